@@ -0,0 +1,378 @@
+# -*- coding: utf-8 -*-
+# @Project Name : spider
+"""
+文件名：archive.py
+功能：网页归档；
+　　　下载到的原始响应追加写入 WARC 格式的归档文件，任务配置变更时可以从归档重新抽取，不必重新抓取：
+　　　　　每条记录单独压缩为一个 gzip member，可以从任意记录的偏移开始解压，兼容 warc 工具
+      写入时只把记录放入内存队列，由后台线程（gevent 模式下为协程，压缩在 hub 线程池中执行）批量压缩和写出
+      归档文件超过大小上限时切换到新的分段文件
+      每个分段有一个索引文件，每行：url 指纹 \\t 偏移 \\t 长度 \\t url
+      读取时 mmap 分段文件，按 url 指纹随机读取，也可以顺序遍历所有记录
+"""
+
+import os
+import time
+import uuid
+import zlib
+import mmap
+import gzip
+import atexit
+import hashlib
+import datetime
+import threading
+from collections import deque
+from http.client import responses as http_reasons
+
+import gevent
+import gevent.lock
+import gevent.event
+from gevent import monkey
+from requests.models import Response
+from requests.structures import CaseInsensitiveDict
+
+import log
+import setting
+import frontier
+
+# 响应内容已经解码，不再保留这些响应头
+DROP_HEADERS = ("content-encoding", "transfer-encoding", "content-length")
+
+
+def fingerprint(url):
+    """
+    url 指纹：规范化 url 的 sha1
+    :param url:
+    :return:
+    """
+    return hashlib.sha1(frontier.canonical_url(url).encode("utf-8")).hexdigest()
+
+
+class ArchiveRecord:
+    """
+    归档中的一条响应记录
+    """
+
+    __slots__ = ("url", "status", "reason", "headers", "body", "warc")
+
+    def __init__(self, url, status, reason, headers, body, warc):
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+        self.warc = warc
+
+    def to_response(self):
+        """
+        转为 requests.Response，供抽取等原有流程使用
+        :return:
+        """
+        response = Response()
+        response.url = self.url
+        response.status_code = self.status
+        response.reason = self.reason
+        response.headers = CaseInsensitiveDict(self.headers)
+        response._content = self.body
+        response.from_archive = True
+        return response
+
+
+class ArchiveWriter:
+    """
+    归档写入
+    """
+
+    def __init__(self, archive_dir=setting.ARCHIVE_DIR, segment_size=setting.ARCHIVE_SEGMENT_SIZE, prefix="spider",
+                 batch_size=100, flush_interval=1, max_pending=1000):
+        """
+
+        :param archive_dir: 归档目录
+        :param segment_size: 分段文件大小上限(字节)
+        :param prefix: 分段文件名前缀，多进程写同一目录时应各不相同
+        :param batch_size: 待写入记录达到该数目时唤醒后台写出
+        :param flush_interval: 后台写出间隔(秒)
+        :param max_pending: 待写入记录超过该数目时由调用方直接写出，避免磁盘慢时占用过多内存
+        """
+        self.archive_dir = archive_dir
+        self.segment_size = segment_size if segment_size > 0 else 1024 * 1024 * 1024
+        self.prefix = prefix
+        self.batch_size = batch_size if batch_size > 0 else 100
+        self.flush_interval = flush_interval if flush_interval > 0 else 1
+        self.max_pending = max(max_pending, self.batch_size)
+        self._file = None
+        self._index = None
+        self._seq = 0
+        self.segment = None
+        # 待压缩写入的记录 (索引 key, url, 未压缩的记录)
+        self._pending = deque()
+        # gevent 模式下 threading 未 patch 时使用协程和 gevent 的锁，否则使用线程和 threading.Lock
+        self._use_greenlet = setting.CRAWLER_MODE == "gevent" and not monkey.is_module_patched("threading")
+        self._lock = gevent.lock.Semaphore() if self._use_greenlet else threading.Lock()
+        self._start_lock = threading.Lock()
+        self._wakeup = None
+        self._writer = None
+        self.running = False
+        if not os.path.isdir(archive_dir):
+            os.makedirs(archive_dir)
+        atexit.register(self.stop)
+
+    def _rotate(self):
+        self.close()
+        self._seq += 1
+        name = "{}-{}-{}-{:05d}.warc.gz".format(self.prefix, os.getpid(),
+                                                 time.strftime("%Y%m%d%H%M%S"), self._seq)
+        self.segment = os.path.join(self.archive_dir, name)
+        self._file = open(self.segment, "ab")
+        self._index = open(self.segment + ".idx", "a")
+
+    @staticmethod
+    def _http_block(status, reason, headers, body):
+        lines = ["HTTP/1.1 {} {}".format(status, reason or http_reasons.get(status, ""))]
+        for name, value in headers:
+            if name.lower() not in DROP_HEADERS:
+                lines.append("{}: {}".format(name, value))
+        lines.append("Content-Length: {}".format(len(body)))
+        return ("\r\n".join(lines) + "\r\n\r\n").encode("utf-8", "replace") + body
+
+    def write(self, url, status, headers, body, reason=None, warc_type="response", key=None, warc_headers=None):
+        """
+        追加一条记录
+        :param url:
+        :param status: http 返回码
+        :param headers: 响应头 [(name, value)]
+        :param body: 解码后的响应内容 bytes
+        :param reason:
+        :param warc_type: WARC-Type
+        :param key: 索引 key，默认为 url 指纹
+        :param warc_headers: 额外的 warc 头 {name: value}
+        :return:
+        """
+        block = self._http_block(status, reason, headers, body or b"")
+        head = [
+            "WARC/1.0",
+            "WARC-Type: {}".format(warc_type),
+            "WARC-Record-ID: <urn:uuid:{}>".format(uuid.uuid4()),
+            "WARC-Date: {}".format(datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")),
+            "WARC-Target-URI: {}".format(url),
+            "Content-Type: application/http; msgtype=response",
+        ]
+        for name, value in (warc_headers or {}).items():
+            head.append("{}: {}".format(name, value))
+        head.append("Content-Length: {}".format(len(block)))
+        record = ("\r\n".join(head) + "\r\n\r\n").encode("utf-8", "replace") + block + b"\r\n\r\n"
+
+        # 压缩和写文件不在下载流程中执行
+        self._pending.append((key or fingerprint(url), url, record))
+        if len(self._pending) >= self.max_pending:
+            self._drain()
+        elif not self.running:
+            self.start()
+        elif len(self._pending) >= self.batch_size:
+            self._wakeup.set()
+
+    @staticmethod
+    def _compress(records):
+        """
+        每条记录单独压缩为一个 gzip member
+        :param records:
+        :return:
+        """
+        result = []
+        for key, url, record in records:
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+            result.append((key, url, compressor.compress(record) + compressor.flush()))
+        return result
+
+    def _drain(self):
+        """
+        压缩并写出待写入的记录
+        :return:
+        """
+        with self._lock:
+            while self._pending:
+                batch = []
+                while self._pending and len(batch) < self.batch_size:
+                    batch.append(self._pending.popleft())
+                if self._use_greenlet and self.running:
+                    # zlib 压缩时释放 GIL，放到线程池中不阻塞 hub；停止后（如进程退出时）直接压缩
+                    batch = gevent.get_hub().threadpool.apply(self._compress, (batch,))
+                else:
+                    batch = self._compress(batch)
+                for key, url, data in batch:
+                    if self._file is None or self._file.tell() + len(data) > self.segment_size:
+                        self._rotate()
+                    offset = self._file.tell()
+                    self._file.write(data)
+                    self._index.write("{}\t{}\t{}\t{}\n".format(key, offset, len(data), url))
+
+    def write_response(self, response, **kwargs):
+        """
+        归档 requests.Response
+        :param response:
+        :param kwargs: 传给 write
+        :return:
+        """
+        return self.write(response.url, response.status_code, list(response.headers.items()),
+                          response.content, reason=response.reason, **kwargs)
+
+    def flush(self):
+        """
+        写出所有待写入的记录
+        :return:
+        """
+        self._drain()
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+                self._index.flush()
+
+    def _run(self):
+        while self.running:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                log.logger.warning("写入归档失败 {}".format(e))
+
+    def start(self):
+        with self._start_lock:
+            if self.running:
+                return
+            self._wakeup = gevent.event.Event() if self._use_greenlet else threading.Event()
+            self.running = True
+            if self._use_greenlet:
+                self._writer = gevent.spawn(self._run)
+            else:
+                self._writer = threading.Thread(target=self._run, name="archive", daemon=True)
+                self._writer.start()
+
+    def stop(self):
+        """
+        停止后台写出，写出剩余的记录
+        :return:
+        """
+        self.running = False
+        if self._wakeup is not None:
+            self._wakeup.set()
+        self.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._index.close()
+            self._file = self._index = None
+
+
+def parse_record(data):
+    """
+    解析一条 warc 记录（已解压）
+    :param data:
+    :return: ArchiveRecord
+    """
+    head_end = data.index(b"\r\n\r\n")
+    warc = {}
+    for line in data[:head_end].decode("utf-8", "replace").split("\r\n")[1:]:
+        name, _, value = line.partition(":")
+        warc[name.strip()] = value.strip()
+    block_start = head_end + 4
+    block = data[block_start:block_start + int(warc.get("Content-Length", len(data) - block_start))]
+
+    http_end = block.index(b"\r\n\r\n")
+    lines = block[:http_end].decode("utf-8", "replace").split("\r\n")
+    _, status, reason = (lines[0].split(" ", 2) + [""])[:3]
+    headers = []
+    for line in lines[1:]:
+        name, _, value = line.partition(":")
+        headers.append((name.strip(), value.strip()))
+    return ArchiveRecord(warc.get("WARC-Target-URI"), int(status), reason, headers, block[http_end + 4:], warc)
+
+
+class ArchiveReader:
+    """
+    归档读取，按 url 指纹随机读取
+    """
+
+    def __init__(self, archive_dir=setting.ARCHIVE_DIR):
+        self.archive_dir = archive_dir
+        # key -> (分段文件, 偏移, 长度)，同一 key 取最新的记录
+        self.index = {}
+        # 分段文件 -> (文件对象, mmap)
+        self._maps = {}
+        self.reload()
+
+    def reload(self):
+        """
+        重新加载所有索引文件
+        :return:
+        """
+        if not os.path.isdir(self.archive_dir):
+            return
+        # 按修改时间加载，后写入的记录覆盖先写入的
+        paths = [os.path.join(self.archive_dir, name) for name in os.listdir(self.archive_dir)
+                 if name.endswith(".warc.gz.idx")]
+        for path in sorted(paths, key=os.path.getmtime):
+            segment = path[:-4]
+            with open(path) as f:
+                for line in f:
+                    parts = line.rstrip("\n").split("\t", 3)
+                    if len(parts) == 4:
+                        self.index[parts[0]] = (segment, int(parts[1]), int(parts[2]))
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def _map(self, segment, end):
+        entry = self._maps.get(segment)
+        # 分段文件仍在写入时，超出已映射长度则重新映射
+        if entry is None or len(entry[1]) < end:
+            if entry is not None:
+                entry[1].close()
+                entry[0].close()
+            f = open(segment, "rb")
+            entry = (f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+            self._maps[segment] = entry
+        return entry[1]
+
+    def read(self, segment, offset, length):
+        m = self._map(segment, offset + length)
+        if len(m) < offset + length:
+            raise ValueError("归档记录不完整 {} {}".format(segment, offset))
+        return parse_record(gzip.decompress(m[offset:offset + length]))
+
+    def get(self, key):
+        """
+        按 url 或索引 key 读取记录，不存在时返回 None
+        :param key:
+        :return: ArchiveRecord
+        """
+        location = self.index.get(key)
+        if location is None and "://" in key:
+            location = self.index.get(fingerprint(key))
+        if location is None:
+            return None
+        try:
+            return self.read(*location)
+        except Exception as e:
+            log.logger.warning("读取归档失败 {} {}".format(key, e))
+            return None
+
+    def __iter__(self):
+        """
+        按索引遍历所有记录（同一 key 只返回最新的记录）
+        :return:
+        """
+        for key in list(self.index):
+            record = self.get(key)
+            if record is not None:
+                yield record
+
+    def close(self):
+        for f, m in self._maps.values():
+            m.close()
+            f.close()
+        self._maps = {}
@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+# @Project Name : spider
+"""
+文件名：benchmark.py
+功能：下载性能基准测试；
+　　　在本地启动模拟站点和模拟代理，按 crawler_mode 分别在子进程中运行 Downloader，
+      输出 json 格式的结果，便于在不同提交之间比较：
+　　　　　pages/s、p50/p99 耗时、错误数、直连数（使用代理时没有取到代理的成功请求）、CPU 时间、最大 RSS
+模拟站点参数：延迟、延迟抖动、错误率、页面大小、页面编码
+用法：
+    python benchmark.py --requests 2000 --concurrency 50 --latency 0.05 --error-rate 0.01 \\
+        --encodings utf-8,gbk --modes gevent,threading --proxies 4 --output bench_output.txt
+"""
+
+import sys
+import json
+import time
+import random
+import argparse
+import resource
+from urllib.parse import urlparse
+
+import gevent
+import gevent.subprocess
+from gevent.pywsgi import WSGIServer
+
+WORDS = "爬虫下载基准测试模拟页面内容"
+
+
+class MockWebFarm:
+    """
+    模拟站点，页面地址 /page/<n>
+    """
+
+    def __init__(self, latency=0.05, jitter=0.02, error_rate=0.0, body_size=20 * 1024,
+                 encodings=("utf-8",), seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.body_size = body_size
+        self.encodings = list(encodings)
+        self.random = random.Random(seed)
+        self._bodies = {}
+        self.servers = []
+
+    def _body(self, encoding):
+        body = self._bodies.get(encoding)
+        if body is None:
+            head = '<html><head><meta charset="{}"><title>bench</title></head><body>'.format(encoding)
+            text = (WORDS * (self.body_size // len(WORDS.encode("utf-8")) + 1))
+            body = (head + "<p>" + text + "</p></body></html>").encode(encoding, "replace")[:self.body_size]
+            self._bodies[encoding] = body
+        return body
+
+    def app(self, environ, start_response):
+        path = urlparse(environ.get("PATH_INFO", "")).path
+        delay = max(0.0, self.random.gauss(self.latency, self.jitter))
+        if delay:
+            gevent.sleep(delay)
+        if self.random.random() < self.error_rate:
+            start_response("500 Internal Server Error", [("Content-Type", "text/plain")])
+            return [b"error"]
+        try:
+            n = int(path.rsplit("/", 1)[-1])
+        except ValueError:
+            n = 0
+        encoding = self.encodings[n % len(self.encodings)]
+        body = self._body(encoding)
+        start_response("200 OK", [("Content-Type", "text/html"), ("Content-Length", str(len(body)))])
+        return [body]
+
+    def start(self, host="127.0.0.1", port=0):
+        server = WSGIServer((host, port), self.app, log=None, error_log=None)
+        server.start()
+        self.servers.append(server)
+        return "{}:{}".format(host, server.server_port)
+
+    def stop(self):
+        for server in self.servers:
+            server.stop()
+        self.servers = []
+
+
+class MockProxy:
+    """
+    模拟代理：按代理的延迟和错误率处理后转发给模拟站点（代理请求的路径是完整 url）
+    """
+
+    def __init__(self, site, latency=0.0, error_rate=0.0, seed=0):
+        """
+
+        :param site: MockWebFarm
+        :param latency: 代理增加的延迟(秒)
+        :param error_rate: 代理错误率，出错时返回 502
+        :param seed:
+        """
+        self.site = site
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.servers = []
+
+    def app(self, environ, start_response):
+        if self.latency:
+            gevent.sleep(self.latency)
+        if self.random.random() < self.error_rate:
+            start_response("502 Bad Gateway", [("Content-Type", "text/plain")])
+            return [b"proxy error"]
+        return self.site.app(environ, start_response)
+
+    start = MockWebFarm.start
+    stop = MockWebFarm.stop
+
+
+def percentile(samples, q):
+    if not samples:
+        return None
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * q))]
+
+
+def run_client(args):
+    """
+    子进程中运行：按 crawler_mode 并发下载，输出一行 json
+    :param args:
+    :return:
+    """
+    if args.mode == "gevent":
+        from gevent import monkey
+        monkey.patch_all()
+
+    # 在导入下载器之前设置，下载器按 crawler_mode 选择代码路径
+    import setting
+    setting.CRAWLER_MODE = args.mode
+
+    import downloader
+
+    proxies = [p for p in (args.proxy_hosts or "").split(",") if p]
+    dl = downloader.Downloader(proxy_enable=bool(proxies), timeout=args.timeout)
+    if proxies:
+        # 不使用共享代理池，模拟代理直接加入进程内的代理管理；没有代理服务器，不重新加载代理
+        dl.proxy_manager = downloader.ProxyManager(10 ** 9, len(proxies), reload_interval=float("inf"))
+        for host in proxies:
+            dl.proxy_manager.registry.add("http", host)
+
+    urls = ["http://{}/page/{}".format(args.site, i) for i in range(args.requests)]
+    latencies = []
+    errors = [0]
+    # 没有可用代理时直接请求站点，成功的请求中直连的数目
+    direct = [0]
+
+    def fetch(url):
+        start = time.time()
+        response = dl.download(url)
+        if response is None or response.status_code != 200:
+            errors[0] += 1
+        else:
+            response.text
+            latencies.append(time.time() - start)
+            if proxies and not getattr(response, "proxies", None):
+                direct[0] += 1
+
+    usage_before = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.time()
+    if args.mode == "gevent":
+        import gevent.pool
+        pool = gevent.pool.Pool(args.concurrency)
+        for url in urls:
+            pool.spawn(fetch, url)
+        pool.join()
+    else:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            list(executor.map(fetch, urls))
+    elapsed = time.time() - start
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+
+    result = {
+        "mode": args.mode,
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "ok": len(latencies),
+        "errors": errors[0],
+        "direct": direct[0],
+        "elapsed": round(elapsed, 3),
+        "pages_per_sec": round(len(latencies) / elapsed, 2) if elapsed else 0,
+        "p50": percentile(latencies, 0.5),
+        "p99": percentile(latencies, 0.99),
+        "cpu_user": round(usage.ru_utime - usage_before.ru_utime, 3),
+        "cpu_sys": round(usage.ru_stime - usage_before.ru_stime, 3),
+        "max_rss_kb": usage.ru_maxrss,
+    }
+    print(json.dumps(result))
+
+
+def run_benchmark(args):
+    """
+    启动模拟站点和代理，依次在子进程中运行各 crawler_mode
+    :param args:
+    :return:
+    """
+    farm = MockWebFarm(args.latency, args.jitter, args.error_rate, args.body_size,
+                       args.encodings.split(","), args.seed)
+    site = farm.start()
+    proxy_farm = MockProxy(farm, args.proxy_latency, args.proxy_error_rate, args.seed + 1)
+    # 借出的代理归还前不会再被选中，代理数少于并发数时多出的请求会直连站点，按并发数补足
+    num_proxies = max(args.proxies, args.concurrency) if args.proxies > 0 else 0
+    if num_proxies > args.proxies:
+        sys.stderr.write("模拟代理数目 {} 小于并发数, 使用 {} 个模拟代理\n".format(args.proxies, num_proxies))
+    proxy_hosts = [proxy_farm.start() for _ in range(num_proxies)]
+
+    results = []
+    try:
+        for mode in args.modes.split(","):
+            cmd = [sys.executable, __file__, "--client", "--mode", mode, "--site", site,
+                   "--proxy-hosts", ",".join(proxy_hosts), "--requests", str(args.requests),
+                   "--concurrency", str(args.concurrency), "--timeout", str(args.timeout)]
+            p = gevent.subprocess.Popen(cmd, stdout=gevent.subprocess.PIPE)
+            out, _ = p.communicate()
+            lines = out.decode("utf-8", "replace").strip().splitlines()
+            if p.returncode != 0 or not lines:
+                results.append({"mode": mode, "error": "client exited with {}".format(p.returncode)})
+                continue
+            results.append(json.loads(lines[-1]))
+    finally:
+        farm.stop()
+        proxy_farm.stop()
+
+    report = {
+        "time": int(time.time()),
+        "params": dict({k: v for k, v in vars(args).items() if k not in ("client", "site", "proxy_hosts", "mode")},
+                       proxies=num_proxies),
+        "results": results,
+    }
+    data = json.dumps(report, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "a") as f:
+            f.write(data + "\n")
+    print(data)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="spider downloader benchmark")
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--timeout", type=int, default=15)
+    parser.add_argument("--modes", default="gevent,threading", help="crawler_mode 列表")
+    parser.add_argument("--latency", type=float, default=0.05, help="站点平均延迟(秒)")
+    parser.add_argument("--jitter", type=float, default=0.02, help="站点延迟标准差(秒)")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--body-size", type=int, default=20 * 1024)
+    parser.add_argument("--encodings", default="utf-8,gbk")
+    parser.add_argument("--proxies", type=int, default=0, help="模拟代理数目, 0 表示不使用代理; 少于并发数时按并发数启动")
+    parser.add_argument("--proxy-latency", type=float, default=0.0)
+    parser.add_argument("--proxy-error-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="", help="结果追加写入的文件")
+    # 子进程参数
+    parser.add_argument("--client", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--mode", default="gevent", help=argparse.SUPPRESS)
+    parser.add_argument("--site", default="", help=argparse.SUPPRESS)
+    parser.add_argument("--proxy-hosts", default="", help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    _args = parse_args()
+    if _args.client:
+        run_client(_args)
+    else:
+        run_benchmark(_args)
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+# @Project Name : spider
+"""
+文件名：breaker.py
+功能：熔断器；
+　　　按 host 或代理分别统计连续失败次数：
+　　　　　closed     正常放行，连续失败达到阈值后转为 open
+      open       拒绝请求，冷却时间结束后转为 half_open
+      half_open  只放行少量探测请求，成功则 closed，失败则重新 open；
+                 探测请求超过冷却时间仍未记录结果（如被取消）时视为丢失，重新放行探测请求
+"""
+
+import time
+
+import requests
+
+import metrics
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(requests.exceptions.RequestException):
+    """
+    熔断器打开时拒绝请求
+    """
+
+    def __init__(self, *args, retry_after=0, **kwargs):
+        """
+
+        :param retry_after: 建议的重试等待时间(秒)
+        """
+        super(CircuitOpenError, self).__init__(*args, **kwargs)
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    单个熔断器
+    """
+
+    __slots__ = ("key", "state", "failures", "opened_at", "probes", "probe_at",
+                 "threshold", "cool_down", "max_probes")
+
+    def __init__(self, key, threshold=5, cool_down=30, max_probes=1):
+        """
+
+        :param key: host 或代理地址
+        :param threshold: 连续失败多少次后打开
+        :param cool_down: 打开后冷却时间(秒)
+        :param max_probes: half_open 状态下同时放行的探测请求数
+        """
+        self.key = key
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self.probes = 0
+        # 最近一次放行探测请求的时间
+        self.probe_at = 0
+        self.threshold = threshold
+        self.cool_down = cool_down
+        self.max_probes = max_probes
+
+    def allow(self, now=None):
+        if self.state == CLOSED:
+            return True
+        now = now if now is not None else time.time()
+        if self.state == OPEN:
+            if now - self.opened_at < self.cool_down:
+                return False
+            self.state = HALF_OPEN
+            self.probes = 0
+        elif self.probes >= self.max_probes and now - self.probe_at >= self.cool_down:
+            # 探测请求没有记录结果，不再等待
+            self.probes = 0
+        if self.probes < self.max_probes:
+            self.probes += 1
+            self.probe_at = now
+            return True
+        return False
+
+    def retry_after(self, now=None):
+        """
+        距离下次可以探测的秒数，closed 状态返回 0
+        :param now:
+        :return:
+        """
+        if self.state != OPEN:
+            return 0
+        now = now if now is not None else time.time()
+        return max(0, self.cool_down - (now - self.opened_at))
+
+    def success(self):
+        self.state = CLOSED
+        self.failures = 0
+        self.probes = 0
+
+    def failure(self, now=None):
+        """
+        记录一次失败，返回熔断器是否因此打开
+        :param now:
+        :return:
+        """
+        self.failures += 1
+        if self.state == HALF_OPEN or self.failures >= self.threshold:
+            opened = self.state != OPEN
+            self.state = OPEN
+            self.opened_at = now if now is not None else time.time()
+            self.probes = 0
+            return opened
+        return False
+
+
+class BreakerRegistry:
+    """
+    一组熔断器，例如所有 host 或所有代理
+    """
+
+    def __init__(self, name, threshold=5, cool_down=30, max_probes=1, max_keys=10000):
+        """
+
+        :param name: 指标名前缀，如 host、proxy
+        :param threshold:
+        :param cool_down:
+        :param max_probes:
+        :param max_keys: 最多保留的熔断器数目，超过时清理 closed 状态的熔断器
+        """
+        self.name = name
+        self.threshold = threshold if threshold > 0 else 5
+        self.cool_down = cool_down if cool_down > 0 else 30
+        self.max_probes = max_probes
+        self.max_keys = max_keys
+        self._breakers = {}
+
+    def get(self, key):
+        breaker = self._breakers.get(key)
+        if breaker is None:
+            if len(self._breakers) >= self.max_keys:
+                self._breakers = {k: b for k, b in self._breakers.items() if b.state != CLOSED}
+            breaker = CircuitBreaker(key, self.threshold, self.cool_down, self.max_probes)
+            self._breakers[key] = breaker
+        return breaker
+
+    def allow(self, key):
+        if not key:
+            return True
+        breaker = self._breakers.get(key)
+        if breaker is None:
+            return True
+        state = breaker.state
+        allowed = breaker.allow()
+        if breaker.state != state:
+            self._publish()
+        if allowed:
+            return True
+        metrics.incr("breaker.{}.rejected".format(self.name))
+        return False
+
+    def retry_after(self, key):
+        breaker = self._breakers.get(key)
+        return breaker.retry_after() if breaker is not None else 0
+
+    def success(self, key):
+        breaker = self._breakers.get(key)
+        if breaker is not None and (breaker.failures or breaker.state != CLOSED):
+            breaker.success()
+            self._publish()
+
+    def failure(self, key):
+        if not key:
+            return
+        if self.get(key).failure():
+            metrics.incr("breaker.{}.opened".format(self.name))
+            self._publish()
+
+    def _publish(self):
+        counts = {OPEN: 0, HALF_OPEN: 0}
+        for breaker in self._breakers.values():
+            if breaker.state in counts:
+                counts[breaker.state] += 1
+        for state, count in counts.items():
+            metrics.gauge("breaker.{}.{}".format(self.name, state), count)
+
+    def snapshot(self):
+        """
+        返回所有非 closed 状态的熔断器
+        :return: {key: (状态, 连续失败次数, 剩余冷却时间)}
+        """
+        return {k: (b.state, b.failures, b.retry_after())
+                for k, b in self._breakers.items() if b.state != CLOSED}
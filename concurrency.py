@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+# @Project Name : spider
+"""
+文件名：concurrency.py
+功能：自适应并发；
+　　　列表页、详情页、数据发送的并发数不再固定为配置值，运行时按 AIMD 调整：
+　　　　　有积压且耗时、错误率、cpu 正常时每个周期加 step 个 worker
+      耗时明显超过基线、错误率或 cpu 过高时乘以 beta 减少 worker
+      没有积压时保持不变
+      并发数始终在 [floor, ceiling] 之间，当前值写入 metrics concurrency.<name>.size
+"""
+
+import time
+import resource
+import threading
+
+import gevent
+
+import log
+import setting
+import metrics
+
+_sleep = gevent.sleep if setting.CRAWLER_MODE == "gevent" else time.sleep
+
+
+def _spawn(func, name):
+    """
+    gevent 模式下启动协程，threading 模式下启动线程
+    :param func:
+    :param name:
+    :return:
+    """
+    if setting.CRAWLER_MODE == "gevent":
+        return gevent.spawn(func)
+    thread = threading.Thread(target=func, name=name, daemon=True)
+    thread.start()
+    return thread
+
+
+class ResizablePool:
+    """
+    可调整大小的 worker 池；每个 worker 循环调用 target，每次调用处理一个任务，
+    缩小时多出的 worker 在处理完当前任务后退出；
+    target 返回 True / False 表示任务成功 / 失败，返回 None 表示没有任务，不计入统计
+    """
+
+    def __init__(self, name, target, size=1):
+        """
+
+        :param name:
+        :param target: worker 每次循环调用的函数，没有任务时应自行等待
+        :param size: 初始 worker 数目
+        """
+        self.name = name
+        self.target = target
+        self.size = 0
+        self.running = 0
+        self._excess = 0
+        self._stopped = False
+        self._lock = threading.Lock()
+        # 每个任务完成后调用 on_done(耗时, 是否成功)
+        self.on_done = None
+        self.resize(size)
+
+    def _should_exit(self):
+        with self._lock:
+            if self._stopped:
+                return True
+            if self._excess > 0:
+                self._excess -= 1
+                return True
+            return False
+
+    def _worker(self):
+        with self._lock:
+            self.running += 1
+        try:
+            while not self._should_exit():
+                start = time.time()
+                try:
+                    ok = self.target()
+                except Exception as e:
+                    log.logger.exception(e)
+                    ok = False
+                if ok is not None and self.on_done is not None:
+                    self.on_done(time.time() - start, ok)
+        finally:
+            with self._lock:
+                self.running -= 1
+
+    def resize(self, size):
+        """
+        调整 worker 数目
+        :param size:
+        :return:
+        """
+        size = max(0, int(size))
+        with self._lock:
+            if self._stopped:
+                return
+            delta = size - self.size
+            self.size = size
+            if delta < 0:
+                self._excess -= delta
+                return
+            # 先抵消尚未退出的多余 worker
+            reuse = min(delta, self._excess)
+            self._excess -= reuse
+            delta -= reuse
+        for _ in range(delta):
+            _spawn(self._worker, "{}-worker".format(self.name))
+
+    def stop(self):
+        with self._lock:
+            self._stopped = True
+
+
+class AIMDController:
+    """
+    AIMD 并发控制器
+    """
+
+    def __init__(self, pool, floor=1, ceiling=100, step=1, beta=0.7, interval=10,
+                 queue_depth=None, max_error_rate=setting.CONCURRENCY_MAX_ERROR_RATE,
+                 max_cpu=setting.CONCURRENCY_MAX_CPU, latency_tolerance=2.0, min_samples=10):
+        """
+
+        :param pool: ResizablePool
+        :param floor: 最小并发数
+        :param ceiling: 最大并发数
+        :param step: 每个周期增加的并发数
+        :param beta: 减少时乘以的系数
+        :param interval: 调整周期(秒)
+        :param queue_depth: 返回待处理任务数目的函数，为空时认为一直有积压
+        :param max_error_rate: 周期内错误率超过该值时减少并发
+        :param max_cpu: 进程 cpu 使用率(单核比例)超过该值时减少并发
+        :param latency_tolerance: 周期内平均耗时超过基线耗时的倍数时减少并发
+        :param min_samples: 周期内样本数少于该值时不根据耗时和错误率调整
+        """
+        self.pool = pool
+        self.floor = max(1, floor)
+        self.ceiling = max(self.floor, ceiling)
+        self.step = step
+        self.beta = beta
+        self.interval = interval
+        self.queue_depth = queue_depth
+        self.max_error_rate = max_error_rate
+        self.max_cpu = max_cpu
+        self.latency_tolerance = latency_tolerance
+        self.min_samples = min_samples
+        # 基线耗时：观察到的最小周期平均耗时，缓慢上浮以适应站点变化
+        self.baseline = None
+        self._count = 0
+        self._errors = 0
+        self._elapsed = 0.0
+        self._last_cpu = None
+        self._last_time = None
+        self.running = False
+        self.pool.on_done = self.record
+        self.pool.resize(min(max(pool.size, self.floor), self.ceiling))
+
+    def record(self, elapsed, ok=True):
+        """
+        worker 每处理完一个任务调用一次
+        :param elapsed: 耗时(秒)
+        :param ok: 是否成功
+        :return:
+        """
+        self._count += 1
+        self._elapsed += elapsed
+        if not ok:
+            self._errors += 1
+
+    def _cpu(self):
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        now = time.time()
+        cpu = usage.ru_utime + usage.ru_stime
+        ratio = None
+        if self._last_cpu is not None and now > self._last_time:
+            ratio = (cpu - self._last_cpu) / (now - self._last_time)
+        self._last_cpu, self._last_time = cpu, now
+        return ratio
+
+    def adjust(self):
+        """
+        根据上一个周期的统计调整并发数
+        :return: 新的并发数
+        """
+        count, errors, elapsed = self._count, self._errors, self._elapsed
+        self._count, self._errors, self._elapsed = 0, 0, 0.0
+        cpu = self._cpu()
+        backlog = self.queue_depth() if self.queue_depth is not None else 1
+        size = self.pool.size
+
+        overloaded = cpu is not None and cpu > self.max_cpu
+        if count >= self.min_samples:
+            latency = elapsed / count
+            if self.baseline is None or latency < self.baseline:
+                self.baseline = latency
+            else:
+                self.baseline *= 1.01
+            if errors / count > self.max_error_rate or latency > self.baseline * self.latency_tolerance:
+                overloaded = True
+
+        if overloaded:
+            new_size = max(self.floor, int(size * self.beta))
+        elif backlog > 0:
+            new_size = min(self.ceiling, size + self.step)
+        else:
+            new_size = size
+        new_size = min(max(new_size, self.floor), self.ceiling)
+        if new_size != size:
+            self.pool.resize(new_size)
+        metrics.gauge("concurrency.{}.size".format(self.pool.name), new_size)
+        return new_size
+
+    def _run(self):
+        self._cpu()
+        while self.running:
+            _sleep(self.interval)
+            if not self.running:
+                break
+            try:
+                self.adjust()
+            except Exception as e:
+                log.logger.exception(e)
+
+    def start(self):
+        if not self.running:
+            self.running = True
+            _spawn(self._run, "{}-aimd".format(self.pool.name))
+
+    def stop(self):
+        self.running = False
+
+
+def create_pool(name, target, queue_depth=None):
+    """
+    按配置创建 list / detail / data worker 池；开启自适应并发时返回 (池, 控制器)，否则控制器为 None
+    :param name: list, detail, data
+    :param target:
+    :param queue_depth:
+    :return:
+    """
+    size, floor, ceiling = {
+        "list": (setting.LIST_PAGE_THREAD_NUM, setting.LIST_PAGE_THREAD_MIN, setting.LIST_PAGE_THREAD_MAX),
+        "detail": (setting.DETAIL_PAGE_THREAD_NUM, setting.DETAIL_PAGE_THREAD_MIN, setting.DETAIL_PAGE_THREAD_MAX),
+        "data": (setting.DATA_QUEUE_THREAD_NUM, setting.DATA_QUEUE_THREAD_MIN, setting.DATA_QUEUE_THREAD_MAX),
+    }[name]
+    pool = ResizablePool(name, target, size)
+    if not setting.ADAPTIVE_CONCURRENCY:
+        return pool, None
+    controller = AIMDController(pool, floor, ceiling, queue_depth=queue_depth)
+    controller.start()
+    return pool, controller
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+# @Project Name : spider
+"""
+文件名：cookiepool.py
+功能：按 host 或任务分片的 cookie jar；
+　　　目前实现的功能有：
+　　　　　每个 host（或请求 meta 中的 cookie_key）使用独立的 cookie jar
+      cookie jar 数目有上限，按 LRU 淘汰
+      可选持久化到本地目录，淘汰和退出时保存，再次使用时加载
+      记录 cookie jar 对应的代理，需要登录或反爬 cookie 的站点始终使用同一个代理
+"""
+
+import os
+import atexit
+import pickle
+import hashlib
+from collections import OrderedDict
+from http.cookiejar import DefaultCookiePolicy
+
+from requests.cookies import RequestsCookieJar, extract_cookies_to_jar
+
+import log
+import setting
+
+
+class BlockAllCookiePolicy(DefaultCookiePolicy):
+    """
+    session 自身的 cookie jar 不保存也不发送任何 cookie，cookie 全部由分片 jar 管理
+    """
+
+    def set_ok(self, cookie, request):
+        return False
+
+    def return_ok(self, cookie, request):
+        return False
+
+
+class CookieJarPool:
+    """
+    cookie jar 分片
+    """
+
+    def __init__(self, max_jars=setting.COOKIE_JAR_MAX, persist_dir=setting.COOKIE_JAR_DIR):
+        """
+
+        :param max_jars: 内存中最多保留的 cookie jar 数目
+        :param persist_dir: 持久化目录，为空时不持久化
+        """
+        self.max_jars = max_jars if max_jars > 0 else 1000
+        self.persist_dir = persist_dir
+        self._jars = OrderedDict()
+        # cookie jar key -> (代理类型, 代理地址)
+        self._affinity = OrderedDict()
+        if persist_dir:
+            if not os.path.isdir(persist_dir):
+                os.makedirs(persist_dir)
+            # 进程退出时保存内存中的 cookie jar，停机协调器也会主动调用 save_all
+            atexit.register(self.save_all)
+
+    @staticmethod
+    def key_for(host, request=None):
+        """
+        请求 meta 中指定 cookie_key 时使用该 key，否则按 host 分片
+        :param host:
+        :param request:
+        :return:
+        """
+        if isinstance(request, dict):
+            key = (request.get("meta") or {}).get("cookie_key")
+            if key:
+                return str(key)
+        return host or ""
+
+    def _path(self, key):
+        return os.path.join(self.persist_dir, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".cookie")
+
+    def _load(self, key):
+        if not self.persist_dir:
+            return None
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, "rb") as f:
+                key_saved, jar, affinity = pickle.load(f)
+        except Exception as e:
+            log.logger.warning("加载 cookie 失败 {} {}".format(key, e))
+            return None
+        if key_saved != key:
+            return None
+        if affinity:
+            self._affinity[key] = affinity
+        return jar
+
+    def save(self, key):
+        """
+        持久化指定的 cookie jar
+        :param key:
+        :return:
+        """
+        jar = self._jars.get(key)
+        if not self.persist_dir or jar is None:
+            return
+        path = self._path(key)
+        try:
+            with open(path + ".tmp", "wb") as f:
+                pickle.dump((key, jar, self._affinity.get(key)), f)
+            os.replace(path + ".tmp", path)
+        except Exception as e:
+            log.logger.warning("保存 cookie 失败 {} {}".format(key, e))
+
+    def save_all(self):
+        """
+        持久化内存中的全部 cookie jar
+        :return:
+        """
+        for key in list(self._jars):
+            self.save(key)
+
+    def get(self, key):
+        """
+        返回该 key 的 cookie jar，不存在时加载或新建
+        :param key:
+        :return:
+        """
+        jar = self._jars.get(key)
+        if jar is not None:
+            self._jars.move_to_end(key)
+            return jar
+        jar = self._load(key) or RequestsCookieJar()
+        self._jars[key] = jar
+        while len(self._jars) > self.max_jars:
+            old_key = next(iter(self._jars))
+            self.save(old_key)
+            self._jars.pop(old_key)
+            self._affinity.pop(old_key, None)
+        return jar
+
+    def clear(self, key):
+        """
+        清空 cookie 和代理绑定，例如登录失效时
+        :param key:
+        :return:
+        """
+        self._jars.pop(key, None)
+        self._affinity.pop(key, None)
+        if self.persist_dir and os.path.exists(self._path(key)):
+            os.remove(self._path(key))
+
+    @staticmethod
+    def extract(jar, response):
+        """
+        把响应（包括重定向过程中的响应）设置的 cookie 保存到 jar
+        :param jar:
+        :param response:
+        :return:
+        """
+        for r in list(response.history) + [response]:
+            if getattr(r, "raw", None) is not None and r.request is not None:
+                extract_cookies_to_jar(jar, r.request, r.raw)
+            else:
+                # http/2 通道转换的响应没有 raw，cookie 已复制到 response.cookies
+                for cookie in r.cookies:
+                    jar.set_cookie(cookie)
+
+    def sticky_proxy(self, key):
+        """
+        返回该 cookie jar 绑定的代理 (代理类型, 代理地址)，没有时返回 (None, None)
+        :param key:
+        :return:
+        """
+        return self._affinity.get(key) or (None, None)
+
+    def bind_proxy(self, key, proxy_type, proxy_host):
+        if proxy_host:
+            self._affinity[key] = (proxy_type, proxy_host)
+
+    def unbind_proxy(self, key):
+        self._affinity.pop(key, None)
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+# @Project Name : spider
+"""
+文件名：crawlstats.py
+功能：进程内抓取统计；
+　　　按 (config_id, host, 返回码) 统计下载次数、字节数、耗时和耗时分布，
+　　　目前实现的功能有：
+　　　　　每个协程（线程）写自己的统计表，热路径上没有锁，只有一次字典查找和几次加法
+      耗时分布按 2 的幂分桶(毫秒)，分桶用 math.frexp 计算
+      发送心跳时汇总各 worker 的增量，作为心跳的 stats 字段发送；
+          心跳发送失败时增量保留到下一次心跳
+      threading 模式下 worker 可能在交换统计表的同时写入旧表，旧表推迟一个周期再汇总，不丢失计数
+"""
+
+import math
+
+import gevent
+
+# 耗时分桶数目：第 i 桶为 [2^(i-1), 2^i) 毫秒，最后一桶包含更大的值
+BUCKETS = 20
+
+
+class WorkerStats:
+    """
+    单个 worker 的统计表，只由该 worker 写入
+    """
+
+    __slots__ = ("data", "retired", "owner")
+
+    def __init__(self, owner=None):
+        # (config_id, host, 返回码) -> [次数, 字节数, 总耗时毫秒, {分桶: 次数}]
+        self.data = {}
+        # 上一个周期交换出来的统计表
+        self.retired = None
+        self.owner = owner
+
+    def record(self, config_id, host, status, elapsed, size=0):
+        """
+
+        :param config_id:
+        :param host:
+        :param status: 返回码，下载失败为 0
+        :param elapsed: 耗时(秒)
+        :param size: 响应字节数
+        :return:
+        """
+        key = (config_id, host, status)
+        entry = self.data.get(key)
+        if entry is None:
+            entry = self.data[key] = [0, 0, 0.0, {}]
+        ms = elapsed * 1000
+        bucket = min(max(math.frexp(ms)[1], 0), BUCKETS - 1)
+        entry[0] += 1
+        entry[1] += size
+        entry[2] += ms
+        histogram = entry[3]
+        histogram[bucket] = histogram.get(bucket, 0) + 1
+
+
+def _merge(target, data):
+    for key, (count, size, ms, histogram) in data.items():
+        entry = target.get(key)
+        if entry is None:
+            entry = target[key] = [0, 0, 0.0, {}]
+        entry[0] += count
+        entry[1] += size
+        entry[2] += ms
+        for bucket, n in histogram.items():
+            entry[3][bucket] = entry[3].get(bucket, 0) + n
+
+
+class StatsAggregator:
+    """
+    统计汇总
+    """
+
+    def __init__(self):
+        # worker 标识(协程或线程) -> WorkerStats
+        self._workers = {}
+        # 已发送但尚未确认的增量
+        self._inflight = None
+
+    def worker(self):
+        """
+        返回当前协程（线程）的统计表
+        :return:
+        """
+        owner = gevent.getcurrent()
+        stats = self._workers.get(owner)
+        if stats is None:
+            stats = self._workers[owner] = WorkerStats(owner)
+        return stats
+
+    def record(self, config_id, host, status, elapsed, size=0):
+        self.worker().record(config_id, host, status, elapsed, size)
+
+    def collect(self):
+        """
+        汇总各 worker 的增量
+        :return: {(config_id, host, 返回码): [次数, 字节数, 总耗时毫秒, {分桶: 次数}]}
+        """
+        delta = {}
+        for owner, stats in list(self._workers.items()):
+            if stats.retired:
+                _merge(delta, stats.retired)
+            stats.retired, stats.data = stats.data, {}
+            if getattr(owner, "dead", False) and not stats.retired:
+                self._workers.pop(owner, None)
+        return delta
+
+    @staticmethod
+    def compact(delta):
+        """
+        转为心跳中发送的紧凑格式：{"config_id|host|返回码": [次数, 字节数, 总耗时毫秒, {分桶: 次数}]}
+        :param delta:
+        :return:
+        """
+        return {"{}|{}|{}".format(*key): [count, size, round(ms, 1), histogram]
+                for key, (count, size, ms, histogram) in delta.items()}
+
+    def heartbeat_provider(self):
+        """
+        DispatcherClient 心跳数据函数；上一次心跳未确认时，上一次的增量合并到本次发送
+        DispatcherClient 默认注册 aggregator 的 heartbeat_provider 和 heartbeat_listener
+        :return:
+        """
+        delta = self.collect()
+        if self._inflight:
+            _merge(delta, self._inflight)
+        self._inflight = delta
+        return {"stats": self.compact(delta)} if delta else {}
+
+    def heartbeat_listener(self, data):
+        """
+        心跳发送成功
+        :param data:
+        :return:
+        """
+        self._inflight = None
+
+
+aggregator = StatsAggregator()
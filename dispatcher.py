@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+# @Project Name : spider
+"""
+文件名：dispatcher.py
+功能：调度服务客户端；
+　　　目前实现的功能有：
+　　　　　单一连接池 keep-alive session
+      批量获取任务（一次请求获取 N 个任务）
+      长轮询 / 预取，任务队列低于水位时后台补充
+      心跳合并，同一周期内的多次心跳只发送一次
+      抓取结果批量发送
+"""
+
+import json
+import time
+
+import gevent
+import gevent.event
+import gevent.queue
+import requests
+from requests.adapters import HTTPAdapter
+
+import log
+import setting
+import crawlstats
+
+
+class DispatcherClient:
+    """
+    调度服务客户端
+    所有请求共用一个 session，url 模板来自 spider.conf，
+    测试时可通过 urls 和 session 参数指向本地的桩调度服务
+    """
+
+    def __init__(self, spider_id=setting.SPIDER_ID, batch_size=setting.TASK_BATCH_SIZE,
+                 prefetch_num=setting.TASK_PREFETCH_NUM, long_poll=setting.TASK_LONG_POLL,
+                 heartbeat_interval=setting.HEARTBEAT_INTERVAL, timeout=setting.HTTP_TIMEOUT,
+                 urls=None, session=None, crawl_stats=True):
+        """
+
+        :param spider_id: 爬虫id
+        :param batch_size: 每次请求获取的任务数目
+        :param prefetch_num: 本地任务队列低水位，低于该数目时后台预取任务
+        :param long_poll: 长轮询等待时间(秒)，0 表示不使用长轮询
+        :param heartbeat_interval: 心跳发送间隔(秒)
+        :param timeout: 请求超时时间
+        :param urls: 覆盖 spider.conf 中的调度地址, 键为 get_spider_config_from, add_spider_from,
+                     spider_heartbeat_from, send_crawl_result_to
+        :param session: 自定义 session
+        :param crawl_stats: 是否在心跳中发送进程内抓取统计(crawlstats.aggregator)
+        """
+        self.spider_id = spider_id
+        self.batch_size = batch_size if batch_size > 0 else 1
+        self.prefetch_num = prefetch_num if prefetch_num > 0 else self.batch_size
+        self.long_poll = long_poll if long_poll > 0 else 0
+        self.heartbeat_interval = heartbeat_interval if heartbeat_interval > 0 else 30
+        self.timeout = timeout if 0 < timeout <= 120 else 30
+
+        self.urls = {
+            "get_spider_config_from": setting.GET_SPIDER_CONFIG_FROM,
+            "add_spider_from": setting.ADD_SPIDER_FROM,
+            "spider_heartbeat_from": setting.SPIDER_HEARTBEAT_FROM,
+            "send_crawl_result_to": setting.SEND_CRAWL_RESULT_TO,
+        }
+        self.urls.update(urls or {})
+
+        if session is None:
+            session = requests.Session()
+            a = HTTPAdapter(pool_connections=1, pool_maxsize=16, max_retries=0)
+            session.mount("http://", a)
+            session.mount("https://", a)
+        self.session = session
+
+        # 预取的任务
+        self.task_queue = gevent.queue.Queue()
+        # 有 worker 在等待任务时置位，唤醒预取协程
+        self._need_tasks = gevent.event.Event()
+        # 待合并发送的心跳数据
+        self._heartbeat_payload = {}
+        self._heartbeat_pending = gevent.event.Event()
+        # 心跳监听函数 func(心跳返回数据)，如节点列表
+        self.heartbeat_listeners = []
+        # 心跳数据函数 func() -> dict，发送心跳时调用，返回值合并到心跳数据中
+        self.heartbeat_providers = []
+        if crawl_stats:
+            self.add_heartbeat_provider(crawlstats.aggregator.heartbeat_provider)
+            self.add_heartbeat_listener(crawlstats.aggregator.heartbeat_listener)
+        # 待批量发送的抓取结果
+        self._results = []
+        self._workers = []
+        self._stopped = False
+
+    def _request(self, method, url, timeout=None, **kwargs):
+        """
+        发送请求并解析 json 返回值，请求失败返回 None
+        :param method:
+        :param url:
+        :param timeout:
+        :param kwargs:
+        :return:
+        """
+        if not url:
+            return None
+        try:
+            r = self.session.request(method, url, timeout=timeout or self.timeout, **kwargs)
+            r.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            log.logger.warning("调度服务请求失败 url:{} {}".format(url, e))
+            return None
+        try:
+            return r.json()
+        except ValueError:
+            return r.text
+
+    def register(self, spider_name):
+        """
+        注册爬虫，返回调度服务分配的爬虫id
+        :param spider_name:
+        :return:
+        """
+        data = self._request("GET", self._format("add_spider_from", spider_name))
+        if isinstance(data, dict):
+            data = data.get("spider_id") or data.get("spiderid") or data.get("id")
+        if data:
+            self.spider_id = str(data).strip()
+        return self.spider_id
+
+    def _format(self, name, *args):
+        template = self.urls.get(name) or ""
+        if not template:
+            return ""
+        try:
+            return template % args
+        except TypeError:
+            return template
+
+    @staticmethod
+    def _parse_tasks(data):
+        """
+        兼容三种返回格式: 任务列表、{"tasks": [...]}、单个任务
+        :param data:
+        :return:
+        """
+        if not data:
+            return []
+        if isinstance(data, list):
+            return [task for task in data if task]
+        if isinstance(data, dict):
+            if "tasks" in data:
+                return [task for task in data.get("tasks") or [] if task]
+            return [data]
+        return []
+
+    def fetch_tasks(self, worker_id="", num=None, wait=0):
+        """
+        一次请求获取多个任务
+        :param worker_id:
+        :param num: 获取任务数目，默认 batch_size
+        :param wait: 长轮询等待时间，调度服务在该时间内没有任务时才返回空
+        :return: 任务列表
+        """
+        params = {"num": num or self.batch_size}
+        timeout = self.timeout
+        if wait:
+            params["wait"] = wait
+            timeout = self.timeout + wait
+        url = self._format("get_spider_config_from", self.spider_id, worker_id)
+        return self._parse_tasks(self._request("GET", url, timeout=timeout, params=params))
+
+    def _prefetch_loop(self, worker_id):
+        """
+        保持本地任务队列不低于 prefetch_num；
+        使用长轮询时由调度服务挂起请求，否则没有任务时退避等待；
+        长轮询请求失败或很快返回空（调度服务不支持 wait）时同样退避，不连续请求调度服务
+        :param worker_id:
+        :return:
+        """
+        idle = 1
+        while not self._stopped:
+            if self.task_queue.qsize() >= self.prefetch_num:
+                self._need_tasks.clear()
+                self._need_tasks.wait(timeout=1)
+                continue
+            start = time.time()
+            tasks = self.fetch_tasks(worker_id, wait=self.long_poll)
+            for task in tasks:
+                self.task_queue.put(task)
+            if tasks:
+                idle = 1
+            elif not self.long_poll or time.time() - start < self.long_poll / 2.0:
+                gevent.sleep(idle)
+                idle = min(idle * 2, 30)
+            else:
+                # 调度服务挂起了请求，立即发起下一次长轮询
+                idle = 1
+
+    def get_task(self, block=True, timeout=None):
+        """
+        从本地预取队列获取一个任务
+        :param block:
+        :param timeout:
+        :return: 任务，没有任务时返回 None
+        """
+        if self.task_queue.qsize() < self.prefetch_num:
+            self._need_tasks.set()
+        try:
+            return self.task_queue.get(block=block, timeout=timeout)
+        except gevent.queue.Empty:
+            return None
+
+    def heartbeat(self, **payload):
+        """
+        记录一次心跳，由后台协程在下一个周期合并发送
+        :param payload: 附带的心跳数据，同名键后写覆盖先写
+        :return:
+        """
+        self._heartbeat_payload.update(payload)
+        self._heartbeat_pending.set()
+
+    def send_heartbeat(self):
+        """
+        立即发送心跳
+        :return:
+        """
+        payload, self._heartbeat_payload = self._heartbeat_payload, {}
+        self._heartbeat_pending.clear()
+        for func in self.heartbeat_providers:
+            try:
+                payload.update(func() or {})
+            except Exception as e:
+                log.logger.warning("心跳数据函数异常 {}".format(e))
+        payload.setdefault("time", int(time.time()))
+        url = self._format("spider_heartbeat_from", self.spider_id)
+        data = self._request("POST", url, data={"data": json.dumps(payload)})
+        if data is not None:
+            for func in self.heartbeat_listeners:
+                try:
+                    func(data)
+                except Exception as e:
+                    log.logger.warning("心跳监听函数异常 {}".format(e))
+        return data
+
+    def add_heartbeat_listener(self, func):
+        self.heartbeat_listeners.append(func)
+
+    def add_heartbeat_provider(self, func):
+        self.heartbeat_providers.append(func)
+
+    def _heartbeat_loop(self):
+        # 每个周期固定发送一次，周期内的多次 heartbeat() 合并到同一次请求
+        while not self._stopped:
+            gevent.sleep(self.heartbeat_interval)
+            self.send_heartbeat()
+
+    def send_result(self, result):
+        """
+        缓存抓取结果，由后台协程随心跳周期批量发送
+        :param result:
+        :return:
+        """
+        self._results.append(result)
+
+    def flush_results(self):
+        """
+        批量发送缓存的抓取结果，发送失败的结果放回缓存，下次重新发送
+        :return:
+        """
+        if not self._results:
+            return None
+        results, self._results = self._results, []
+        url = self.urls.get("send_crawl_result_to")
+        data = self._request("POST", url, data={"data": json.dumps(results)})
+        if data is None and url:
+            self._results[:0] = results
+        return data
+
+    def _result_loop(self):
+        while not self._stopped:
+            gevent.sleep(self.heartbeat_interval)
+            self.flush_results()
+
+    def start(self, worker_id=""):
+        """
+        启动预取、心跳和结果发送协程
+        :param worker_id:
+        :return:
+        """
+        self._stopped = False
+        self._workers = [
+            gevent.spawn(self._prefetch_loop, worker_id),
+            gevent.spawn(self._heartbeat_loop),
+            gevent.spawn(self._result_loop),
+        ]
+
+    def stop(self):
+        """
+        停止后台协程，并发送剩余的心跳和结果
+        :return:
+        """
+        self._stopped = True
+        gevent.killall(self._workers)
+        self._workers = []
+        if self._heartbeat_pending.is_set():
+            self.send_heartbeat()
+        self.flush_results()
@@ -10,28 +10,70 @@
       支持　content-encoding：　gzip　deflate
       retry
       redirect
+      http 条件请求缓存(ETag / Last-Modified)
+      响应编码识别(header / meta / 统计识别, 按 host 缓存)
+      dns 缓存和预解析
+      http/2 多路复用(可选, 不支持时回退到 http/1.1)
+      对冲请求(可选, 超过该 host 的 p95 耗时未返回时换代理再发一次)
+      按 host 和代理熔断
+      按 host 或任务分片的 cookie jar，可绑定代理
+      慢请求分阶段耗时跟踪(proxy / dns / send / body / retry_sleep)
+      gevent 模式下重试等待不阻塞 hub
+      下载日志异步批量输出，同一站点重复日志限流
+      记录正在进行的请求数，退出时等待请求完成
+      相同请求合并：并发的相同请求(规范化 url + method + body)只下载一次，共享响应
+      原始响应写入 WARC 归档(可选)
+      录制 / 回放模式：录制请求和响应，回放时不访问网络
+      按 config_id / host / 返回码 统计下载次数、字节数和耗时分布
 """
 
 import gevent
 import gevent.queue
+import gevent.event
+import gevent.pool
+import gevent.socket
 # from gevent import monkey
 
 # monkey.patch_all()
 from urllib.parse import urlparse
 import json
 import time
+import hashlib
 import copy
-import random
+import socket
 import logging
+import ipaddress
 import traceback
+from collections import OrderedDict, deque
 
 import requests
 from requests.adapters import HTTPAdapter
+from urllib3.util import connection as urllib3_connection
+
+try:
+    import dns.resolver
+    import dns.exception
+    dns_resolver = dns.resolver
+except ImportError:
+    dns_resolver = None
 
 import log
-import util
 import proxy
 import setting
+import httpcache
+import encoding
+import metrics
+import frontier
+import h2transport
+import breaker
+import proxyregistry
+import proxypool
+import cookiepool
+import archive
+import replay
+import crawlstats
+import profiler
+import hotlog
 
 
 def retry(ExceptionToCheck, tries=2, delay=1, backoff=2):
@@ -44,6 +86,9 @@ def retry(ExceptionToCheck, tries=2, delay=1, backoff=2):
     :return:
     """
 
+    # gevent 模式下即使 time 未被 monkey patch 也不阻塞 hub
+    _sleep = gevent.sleep if setting.CRAWLER_MODE == "gevent" else time.sleep
+
     def deco_retry(f):
         def f_retry(self, *args, **kwargs):
             mtries, mdelay = tries, delay
@@ -51,9 +96,16 @@ def retry(ExceptionToCheck, tries=2, delay=1, backoff=2):
                 try:
                     return f(self, *args, **kwargs)
                 except ExceptionToCheck as e:
-                    log.logger.exception(e)
-                    log.logger.error("{}, Retrying in %d seconds...".format(util.B(str(e)), mdelay))
-                    time.sleep(mdelay)
+                    # 熔断中的请求不重试
+                    if isinstance(e, breaker.CircuitOpenError):
+                        raise
+                    request = args[0] if args else kwargs.get("request")
+                    url = request.get("url") if isinstance(request, dict) else request
+                    hotlog.hot_logger.exception("retry", urlparse(url).hostname if url else None, e,
+                                                "{}, Retrying in {} seconds...", e, mdelay,
+                                                url=url, error=type(e).__name__, config_id=self._config_id(request))
+                    with profiler.tracer.phase("retry_sleep"):
+                        _sleep(mdelay)
                     mtries -= 1
                     mdelay *= backoff
                     lastException = e
@@ -69,15 +121,22 @@ def retry(ExceptionToCheck, tries=2, delay=1, backoff=2):
 class ProxyItem:
     """
     代理对象
+    只保存本次借出的代理，统计信息保存在 ProxyRegistry 中
     """
 
-    def __init__(self, proxy_type=None, host=None, proxy_max_num=10):
+    __slots__ = ("pid", "proxy_type", "host", "max_reused_num", "proxy_counter", "origin")
+
+    def __init__(self, proxy_type=None, host=None, proxy_max_num=10, pid=None, origin=None):
         """
 
         :param proxy_type: 代理类型
         :param host: 代理地址
         :param proxy_max_num: 代理最多连续使用的次数
+        :param pid: 代理在 ProxyRegistry 中的 id
+        :param origin: 借出该代理的代理池，None 表示进程内的 ProxyManager
         """
+        self.pid = pid
+        self.origin = origin
         self.max_reused_num = setting.PROXY_MAX_NUM if proxy_max_num <= 0 else proxy_max_num
         # 记录当前代理已使用次数
         self.proxy_counter = 0
@@ -105,98 +164,426 @@ class ProxyItem:
 class ProxyManager:
     """
     代理管理
+    代理保存在 ProxyRegistry 中，按成功率和耗时加权随机选择；
+    借出的代理在归还前不会再被选中
     """
 
-    def __init__(self, proxy_max_num=10, available_proxy=20, proxy_url=None):
+    def __init__(self, proxy_max_num=10, available_proxy=20, proxy_url=None,
+                 reload_interval=setting.PROXY_RELOAD_INTERVAL):
         """
 
         :param proxy_max_num: 代理最多可连续使用次数
         :param available_proxy: 最多可用代理数目
         :param proxy_url:
+        :param reload_interval: 可用代理不足时两次加载代理的最小间隔(秒)
         :return:
         """
         self.proxy_max_num = setting.PROXY_MAX_NUM if proxy_max_num <= 0 else proxy_max_num
         self.maxsize = setting.PAROXY if available_proxy <= 0 else available_proxy
         self.proxy_url = proxy_url
-        self.proxy_queue = gevent.queue.LifoQueue(maxsize=self.maxsize * 5)
+        self.reload_interval = reload_interval
+        self._last_reload = 0
+        self.registry = proxyregistry.ProxyRegistry(max_failures=setting.PROXY_MAX_FAILURES)
         # 代理黑名单， 保存下载失败时使用的代理
-        self.black_peoxies = set()
+        self.black_peoxies = self.registry.blacklist
 
-    def random_choice_proxy(self):
+    def _maybe_reload(self):
         """
-        随机从 self.proxy_list 中获取一个代理，并将该代理从self.proxy_list删除
-        如果 self.proxy_list 元素较少时，重新加载代理
+        可用代理不足时重新加载代理；注册表已满（代理都已借出）或距上次加载不足 reload_interval 秒时不加载
         :return:
         """
-        # 重新加载代理
-        if len(self.proxy_list) <= 1:
-            self.proxy_list = proxy.get_proxy(self.proxy_url)
+        if self.registry.available_count() > 1 or len(self.registry) >= self.maxsize * 5:
+            return
+        if time.time() - self._last_reload < self.reload_interval:
+            return
+        self._reload()
 
-        # 随机重proxy_list 中获取一个代理，并将该代理从proxy_lsit 中删除
-        try:
-            index = int(random.random() * len(self.proxy_list))
-            proxy_type, host, port = self.proxy_list.pop(index)
-        except:
+    def _reload(self):
+        """
+        从代理服务器获取代理，补充到注册表，总数不超过 maxsize * 5
+        :return:
+        """
+        self._last_reload = time.time()
+        for proxy_type, host, port in proxy.get_proxy(self.proxy_url) or []:
+            if len(self.registry) >= self.maxsize * 5:
+                break
+            self.registry.add(proxy_type, "{}:{}".format(host, port))
+
+    def random_choice_proxy(self):
+        """
+        按得分加权随机选择一个可用代理，可用代理较少时重新加载代理
+        :return:
+        """
+        self._maybe_reload()
+        pid = self.registry.select()
+        if pid is None:
             return None, None
-        else:
-            proxy_host = "{}:{}".format(host, port)
-            return proxy_type, proxy_host
+        return self.registry.get(pid)
 
     def update_black_peoxies(self, host):
         """
-        保存所有不可用的代理或者下载超时的代理；每添加一个不可用代理，
-        则随机获取一个新的代理放到proxy_queue中
-        同时返回新获取的代理
+        保存所有不可用的代理或者下载超时的代理，同时返回新获取的代理
         :param host:
         :return:
         """
-        if host:
-            self.black_peoxies.add(host)
+        self.registry.ban(host)
         return self.random_choice_proxy()
 
     def init_proxy_queue(self):
         """
-        从代理服务器获取代理，初始化代理队列
+        从代理服务器获取代理，初始化代理注册表
+        :return:
+        """
+        self._reload()
+
+    def size(self):
+        return len(self.registry)
+
+    def put_proxy(self, proxy_item, elapsed=None):
+        """
+        归还代理，记录一次成功；达到最大连续使用次数的代理删除
+        :param proxy_item:
+        :param elapsed: 本次请求耗时
         :return:
         """
-        # 从代理服务器上获取代理
-        self.proxy_list = proxy.get_proxy(self.proxy_url)
-        if not self.proxy_list:
+        if proxy_item is None or proxy_item.pid is None:
             return
-        for _ in range(self.maxsize):
-            proxy_type, proxy_host = self.random_choice_proxy()
-            if all([proxy_host, proxy_type]):
-                proxy_item = ProxyItem(proxy_type, proxy_host, self.proxy_max_num)
-                self.put_proxy(proxy_item)
+        pid, proxy_item.pid = proxy_item.pid, None
+        self.registry.release(pid, True, elapsed)
+        if not proxy_item.is_valid():
+            log.logger.debug("proxy reached max reused num, discarding proxy: {}".format(proxy_item))
+            self.registry.remove(pid)
 
-    def put_proxy(self, proxy_item):
+    def report_failure(self, proxy_item, elapsed=None):
         """
-        将代理放入代理队列
+        归还下载失败的代理，记录一次失败；已归还的代理不重复记录；
+        连续失败次数过多或得分过低的代理从注册表删除
         :param proxy_item:
+        :param elapsed: 到失败为止的耗时
         :return:
         """
-        try:
-            self.proxy_queue.put(proxy_item, block=False)
-        except gevent.queue.Full:
-            log.logger.debug("proxy pool is full, discarding proxy: {}".format(proxy_item))
+        if proxy_item is None or proxy_item.pid is None:
+            return
+        pid, proxy_item.pid = proxy_item.pid, None
+        if self.registry.release(pid, False, elapsed):
+            log.logger.debug("proxy failed too many times, discarding proxy: {}".format(proxy_item))
+            metrics.incr("proxy.discarded")
+
+    def release_proxy(self, proxy_item):
+        """
+        归还代理，不记录成功或失败，用于被取消的请求
+        :param proxy_item:
+        :return:
+        """
+        if proxy_item is None or proxy_item.pid is None:
+            return
+        pid, proxy_item.pid = proxy_item.pid, None
+        self.registry.release(pid, None)
 
     def get_proxy(self):
         """
-        从代理对列中获取一个代理
-        判断该代理是否有效；如果有效，将该代理放回对列并返回该代理
+        借出一个代理，没有可用代理时返回 None
         :return:
         """
-        proxy_item = None
+        self._maybe_reload()
+        pid = self.registry.select()
+        if pid is None:
+            return None
+        self.registry.acquire(pid)
+        proxy_type, proxy_host = self.registry.get(pid)
+        proxy_item = ProxyItem(proxy_type, proxy_host, self.proxy_max_num, pid)
+        proxy_item.proxy_counter = self.registry.uses[pid] - 1
+        return proxy_item
+
+
+class DNSCache:
+    """
+    dns 缓存
+    同一 host 的并发解析只发起一次，域名不存在等确定的解析失败按 negative_ttl 缓存，超时等临时错误不缓存；
+    安装 dnspython 时使用 dns 记录的 ttl，否则（getaddrinfo 不返回 ttl）使用默认 ttl；
+    resolver 可替换为本地桩解析函数，返回 ip 列表或 (ip 列表, ttl)
+    """
+
+    def __init__(self, ttl=setting.DNS_CACHE_TTL, negative_ttl=setting.DNS_NEGATIVE_TTL,
+                 resolver=None, max_hosts=10000, prefetch_concurrency=20):
+        """
+
+        :param ttl: 解析结果没有 ttl 时使用的缓存时间(秒)
+        :param negative_ttl: 解析失败结果的缓存时间(秒)
+        :param resolver: 解析函数 func(host)，默认使用 dnspython（未安装时使用 gevent 的 getaddrinfo）
+        :param max_hosts: 最多缓存的 host 数目
+        :param prefetch_concurrency: 预解析最大并发数
+        """
+        self.ttl = ttl if ttl > 0 else 300
+        self.negative_ttl = negative_ttl if negative_ttl > 0 else 30
+        self.resolver = resolver or (self._dns_resolve if dns_resolver is not None else self._getaddrinfo)
+        self.max_hosts = max_hosts
+        # host -> (过期时间, ip 列表, 异常)
+        self._cache = OrderedDict()
+        # host -> AsyncResult，正在解析中的 host
+        self._pending = {}
+        self._prefetch_pool = gevent.pool.Pool(prefetch_concurrency)
+        self._original_create_connection = None
+
+    @staticmethod
+    def _getaddrinfo(host):
+        infos = gevent.socket.getaddrinfo(host, None, 0, socket.SOCK_STREAM)
+        ips = []
+        for info in infos:
+            ip = info[4][0]
+            if ip not in ips:
+                ips.append(ip)
+        return ips
+
+    @classmethod
+    def _dns_resolve(cls, host):
+        """
+        使用 dnspython 查询 A / AAAA 记录，返回 (ip 列表, 最小 ttl)；
+        查询失败时使用 getaddrinfo（如 /etc/hosts 中的 host）
+        :param host:
+        :return:
+        """
+        ips, ttl = [], None
+        for rdtype in ("A", "AAAA"):
+            try:
+                answer = dns_resolver.resolve(host, rdtype)
+            except dns.exception.DNSException:
+                continue
+            ips.extend(rdata.address for rdata in answer)
+            ttl = answer.rrset.ttl if ttl is None else min(ttl, answer.rrset.ttl)
+        if not ips:
+            return cls._getaddrinfo(host)
+        return ips, max(ttl or 0, 1)
+
+    @staticmethod
+    def _negative_cacheable(error):
+        """
+        域名不存在等确定的失败才缓存，超时和临时失败不缓存
+        :param error:
+        :return:
+        """
+        if isinstance(error, socket.gaierror):
+            return error.errno != socket.EAI_AGAIN
+        return isinstance(error, socket.herror)
+
+    def _store(self, host, ips, error, ttl):
+        self._cache[host] = (time.time() + ttl, ips, error)
+        self._cache.move_to_end(host)
+        while len(self._cache) > self.max_hosts:
+            self._cache.popitem(last=False)
+
+    def _lookup(self, host):
+        try:
+            result = self.resolver(host)
+        except (socket.gaierror, socket.herror, OSError) as e:
+            metrics.incr("dns.error")
+            if self._negative_cacheable(e):
+                self._store(host, None, e, self.negative_ttl)
+            raise
+        ttl = self.ttl
+        if isinstance(result, tuple):
+            result, ttl = result
+        ips = list(result or [])
+        if not ips:
+            e = socket.gaierror(socket.EAI_NONAME, "no address for {}".format(host))
+            self._store(host, None, e, self.negative_ttl)
+            raise e
+        self._store(host, ips, None, ttl)
+        return ips
+
+    def resolve(self, host):
+        """
+        返回 host 的 ip 列表，解析失败抛出 socket.gaierror
+        :param host:
+        :return:
+        """
+        entry = self._cache.get(host)
+        if entry is not None:
+            expire, ips, error = entry
+            if expire > time.time():
+                if error is not None:
+                    metrics.incr("dns.negative_hit")
+                    raise type(error)(*error.args)
+                metrics.incr("dns.hit")
+                return ips
+            self._cache.pop(host, None)
+
+        pending = self._pending.get(host)
+        if pending is not None:
+            metrics.incr("dns.hit")
+            return pending.get()
+
+        metrics.incr("dns.miss")
+        pending = gevent.event.AsyncResult()
+        self._pending[host] = pending
         try:
-            proxy_item = self.proxy_queue.get(False)
-        except gevent.queue.Empty as e:
-            proxy_type, proxy_host = self.random_choice_proxy()
-            return ProxyItem(proxy_type, proxy_host, self.proxy_max_num)
+            with profiler.tracer.phase("dns"):
+                ips = self._lookup(host)
+        except Exception as e:
+            pending.set_exception(e)
+            raise
         else:
-            if proxy_item.isvalid():
-                return proxy_item
-            else:
-                self.get_proxy()
+            pending.set(ips)
+            return ips
+        finally:
+            self._pending.pop(host, None)
+
+    def prefetch(self, hosts):
+        """
+        后台预解析未缓存的 host
+        :param hosts:
+        :return:
+        """
+        now = time.time()
+        for host in set(hosts):
+            if not host or host in self._pending or self._is_ip(host):
+                continue
+            entry = self._cache.get(host)
+            if entry is not None and entry[0] > now:
+                continue
+            # 预解析池已满时不等待，Pool.spawn 会阻塞调用方（frontier 入队）
+            if self._prefetch_pool.full():
+                metrics.incr("dns.prefetch_dropped")
+                break
+            metrics.incr("dns.prefetch")
+            self._prefetch_pool.spawn(self._prefetch_one, host)
+
+    def _prefetch_one(self, host):
+        try:
+            self.resolve(host)
+        except Exception:
+            pass
+
+    def frontier_listener(self, requests_list):
+        """
+        frontier 监听函数，请求入队时预解析其 host
+        :param requests_list:
+        :return:
+        """
+        self.prefetch(urlparse(frontier.request_url(r)).hostname for r in requests_list)
+
+    @staticmethod
+    def _is_ip(host):
+        try:
+            ipaddress.ip_address(host)
+        except ValueError:
+            return False
+        return True
+
+    def _create_connection(self, address, *args, **kwargs):
+        host, port = address[0], address[1]
+        if not host or self._is_ip(host.strip("[]")):
+            return self._original_create_connection(address, *args, **kwargs)
+        error = None
+        for ip in self.resolve(host):
+            try:
+                return self._original_create_connection((ip, port), *args, **kwargs)
+            except OSError as e:
+                error = e
+        raise error
+
+    def install(self):
+        """
+        替换 urllib3 建立连接时的 dns 解析，对进程内所有 requests session 生效，只应在 gevent 模式下安装；
+        Host 头和 TLS SNI 仍使用原始域名
+        :return:
+        """
+        if self._original_create_connection is None:
+            self._original_create_connection = urllib3_connection.create_connection
+            urllib3_connection.create_connection = self._create_connection
+
+    def uninstall(self):
+        if self._original_create_connection is not None:
+            urllib3_connection.create_connection = self._original_create_connection
+            self._original_create_connection = None
+
+    def stats(self):
+        data = metrics.snapshot("dns.")
+        data["dns.cached_hosts"] = len(self._cache)
+        return data
+
+
+_dns_cache = None
+
+
+def get_dns_cache():
+    """
+    返回进程内共享的 dns 缓存，首次调用时安装
+    :return:
+    """
+    global _dns_cache
+    if _dns_cache is None:
+        _dns_cache = DNSCache()
+        _dns_cache.install()
+    return _dns_cache
+
+
+class LatencyTracker:
+    """
+    按 host 统计最近的下载耗时，用于估计 p95
+    """
+
+    def __init__(self, window=100, min_samples=20, max_hosts=10000):
+        """
+
+        :param window: 每个 host 保留的样本数
+        :param min_samples: 样本数少于该值时不给出估计
+        :param max_hosts: 最多记录的 host 数目
+        """
+        self.window = window
+        self.min_samples = min_samples
+        self.max_hosts = max_hosts
+        # host -> [样本, 缓存的 p95, 上次计算后新增样本数]
+        self._hosts = OrderedDict()
+
+    def record(self, host, elapsed):
+        entry = self._hosts.get(host)
+        if entry is None:
+            entry = [deque(maxlen=self.window), None, 0]
+            self._hosts[host] = entry
+            while len(self._hosts) > self.max_hosts:
+                self._hosts.popitem(last=False)
+        entry[0].append(elapsed)
+        entry[2] += 1
+
+    def percentile(self, host, q=0.95):
+        """
+        返回该 host 耗时的 q 分位数，样本不足时返回 None；
+        每新增 min_samples 个样本重新计算一次
+        :param host:
+        :param q:
+        :return:
+        """
+        entry = self._hosts.get(host)
+        if entry is None or len(entry[0]) < self.min_samples:
+            return None
+        if entry[1] is None or entry[2] >= self.min_samples:
+            samples = sorted(entry[0])
+            entry[1] = samples[min(len(samples) - 1, int(len(samples) * q))]
+            entry[2] = 0
+        return entry[1]
+
+
+class HedgeBudget:
+    """
+    对冲请求全局预算
+    每个请求增加 ratio 个令牌，每次对冲消耗一个令牌，令牌数不超过 burst
+    """
+
+    def __init__(self, ratio=setting.HEDGE_RATIO, burst=10):
+        self.ratio = ratio if 0 < ratio <= 1 else 0.05
+        self.burst = burst
+        self.tokens = 0.0
+
+    def on_request(self):
+        self.tokens = min(self.burst, self.tokens + self.ratio)
+
+    def acquire(self):
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        metrics.incr("hedge.budget_exhausted")
+        return False
 
 
 class Downloader:
@@ -206,7 +593,11 @@ class Downloader:
 
     def __init__(self, proxy_enable=setting.PROXY_ENABLE, proxy_max_num=setting.PROXY_MAX_NUM,
                  available_proxy=setting.PAROXY_AVAILABLE, proxy_url=setting.PAROXY_URL,
-                 cookeis_enable=setting.COOKIES_ENABLE, timeout=setting.HTTP_TIMEOUT, **kwargs):
+                 cookeis_enable=setting.COOKIES_ENABLE, timeout=setting.HTTP_TIMEOUT,
+                 http_cache_enable=setting.HTTP_CACHE_ENABLE, dns_cache_enable=setting.DNS_CACHE_ENABLE,
+                 http2_enable=setting.HTTP2_ENABLE, hedge_enable=setting.HEDGE_ENABLE,
+                 breaker_enable=setting.BREAKER_ENABLE, single_flight=setting.SINGLE_FLIGHT_ENABLE,
+                 archive_enable=setting.ARCHIVE_ENABLE, replay_mode=setting.REPLAY_MODE, **kwargs):
         self.cookies_enable = cookeis_enable
         self.proxy_enable = proxy_enable
         self.headers = {
@@ -215,7 +606,12 @@ class Downloader:
         }
         self.proxy_url = proxy_url
         if self.proxy_enable:
-            self.proxy_manager = ProxyManager(proxy_max_num, available_proxy, proxy_url)
+            if setting.PROXY_POOL_SOCKET:
+                # 多进程共享代理池
+                self.proxy_manager = proxypool.ProxyPoolClient(setting.PROXY_POOL_SOCKET, proxy_max_num,
+                                                               available_proxy, proxy_url)
+            else:
+                self.proxy_manager = ProxyManager(proxy_max_num, available_proxy, proxy_url)
         if timeout > 120 or timeout <= 0:
             self.timeout = 30
         else:
@@ -227,6 +623,13 @@ class Downloader:
                                           max_retries=0)
         self.session.mount("http://", a)
         self.session.mount("https://", a)
+
+        # cookie 按 host 或任务分片保存，session 自身不保存 cookie
+        self.cookie_pool = None
+        self.sticky_proxy = setting.COOKIE_STICKY_PROXY
+        if self.cookies_enable:
+            self.cookie_pool = cookiepool.CookieJarPool()
+            self.session.cookies.set_policy(cookiepool.BlockAllCookiePolicy())
         self.config_id = ''
         # requests模块支持的参数列表
         self.requests_module_kwargs = ["params", "data", "json", "headers", "cookies",
@@ -235,31 +638,190 @@ class Downloader:
 
         self.keep_status_code = False
 
+        # 正在进行的下载数目，退出时等待其归零
+        self.in_flight = 0
+
+        # 原始响应归档
+        self.archive = archive.ArchiveWriter() if archive_enable else None
+
+        # 录制 / 回放
+        self.recorder = replay.Recorder() if replay_mode == "record" else None
+        self.replayer = replay.Replayer() if replay_mode == "replay" else None
+
+        # 相同请求合并，只在 gevent 模式下有效：请求 key -> AsyncResult
+        self.single_flight = single_flight and setting.CRAWLER_MODE == "gevent"
+        self._flights = {}
+
+        # 条件请求缓存
+        self.http_cache = None
+        if http_cache_enable:
+            self.http_cache = httpcache.HttpCache(setting.HTTP_CACHE_DIR, setting.HTTP_CACHE_MAX_SIZE)
+
+        # 响应编码识别
+        self.encoding_resolver = encoding.EncodingResolver()
+
+        # dns 缓存，进程内所有下载器共享；替换的是 urllib3 全局的建立连接函数，
+        # 并使用 gevent 的等待原语，只在 gevent 模式下启用
+        self.dns_cache = get_dns_cache() if dns_cache_enable and setting.CRAWLER_MODE == "gevent" else None
+
+        # http/2 通道，httpx 未安装时不启用
+        self.http2 = None
+        if http2_enable:
+            self.http2 = h2transport.Http2Transport()
+            if not self.http2.available:
+                log.logger.warning("未安装 httpx[http2], 不启用 http/2")
+                self.http2 = None
+
+        # 对冲请求，只在 gevent 模式下有效
+        self.hedge_enable = hedge_enable and setting.CRAWLER_MODE == "gevent"
+        self.latency = LatencyTracker()
+        self.hedge_budget = HedgeBudget()
+
+        # 熔断器
+        self.host_breakers = None
+        self.proxy_breakers = None
+        if breaker_enable:
+            self.host_breakers = breaker.BreakerRegistry("host", setting.HOST_BREAKER_THRESHOLD,
+                                                         setting.BREAKER_COOL_DOWN)
+            self.proxy_breakers = breaker.BreakerRegistry("proxy", setting.PROXY_BREAKER_THRESHOLD,
+                                                          setting.BREAKER_COOL_DOWN)
+        # 推迟监听函数 func(请求, 建议的重试等待秒数)，host 熔断中、请求没有发出时调用
+        self.deferred_listeners = []
+
+    def add_deferred_listener(self, func):
+        self.deferred_listeners.append(func)
+
+    def retry_after(self, url):
+        """
+        url 所在 host 熔断中时返回距离下次可以请求的秒数，否则返回 0
+        :param url:
+        :return:
+        """
+        if self.host_breakers is None or not url:
+            return 0
+        return self.host_breakers.retry_after(urlparse(url).hostname)
+
+    def _config_id(self, request):
+        """
+        请求所属的任务配置：多个任务共用下载器时使用请求 meta 中的 config_id，否则使用下载器的 config_id
+        :param request:
+        :return:
+        """
+        if isinstance(request, dict):
+            config_id = (request.get("meta") or {}).get("config_id")
+            if config_id:
+                return config_id
+        return self.config_id
+
     def init_proxy_success(self):
         """
         返回初始化代理结果，成功返回True，失败返回False
         :return:
         """
         if self.proxy_enable:
-            if self.proxy_manager.proxy_queue.qsize() > 0:
+            if self.proxy_manager.size() > 0:
                 return True
         return False
 
+    def _choose_proxy(self, max_tries=5):
+        """
+        从代理管理器获取代理，跳过熔断中的代理；
+        跳过的代理在选择结束后归还（不记录结果，请求没有发出），选择过程中不会再次取到
+        :param max_tries:
+        :return: 代理，没有代理或取到的代理都在熔断中时返回 None（不使用代理）
+        """
+        chosen, skipped = None, []
+        for _ in range(max_tries):
+            proxy_item = self.proxy_manager.get_proxy()
+            if proxy_item is None:
+                break
+            if self.proxy_breakers is None or self.proxy_breakers.allow(proxy_item.host):
+                chosen = proxy_item
+                break
+            skipped.append(proxy_item)
+            metrics.incr("breaker.proxy.rerouted")
+        for proxy_item in skipped:
+            self.proxy_manager.release_proxy(proxy_item)
+        if chosen is None and skipped:
+            metrics.incr("breaker.proxy.exhausted")
+        return chosen
+
+    def _breaker_record(self, host, proxy_item, error=None):
+        """
+        记录下载结果：网络错误计入 host 和代理，5xx/429 计入 host，其它错误返回码计入代理
+        :param host:
+        :param proxy_item:
+        :param error:
+        :return:
+        """
+        if self.host_breakers is None:
+            return
+        proxy_host = proxy_item.host if proxy_item is not None else None
+        if error is None:
+            self.host_breakers.success(host)
+            self.proxy_breakers.success(proxy_host)
+            return
+        if isinstance(error, breaker.CircuitOpenError):
+            return
+        response = getattr(error, "response", None)
+        status_code = getattr(response, "status_code", None)
+        if status_code is None:
+            self.host_breakers.failure(host)
+            self.proxy_breakers.failure(proxy_host)
+        elif status_code >= 500 or status_code == 429:
+            self.host_breakers.failure(host)
+        else:
+            self.proxy_breakers.failure(proxy_host)
+
+    def breaker_snapshot(self):
+        """
+        返回熔断中的 host 和代理
+        :return:
+        """
+        if self.host_breakers is None:
+            return {}
+        return {"host": self.host_breakers.snapshot(), "proxy": self.proxy_breakers.snapshot()}
+
     @retry(Exception)
-    def _download(self, request, **kwargs):
+    def _download(self, request, keep_open=False, **kwargs):
         """
 
         :param request: 请求字典或请求url
+        :param keep_open: 不读取响应内容，保持连接，由调用方按块读取 response.raw 后关闭
         :param kwargs:
         :return:
         """
         request = copy.deepcopy(request)
         url = request.get("url") if isinstance(request, dict) else request
         response = None
+        host = urlparse(url).hostname
+
+        if self.host_breakers is not None and not self.host_breakers.allow(host):
+            retry_after = self.host_breakers.retry_after(host)
+            raise breaker.CircuitOpenError("host 熔断中 {}, {:.0f} 秒后重试".format(host, retry_after),
+                                           retry_after=retry_after)
+
+        cookie_key, jar, sticky = None, None, False
+        if self.cookie_pool is not None:
+            cookie_key = self.cookie_pool.key_for(host, request)
+            jar = self.cookie_pool.get(cookie_key)
+            sticky = self.sticky_proxy
+            if isinstance(request, dict):
+                sticky = (request.get("meta") or {}).get("sticky_proxy", sticky)
+
+        proxy_item = None
+        sticky_type, sticky_host = self.cookie_pool.sticky_proxy(cookie_key) if sticky else (None, None)
+        if self.proxy_enable and sticky_host and \
+                (self.proxy_breakers is None or self.proxy_breakers.allow(sticky_host)):
+            # 使用 cookie jar 绑定的代理，不经过代理管理器
+            proxy_item = ProxyItem(sticky_type, sticky_host)
+        elif self.proxy_enable:
+            sticky_host = None
+            with profiler.tracer.phase("proxy"):
+                proxy_item = self._choose_proxy()
 
         if self.proxy_enable:
-            proxy_item = self.proxy_manager.get_proxy()
-            proxy_type, proxy_host = proxy_item.get_proxy()
+            proxy_type, proxy_host = proxy_item.get_proxy() if proxy_item is not None else (None, None)
             if proxy_host is not None:
                 proxy = "{}://{}".format(proxy_type, proxy_host)
                 proxies = {proxy_type: proxy}
@@ -270,6 +832,10 @@ class Downloader:
 
         # 异常是否在本函数中发生， 标志位置
         is_exc = 0
+        # 是否被取消（对冲下载中落后的请求）
+        cancelled = False
+        # 请求发出的时间，失败时计入代理耗时
+        start = None
 
         try:
             timeout = gevent.Timeout(self.timeout + 1)
@@ -299,50 +865,247 @@ class Downloader:
 
                     kwargs.update(request)
 
-                    for key in kwargs.keys():
+                    for key in list(kwargs.keys()):
                         if key not in self.requests_module_kwargs:
                             kwargs.pop(key)
-                r = self.session.request(default_method, url, **kwargs)
+                if jar is not None and not kwargs.get("cookies"):
+                    kwargs["cookies"] = jar
+                start = time.time()
+                r = None
+                # stream 模式下 send 阶段到收到响应头为止
+                with profiler.tracer.phase("send"):
+                    # http/2 通道读取完整响应，没有 raw，流式下载不使用
+                    if self.http2 is not None and not keep_open and self.http2.supports(url, kwargs):
+                        r = self.http2.request(default_method, url, **kwargs)
+                    if r is None:
+                        r = self.session.request(default_method, url, **kwargs)
                 response = r
 
-                if r.status_code not in (200, 404, 410):
-                    log.logger.warning("调试信息 下载返回码 {} 请注意 url:{}".format(util.BB(r.status_code), url))
-                    if not keep_status_code:
+                if r.status_code not in (200, 304):
+                    hotlog.hot_logger.warning("status", host,
+                                              "调试信息 下载返回码 {} 请注意 url:{}", r.status_code, url,
+                                              url=url, status_code=r.status_code, config_id=self._config_id(request))
+                    if r.status_code not in (404, 410) and not keep_status_code:
                         r.raise_for_status()
-                elif r.status_code in (404, 410):
-                    log.logger.warning("调试信息 下载返回码 {} 请注意 url:{}".format(util.BB(r.status_code), url))
 
+                self._breaker_record(host, proxy_item)
+                if jar is not None:
+                    self.cookie_pool.extract(jar, r)
+                    if sticky and proxy_item is not None:
+                        self.cookie_pool.bind_proxy(cookie_key, proxy_item.proxy_type, proxy_item.host)
+                        sticky_host = None
                 # 保存当前代理
                 if self.proxy_enable:
-                    self.proxy_manager.put_proxy(proxy_item)
+                    self.proxy_manager.put_proxy(proxy_item, time.time() - start)
                 try:
                     response.proxies = kwargs.get("proxies")
                 except Exception as e:
                     log.logger.error("response 对象增加代理属性失败 {}".format(e))
             except requests.exceptions.Timeout as e:
                 is_exc = 1
+                self._breaker_record(host, proxy_item, e)
                 raise e
             except requests.exceptions.RequestException as e:
                 is_exc = 1
+                self._breaker_record(host, proxy_item, e)
                 raise e
             except Exception as e:
                 is_exc = 1
+                self._breaker_record(host, proxy_item, e)
                 raise e
             else:
+                # 读取响应内容后再释放连接，否则 stream 模式下关闭后无法再读取
+                if keep_open:
+                    return response
+                with profiler.tracer.phase("body"):
+                    response.content
                 response.close()
         except gevent.Timeout as e:
             is_exc = 1
+            self._breaker_record(host, proxy_item, e)
             raise requests.exceptions.Timeout
         except requests.exceptions.RequestException as e:
             is_exc = 1
             raise e
+        except gevent.GreenletExit:
+            # 对冲下载中落后的请求被取消，不是代理的问题
+            cancelled = True
+            raise
         finally:
             timeout.cancel()
+            if proxy_item is not None:
+                if cancelled:
+                    # 被取消时只归还代理，不记录结果
+                    self.proxy_manager.release_proxy(proxy_item)
+                else:
+                    # 下载失败时归还代理并记录失败
+                    self.proxy_manager.report_failure(
+                        proxy_item, time.time() - start if start is not None else None)
+            # 绑定的代理下载失败，下次重新选择代理
+            if sticky_host and not cancelled:
+                self.cookie_pool.unbind_proxy(cookie_key)
 
         return response
 
+    def _hedged_download(self, requset, host, **kwargs):
+        """
+        对冲下载：超过该 host 的 p95 耗时仍未返回时，再发起一次下载，取先成功的结果；
+        第一次下载占用的代理尚未放回代理队列，第二次下载会从代理队列中取到不同的代理
+        :param requset:
+        :param host:
+        :param kwargs:
+        :return:
+        """
+        self.hedge_budget.on_request()
+        delay = self.latency.percentile(host)
+        primary = gevent.spawn(self._download, requset, **kwargs)
+        if delay is None:
+            return primary.get()
+        primary.join(timeout=max(delay, 0.05))
+        if primary.ready() or not self.hedge_budget.acquire():
+            return primary.get()
+
+        metrics.incr("hedge.fired")
+        hedge = gevent.spawn(self._download, requset, **kwargs)
+        pending = [primary, hedge]
+        while True:
+            g = gevent.wait(pending, count=1)[0]
+            pending.remove(g)
+            if g.successful() or not pending:
+                break
+        # 取消未完成的请求
+        gevent.killall(pending, block=False)
+        if g is hedge and g.successful():
+            metrics.incr("hedge.won")
+        return g.get()
+
+    @staticmethod
+    def _request_parts(requset, kwargs):
+        """
+        返回请求的 (method, 完整 url, body md5, cookie_key)；完整 url 包含 params，
+        上传文件的请求或 url 无效时返回 None
+        :param requset:
+        :param kwargs:
+        :return:
+        """
+        request = dict(kwargs, **requset) if isinstance(requset, dict) else dict(kwargs, url=requset)
+        if request.get("files") or not request.get("url"):
+            return None
+        try:
+            prepared = requests.PreparedRequest()
+            prepared.prepare_url(request["url"], request.get("params"))
+        except requests.exceptions.RequestException:
+            return None
+        body = request.get("data")
+        if body is None and request.get("json") is not None:
+            body = request.get("json")
+        if body is None:
+            body_hash = ""
+        else:
+            if not isinstance(body, (bytes, str)):
+                body = json.dumps(body, sort_keys=True, default=str)
+            if isinstance(body, str):
+                body = body.encode("utf-8")
+            body_hash = hashlib.md5(body).hexdigest()
+        method = (request.get("method") or ("POST" if body_hash else "GET")).upper()
+        cookie_key = (request.get("meta") or {}).get("cookie_key")
+        return method, prepared.url, body_hash, cookie_key
+
+    @classmethod
+    def _flight_key(cls, requset, kwargs):
+        """
+        请求合并的 key：(method, 规范化 url, body md5, cookie_key)；上传文件的请求不合并，返回 None
+        :param requset:
+        :param kwargs:
+        :return:
+        """
+        parts = cls._request_parts(requset, kwargs)
+        if parts is None:
+            return None
+        method, url, body_hash, cookie_key = parts
+        return method, frontier.canonical_url(url), body_hash, cookie_key
+
+    @classmethod
+    def _replay_key(cls, requset, kwargs):
+        """
+        录制 / 回放的 key：(method, 完整 url, body md5)，url 不做规范化，与实际发送的请求一致
+        :param requset:
+        :param kwargs:
+        :return:
+        """
+        parts = cls._request_parts(requset, kwargs)
+        return parts[:3] if parts is not None else None
+
     def download(self, requset, **kwargs):
         """
+        下载；并发的相同请求只下载一次，所有调用方得到同一个响应对象
+        :param requset:
+        :param kwargs:
+        :return: 响应，下载失败返回 None；
+                 host 熔断中时也返回 None，并调用 add_deferred_listener 注册的监听函数，
+                 调用方也可以用 retry_after(url) 判断是否应推迟该请求而不是当作失败
+        """
+        if self.replayer is not None:
+            response = self.replayer.replay(self._replay_key(requset, kwargs))
+            if response is not None:
+                url = requset.get("url") if isinstance(requset, dict) else requset
+                self.encoding_resolver.apply(response, urlparse(url).hostname)
+            return response
+        key = self._flight_key(requset, kwargs) if self.single_flight else None
+        if key is None:
+            return self._record_fetch(requset, **kwargs)
+
+        pending = self._flights.get(key)
+        if pending is not None:
+            metrics.incr("singleflight.shared")
+            return pending.get()
+
+        metrics.incr("singleflight.leader")
+        pending = gevent.event.AsyncResult()
+        self._flights[key] = pending
+        response = None
+        try:
+            response = self._record_fetch(requset, **kwargs)
+        finally:
+            # 下载被取消时等待的调用方得到 None
+            self._flights.pop(key, None)
+            pending.set(response)
+        return response
+
+    def open_stream(self, requset, **kwargs):
+        """
+        流式下载，与 download 一样经过代理、熔断和 cookie jar，但不读取响应内容，
+        也不经过缓存、归档、录制和请求合并；调用方按块读取 response.raw 后需要调用 response.close()
+        :param requset:
+        :param kwargs:
+        :return: 响应，下载失败时抛出异常，host 熔断中时抛出 breaker.CircuitOpenError
+        """
+        kwargs.update(headers=dict(self.headers, **kwargs.get("headers", {})))
+        self.in_flight += 1
+        try:
+            return self._download(requset, keep_open=True, **kwargs)
+        finally:
+            self.in_flight -= 1
+
+    def _record_fetch(self, requset, **kwargs):
+        """
+        下载，录制模式下录制下载结果
+        :param requset:
+        :param kwargs:
+        :return:
+        """
+        key = self._replay_key(requset, kwargs) if self.recorder is not None else None
+        start = time.time()
+        response = self._fetch(requset, **kwargs)
+        if key is not None and response is not None:
+            try:
+                self.recorder.record(key, response, time.time() - start)
+            except Exception as e:
+                log.logger.warning("录制失败 {} {}".format(key[1], e))
+        return response
+
+    def _fetch(self, requset, **kwargs):
+        """
 
         :param requset:
         :param kwargs:
@@ -352,8 +1115,41 @@ class Downloader:
         self.headers.update(headers)
         kwargs.update(headers=self.headers)
         response = None
+
+        # 只缓存没有请求体的 GET 请求，以包含 params 的完整 url 作为缓存 key
+        cache_url, cache_entry = None, None
+        if self.http_cache is not None:
+            parts = self._request_parts(requset, kwargs)
+            if parts is not None and parts[0] == "GET" and not parts[2]:
+                cache_url = parts[1]
+        if cache_url:
+            conditional_headers, cache_entry = self.http_cache.conditional_headers(cache_url)
+            if conditional_headers:
+                kwargs.update(headers=dict(self.headers, **conditional_headers))
+                if isinstance(requset, dict) and "headers" in requset:
+                    requset = dict(requset, headers=dict(requset["headers"], **conditional_headers))
+
+        url = requset.get("url") if isinstance(requset, dict) else requset
+        host = urlparse(url).hostname
+        trace = profiler.tracer.begin(url)
+        start = time.time()
+        self.in_flight += 1
         try:
-            response = self._download(requset, **kwargs)
+            if self.hedge_enable:
+                response = self._hedged_download(requset, host, **kwargs)
+            else:
+                response = self._download(requset, **kwargs)
+            self.latency.record(host, time.time() - start)
+        except breaker.CircuitOpenError as e:
+            # 熔断中的请求没有发出，返回 None，通知监听函数推迟该请求
+            metrics.incr("breaker.host.deferred")
+            profiler.tracer.finish(trace, None)
+            for func in self.deferred_listeners:
+                try:
+                    func(requset, e.retry_after)
+                except Exception as ex:
+                    log.logger.warning("推迟请求监听函数异常 {}".format(ex))
+            return None
         except gevent.Timeout as e:
             pass
         except requests.exceptions.Timeout as e:
@@ -362,5 +1158,28 @@ class Downloader:
             pass
         except Exception as e:
             pass
+        finally:
+            self.in_flight -= 1
+
+        if cache_url and response is not None:
+            if response.status_code == 304 and cache_entry is not None:
+                response = self.http_cache.apply(response, cache_entry)
+            elif response.status_code == 200:
+                self.http_cache.set(cache_url, response)
+
+        if response is not None:
+            self.encoding_resolver.apply(response, host)
+
+        # 只归档从网络下载的成功响应
+        if self.archive is not None and response is not None and response.status_code == 200 \
+                and not getattr(response, "from_cache", False):
+            try:
+                self.archive.write_response(response)
+            except Exception as e:
+                log.logger.warning("写入归档失败 {} {}".format(url, e))
 
+        status_code = response.status_code if response is not None else None
+        crawlstats.aggregator.record(self._config_id(requset), host, status_code or 0, time.time() - start,
+                                     len(response.content or b"") if response is not None else 0)
+        profiler.tracer.finish(trace, status_code)
         return response
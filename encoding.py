@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+# @Project Name : spider
+"""
+文件名：encoding.py
+功能：响应编码识别；
+　　　按以下顺序确定编码，命中即返回：
+　　　　　BOM
+      响应头 Content-Type 中的 charset
+      页面前几 KB 中的 <meta charset> 或 <?xml encoding>
+      该 host 上次统计识别的结果
+      统计识别，只在前几 KB 上进行（优先 cchardet，其次 chardet）
+      gb2312 / gbk 统一按超集 gb18030 解码
+"""
+
+import re
+import codecs
+from collections import OrderedDict
+
+try:
+    import cchardet as chardet
+except ImportError:
+    try:
+        import chardet
+    except ImportError:
+        chardet = None
+
+import setting
+
+HEADER_CHARSET_RE = re.compile(r'charset\s*=\s*["\']?\s*([\w.:-]+)', re.I)
+META_CHARSET_RE = re.compile(br'<meta[^>]+?charset\s*=\s*["\']?\s*([\w.:-]+)', re.I)
+XML_ENCODING_RE = re.compile(br'^\s*<\?xml[^>]+?encoding\s*=\s*["\']([\w.:-]+)', re.I)
+
+BOMS = (
+    (codecs.BOM_UTF8, "utf-8"),
+    (codecs.BOM_UTF32_LE, "utf-32-le"),
+    (codecs.BOM_UTF32_BE, "utf-32-be"),
+    (codecs.BOM_UTF16_LE, "utf-16-le"),
+    (codecs.BOM_UTF16_BE, "utf-16-be"),
+)
+
+# 页面声明的编码往往比实际使用的字符集小，按超集解码
+SUPERSETS = {
+    "gb2312": "gb18030",
+    "gbk": "gb18030",
+    "ascii": "utf-8",
+    "latin-1": "cp1252",
+    "iso8859-1": "cp1252",
+    "big5": "big5hkscs",
+}
+
+
+def normalize(name):
+    """
+    返回规范化的编码名称，不支持的编码返回 None
+    :param name:
+    :return:
+    """
+    if not name:
+        return None
+    if isinstance(name, bytes):
+        name = name.decode("ascii", "ignore")
+    try:
+        name = codecs.lookup(name.strip().lower()).name
+    except LookupError:
+        return None
+    return SUPERSETS.get(name, name)
+
+
+class EncodingResolver:
+    """
+    编码识别器
+    """
+
+    def __init__(self, sniff_size=4096, default=setting.DATA_ENCODING, max_hosts=10000):
+        """
+
+        :param sniff_size: 用于 meta 探测和统计识别的字节数
+        :param default: 纯 ascii 页面使用的编码
+        :param max_hosts: 最多缓存的 host 数目
+        """
+        self.sniff_size = sniff_size
+        self.default = normalize(default) or "utf-8"
+        self.max_hosts = max_hosts
+        self._hosts = OrderedDict()
+        # 各识别方式命中次数
+        self.stats = {"bom": 0, "header": 0, "meta": 0, "host": 0, "detect": 0}
+
+    def _remember(self, host, encoding):
+        if not host:
+            return
+        self._hosts[host] = encoding
+        self._hosts.move_to_end(host)
+        while len(self._hosts) > self.max_hosts:
+            self._hosts.popitem(last=False)
+
+    def _detect(self, sample):
+        """
+        统计识别；能按 utf-8 解码的直接返回 utf-8
+        :param sample: memoryview
+        :return: (编码, 是否可以作为该 host 的识别结果缓存)，纯 ascii 样本不缓存
+        """
+        try:
+            # final=False 允许样本末尾截断的多字节字符
+            text = codecs.getincrementaldecoder("utf-8")().decode(sample, False)
+        except UnicodeDecodeError:
+            pass
+        else:
+            if text.isascii():
+                return self.default, False
+            return "utf-8", True
+
+        if chardet is not None:
+            result = chardet.detect(bytes(sample))
+            encoding = normalize(result.get("encoding"))
+            if encoding:
+                return encoding, True
+        return "gb18030", True
+
+    def resolve(self, body, content_type=None, host=None):
+        """
+        识别编码
+        :param body: 响应内容 bytes
+        :param content_type: 响应头 Content-Type
+        :param host:
+        :return: (编码, 识别方式)
+        """
+        sample = memoryview(body or b"")[:self.sniff_size]
+
+        for bom, encoding in BOMS:
+            if sample[:len(bom)] == bom:
+                self.stats["bom"] += 1
+                return encoding, "bom"
+
+        if content_type:
+            mo = HEADER_CHARSET_RE.search(content_type)
+            encoding = normalize(mo.group(1)) if mo else None
+            if encoding:
+                self.stats["header"] += 1
+                return encoding, "header"
+
+        mo = XML_ENCODING_RE.search(sample) or META_CHARSET_RE.search(sample)
+        encoding = normalize(mo.group(1)) if mo else None
+        if encoding:
+            self.stats["meta"] += 1
+            return encoding, "meta"
+
+        encoding = self._hosts.get(host) if host else None
+        if encoding:
+            self._hosts.move_to_end(host)
+            self.stats["host"] += 1
+            return encoding, "host"
+
+        encoding, decisive = self._detect(sample)
+        if decisive:
+            self._remember(host, encoding)
+        self.stats["detect"] += 1
+        return encoding, "detect"
+
+    def apply(self, response, host=None):
+        """
+        设置 response.encoding，response.text 只按该编码解码一次，
+        不再触发 requests 对整个页面的 apparent_encoding 识别
+        :param response:
+        :param host:
+        :return: 编码
+        """
+        encoding, _ = self.resolve(response.content, response.headers.get("Content-Type"), host)
+        response.encoding = encoding
+        return encoding
+
+    @staticmethod
+    def decode(body, encoding):
+        return str(body, encoding, "replace")
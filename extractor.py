@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+# @Project Name : spider
+"""
+文件名：extractor.py
+功能：根据任务配置抽取页面数据；
+　　　目前实现的功能有：
+　　　　　按 config_id 缓存编译后的 xpath / css / 正则规则
+      使用 lxml 解析页面
+      批量处理响应，按列返回抽取结果
+
+任务配置中的字段规则格式:
+    {
+        "config_id": "123",
+        "fields": {
+            "title": {"xpath": "//h1/text()"},
+            "author": {"css": "div.author", "regex": "作者[:：](\\S+)"},
+            "images": {"xpath": "//img/@src", "multi": True},
+            "pub_time": {"regex": "(\\d{4}-\\d{2}-\\d{2})"},
+        }
+    }
+xpath 或 css 先选出节点/字符串，regex 再在其结果上匹配；只有 regex 时在整个页面源码上匹配
+字段名不能使用 url（结果中已有 url 列）
+"""
+
+import re
+import json
+import hashlib
+from collections import OrderedDict
+
+from lxml import etree
+
+try:
+    from cssselect import GenericTranslator
+except ImportError:
+    GenericTranslator = None
+
+import log
+
+# 抽取结果中内置的列，不能作为字段名
+RESERVED_FIELDS = ("url",)
+
+
+class FieldRule:
+    """
+    编译后的单个字段规则
+    """
+
+    __slots__ = ("name", "xpath", "regex", "multi")
+
+    def __init__(self, name, rule):
+        """
+
+        :param name: 字段名
+        :param rule: 字段规则字典或 xpath 字符串
+        """
+        if isinstance(rule, str):
+            rule = {"xpath": rule}
+        self.name = name
+        self.multi = bool(rule.get("multi", False))
+        self.xpath = None
+        self.regex = None
+
+        if rule.get("xpath"):
+            self.xpath = etree.XPath(rule["xpath"])
+        elif rule.get("css"):
+            if GenericTranslator is None:
+                raise ValueError("css 规则需要安装 cssselect: {}".format(name))
+            self.xpath = etree.XPath(GenericTranslator().css_to_xpath(rule["css"]))
+        if rule.get("regex"):
+            self.regex = re.compile(rule["regex"], re.S)
+
+    def _match(self, value):
+        mo = self.regex.search(value)
+        if mo is None:
+            return None
+        return mo.group(1) if mo.groups() else mo.group(0)
+
+    def extract(self, tree, text):
+        """
+
+        :param tree: lxml 页面树
+        :param text: 页面源码，只有正则规则时使用
+        :return:
+        """
+        if self.xpath is not None:
+            if tree is None:
+                return [] if self.multi else None
+            values = []
+            for node in self.xpath(tree):
+                if isinstance(node, etree._Element):
+                    node = "".join(node.itertext())
+                node = str(node).strip()
+                if node:
+                    values.append(node)
+        elif self.regex is not None:
+            if self.multi:
+                return [mo.group(1) if mo.groups() else mo.group(0) for mo in self.regex.finditer(text)]
+            return self._match(text)
+        else:
+            values = []
+
+        if self.regex is not None:
+            values = [v for v in (self._match(v) for v in values) if v is not None]
+        if self.multi:
+            return values
+        return values[0] if values else None
+
+
+class CompiledConfig:
+    """
+    编译后的任务配置
+    """
+
+    def __init__(self, config_id, fields):
+        reserved = [name for name in fields if name in RESERVED_FIELDS]
+        if reserved:
+            raise ValueError("字段名与内置列冲突: {}".format(", ".join(reserved)))
+        self.config_id = config_id
+        self.rules = [FieldRule(name, rule) for name, rule in fields.items()]
+        self.field_names = [rule.name for rule in self.rules]
+        # 全部是正则规则时不需要解析 html
+        self.need_tree = any(rule.xpath is not None for rule in self.rules)
+        self.need_text = any(rule.xpath is None and rule.regex is not None for rule in self.rules)
+
+
+class Extractor:
+    """
+    数据抽取引擎
+    """
+
+    def __init__(self, max_configs=256):
+        """
+
+        :param max_configs: 最多缓存的编译配置数目
+        """
+        self.max_configs = max_configs if max_configs > 0 else 256
+        self._compiled = OrderedDict()
+        self._parsers = {}
+
+    @staticmethod
+    def _fingerprint(fields):
+        return hashlib.md5(json.dumps(fields, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def compile(self, config):
+        """
+        返回该任务配置的编译结果；同一 config_id 只有规则变化时才重新编译
+        :param config: 任务配置
+        :return:
+        """
+        config_id = str(config.get("config_id", ""))
+        fields = config.get("fields") or {}
+        key = (config_id, self._fingerprint(fields))
+        compiled = self._compiled.get(key)
+        if compiled is not None:
+            self._compiled.move_to_end(key)
+            return compiled
+
+        compiled = CompiledConfig(config_id, fields)
+        # 同一 config_id 的旧版本规则不再使用
+        for old_key in [k for k in self._compiled if k[0] == config_id]:
+            del self._compiled[old_key]
+        self._compiled[key] = compiled
+        while len(self._compiled) > self.max_configs:
+            self._compiled.popitem(last=False)
+        return compiled
+
+    def _get_parser(self, encoding):
+        parser = self._parsers.get(encoding)
+        if parser is None:
+            parser = etree.HTMLParser(encoding=encoding, remove_comments=True)
+            self._parsers[encoding] = parser
+        return parser
+
+    @staticmethod
+    def _unpack(response):
+        """
+        兼容 requests.Response 和 (url, body, encoding) 元组
+        :param response:
+        :return:
+        """
+        if isinstance(response, (tuple, list)):
+            url, body = response[0], response[1]
+            encoding = response[2] if len(response) > 2 else None
+        else:
+            url, body, encoding = response.url, response.content, response.encoding
+        return url, body or b"", encoding or "utf-8"
+
+    def _parse(self, body, encoding):
+        try:
+            return etree.fromstring(body, self._get_parser(encoding))
+        except (etree.XMLSyntaxError, ValueError, LookupError) as e:
+            log.logger.warning("页面解析失败 {}".format(e))
+            return None
+
+    def extract(self, config, responses):
+        """
+        批量抽取，按列返回结果
+        :param config: 任务配置
+        :param responses: 响应列表
+        :return: {"url": [...], 字段名: [...]}，每列长度等于响应数目
+        """
+        compiled = self.compile(config)
+        columns = OrderedDict((name, []) for name in ["url"] + compiled.field_names)
+        url_column = columns["url"]
+        field_columns = [columns[name] for name in compiled.field_names]
+
+        for response in responses:
+            url, body, encoding = self._unpack(response)
+            tree = self._parse(body, encoding) if compiled.need_tree else None
+            text = None
+            if compiled.need_text:
+                text = body.decode(encoding, "replace") if isinstance(body, bytes) else body
+            url_column.append(url)
+            for rule, column in zip(compiled.rules, field_columns):
+                try:
+                    column.append(rule.extract(tree, text))
+                except Exception as e:
+                    log.logger.warning("字段抽取失败 {} {}".format(rule.name, e))
+                    column.append([] if rule.multi else None)
+        return columns
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+# @Project Name : spider
+"""
+文件名：frontier.py
+功能：待抓取详情页队列；
+　　　列表页解析出的详情页请求经过过滤函数后进入队列，
+      入队后通知监听函数（如 dns 预解析）
+"""
+
+from urllib.parse import urlsplit, urlunsplit
+
+import gevent.queue
+
+import log
+
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+def request_url(request):
+    """
+    返回请求的 url，请求可以是 url 字符串或请求字典
+    :param request:
+    :return:
+    """
+    return request.get("url") if isinstance(request, dict) else request
+
+
+def canonical_url(url):
+    """
+    规范化 url：scheme 和 host 小写，去掉默认端口和 fragment，查询参数排序
+    查询参数按原样（不解码百分号编码）排序，GBK 等非 UTF-8 编码的参数不会被合并
+    :param url:
+    :return:
+    """
+    try:
+        parts = urlsplit(url.strip())
+        scheme = parts.scheme.lower()
+        netloc = (parts.hostname or "").lower()
+        if parts.port and parts.port != DEFAULT_PORTS.get(scheme):
+            netloc = "{}:{}".format(netloc, parts.port)
+        if parts.username:
+            netloc = "{}@{}".format(parts.username if parts.password is None else
+                                    "{}:{}".format(parts.username, parts.password), netloc)
+    except ValueError:
+        return url
+    query = "&".join(sorted(pair for pair in parts.query.split("&") if pair))
+    return urlunsplit((scheme, netloc, parts.path or "/", query, ""))
+
+
+class Frontier:
+    """
+    详情页请求队列
+    """
+
+    def __init__(self, maxsize=None):
+        """
+
+        :param maxsize: 队列最大长度，None 表示不限制
+        """
+        self.queue = gevent.queue.Queue(maxsize=maxsize)
+        # 过滤函数 func(request) -> bool，返回 False 的请求不入队
+        self.filters = []
+        # 监听函数 func(requests)，请求入队后调用
+        self.listeners = []
+
+    def add_filter(self, func):
+        self.filters.append(func)
+
+    def add_listener(self, func):
+        self.listeners.append(func)
+
+    def _accept(self, request):
+        for func in self.filters:
+            try:
+                if not func(request):
+                    return False
+            except Exception as e:
+                log.logger.warning("frontier 过滤函数异常 {} {}".format(request_url(request), e))
+        return True
+
+    def push_many(self, requests):
+        """
+        批量入队
+        :param requests:
+        :return: 实际入队的请求列表
+        """
+        accepted = [request for request in requests if self._accept(request)]
+        for request in accepted:
+            self.queue.put(request)
+        if accepted:
+            for func in self.listeners:
+                try:
+                    func(accepted)
+                except Exception as e:
+                    log.logger.warning("frontier 监听函数异常 {}".format(e))
+        return accepted
+
+    def push(self, request):
+        return bool(self.push_many([request]))
+
+    def pop(self, block=True, timeout=None):
+        """
+        出队，没有请求时返回 None
+        :param block:
+        :param timeout:
+        :return:
+        """
+        try:
+            return self.queue.get(block=block, timeout=timeout)
+        except gevent.queue.Empty:
+            return None
+
+    def qsize(self):
+        return self.queue.qsize()
+
+    def snapshot(self):
+        """
+        返回队列中所有请求的副本，不影响队列
+        :return:
+        """
+        return list(self.queue.queue)
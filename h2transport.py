@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+# @Project Name : spider
+"""
+文件名：h2transport.py
+功能：http/2 下载通道；
+　　　同一站点的并发请求复用少量 http/2 连接（多路复用），
+      站点不支持 http/2、请求使用代理或证书参数时回退到 requests 的 http/1.1；
+      只有协议错误或没有协商 http/2 时才把站点标记为 http/1.1，标记在 h1_ttl 秒后过期，
+      超时和连接错误转换为 requests 的异常，由下载器重试；
+      需要安装 httpx[http2]，未安装时该通道不可用
+"""
+
+import time
+from collections import OrderedDict
+from urllib.parse import urlparse
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+try:
+    import httpx
+    import h2.exceptions
+except ImportError:
+    httpx = None
+
+import log
+import metrics
+import setting
+
+
+class Http2Transport:
+    """
+    http/2 下载通道，每个站点一个 httpx.Client
+    """
+
+    def __init__(self, max_connections=setting.HTTP2_MAX_CONNECTIONS, max_origins=256, h1_ttl=3600):
+        """
+
+        :param max_connections: 每个站点最多连接数
+        :param max_origins: 最多保留的站点连接池数目
+        :param h1_ttl: 站点标记为不支持 http/2 的时间(秒)，过期后重新尝试 http/2
+        """
+        self.max_connections = max_connections if max_connections > 0 else 2
+        self.max_origins = max_origins
+        self.h1_ttl = h1_ttl
+        self._clients = OrderedDict()
+        # 已确认不支持 http/2 的站点 -> 标记过期时间
+        self._h1_origins = {}
+
+    @property
+    def available(self):
+        return httpx is not None
+
+    @staticmethod
+    def _origin(url):
+        parsed = urlparse(url)
+        return "{}://{}".format(parsed.scheme, parsed.netloc.lower())
+
+    def supports(self, url, kwargs):
+        """
+        判断该请求能否使用 http/2
+        :param url:
+        :param kwargs: requests 请求参数
+        :return:
+        """
+        if not self.available or not url.startswith("https://"):
+            return False
+        if kwargs.get("proxies") or kwargs.get("cert") or kwargs.get("verify") is False:
+            return False
+        origin = self._origin(url)
+        expire = self._h1_origins.get(origin)
+        if expire is None:
+            return True
+        if expire > time.time():
+            return False
+        del self._h1_origins[origin]
+        return True
+
+    def _client(self, origin):
+        client = self._clients.get(origin)
+        if client is None:
+            client = httpx.Client(http2=True, limits=httpx.Limits(max_connections=self.max_connections,
+                                                                  max_keepalive_connections=self.max_connections))
+            self._clients[origin] = client
+            while len(self._clients) > self.max_origins:
+                _, old = self._clients.popitem(last=False)
+                old.close()
+        else:
+            self._clients.move_to_end(origin)
+        return client
+
+    def _fallback(self, origin):
+        self._h1_origins[origin] = time.time() + self.h1_ttl
+        while len(self._h1_origins) > self.max_origins * 4:
+            self._h1_origins.pop(next(iter(self._h1_origins)))
+        client = self._clients.pop(origin, None)
+        if client is not None:
+            client.close()
+        metrics.incr("http2.fallback")
+
+    @staticmethod
+    def _to_requests_response(r):
+        """
+        转换为 requests.Response，调用方不需要区分下载通道
+        :param r: httpx.Response
+        :return:
+        """
+        response = requests.models.Response()
+        response.status_code = r.status_code
+        response.headers = CaseInsensitiveDict(r.headers)
+        response._content = r.content
+        response._content_consumed = True
+        response.url = str(r.url)
+        response.reason = r.reason_phrase
+        response.elapsed = r.elapsed
+        response.http_version = r.http_version
+        # 没有 raw，cookie 需要单独复制（包括重定向过程中设置的 cookie）
+        for h in list(r.history) + [r]:
+            for cookie in h.cookies.jar:
+                response.cookies.set_cookie(cookie)
+        return response
+
+    def request(self, method, url, **kwargs):
+        """
+        发送请求
+        :param method:
+        :param url:
+        :param kwargs: requests 请求参数
+        :return: requests.Response；该站点需要回退到 http/1.1 时返回 None
+        """
+        origin = self._origin(url)
+        data = kwargs.get("data")
+        params = {
+            "params": kwargs.get("params"),
+            "json": kwargs.get("json"),
+            "headers": kwargs.get("headers"),
+            "cookies": kwargs.get("cookies"),
+            "files": kwargs.get("files"),
+            "auth": kwargs.get("auth"),
+            "timeout": kwargs.get("timeout"),
+            "follow_redirects": kwargs.get("allow_redirects", True),
+        }
+        if isinstance(data, (bytes, str)):
+            params["content"] = data
+        else:
+            params["data"] = data
+        try:
+            r = self._client(origin).request(method, url, **params)
+        except httpx.TimeoutException as e:
+            raise requests.exceptions.Timeout(e)
+        except (httpx.ProtocolError, h2.exceptions.ProtocolError) as e:
+            log.logger.warning("http/2 请求失败, 回退到 http/1.1 {} {}".format(origin, e))
+            self._fallback(origin)
+            return None
+        except httpx.TooManyRedirects as e:
+            raise requests.exceptions.TooManyRedirects(e)
+        except httpx.HTTPError as e:
+            # 连接错误等临时错误不回退，由下载器重试
+            raise requests.exceptions.ConnectionError(e)
+
+        if r.http_version != "HTTP/2":
+            # 站点没有协商 http/2，之后直接使用 requests
+            self._fallback(origin)
+        else:
+            metrics.incr("http2.request")
+        return self._to_requests_response(r)
+
+    def close(self):
+        for client in self._clients.values():
+            client.close()
+        self._clients.clear()
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+# @Project Name : spider
+"""
+文件名：hotlog.py
+功能：下载热路径上的非阻塞日志；
+　　　站点故障时每个请求都会输出错误日志，格式化字符串和写日志本身会成为瓶颈，
+　　　目前实现的功能有：
+　　　　　日志先放入内存队列，由后台线程（gevent 模式下为协程）统一格式化和写出
+      延迟格式化：调用方只保存模板和参数
+      同一 host 的同一类日志按时间窗口限流，超出的条数在下一条日志中汇总
+      结构化字段分批写入 SPIDER_LOG_DB（redis 列表），redis 未安装或未配置时不写入
+      队列满时丢弃最早的日志，计入 metrics log.dropped
+      进程退出时写出剩余的日志
+"""
+
+import json
+import time
+import atexit
+import logging
+import threading
+from collections import OrderedDict, deque
+
+import gevent
+import gevent.lock
+import gevent.event
+from gevent import monkey
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+import log
+import setting
+import metrics
+
+
+class HotLogger:
+    """
+    热路径日志
+    """
+
+    def __init__(self, burst=setting.HOT_LOG_BURST, interval=setting.HOT_LOG_INTERVAL, max_queue=10000,
+                 log_db=setting.SPIDER_LOG_DB, log_key="spider_log", batch_size=200, flush_interval=2,
+                 max_keys=10000):
+        """
+
+        :param burst: 每个时间窗口内同一 host 同一类日志最多输出条数，0 表示不限流
+        :param interval: 限流时间窗口(秒)
+        :param max_queue: 队列最大长度
+        :param log_db: 结构化日志 redis 地址，为空时不写入
+        :param log_key: 结构化日志 redis 列表名
+        :param batch_size: 结构化日志每批写入条数
+        :param flush_interval: 后台写出间隔(秒)
+        :param max_keys: 限流记录最多保留的 (类别, host) 数目
+        """
+        self.burst = burst
+        self.interval = interval if interval > 0 else 60
+        self.log_db = log_db
+        self.log_key = log_key
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_keys = max_keys
+        self._queue = deque(maxlen=max_queue)
+        # (类别, host) -> [窗口开始时间, 窗口内条数, 被省略条数]
+        self._limits = OrderedDict()
+        # 多个线程同时写日志时保护 _limits 和后台写出的启动，持有期间没有 io
+        self._lock = threading.Lock()
+        self._batch = []
+        # 后台写出和 stop / 退出时的 flush 不能同时写出，start 时按运行模式创建
+        self._flush_lock = None
+        self._redis = None
+        self._wakeup = None
+        self._writer = None
+        self.running = False
+        atexit.register(self.stop)
+
+    def _allow(self, key, host):
+        """
+        限流检查
+        :param key:
+        :param host:
+        :return: (是否输出, 之前被省略的条数)
+        """
+        if self.burst <= 0:
+            return True, 0
+        with self._lock:
+            return self._check_limit(key, host)
+
+    def _check_limit(self, key, host):
+        now = time.time()
+        limit_key = (key, host)
+        state = self._limits.get(limit_key)
+        if state is None:
+            state = self._limits[limit_key] = [now, 0, 0]
+            if len(self._limits) > self.max_keys:
+                self._limits.popitem(last=False)
+        else:
+            self._limits.move_to_end(limit_key)
+        if now - state[0] >= self.interval:
+            state[0], state[1] = now, 0
+        if state[1] >= self.burst:
+            state[2] += 1
+            metrics.incr("log.suppressed")
+            return False, 0
+        state[1] += 1
+        suppressed, state[2] = state[2], 0
+        return True, suppressed
+
+    def log(self, level, key, host, msg, *args, exc=None, **fields):
+        """
+        记录一条日志，只做限流检查和入队，不格式化
+        :param level: logging 级别
+        :param key: 日志类别，限流按 (类别, host) 计数
+        :param host:
+        :param msg: str.format 模板
+        :param args: 模板参数
+        :param exc: 异常对象，输出时附带调用栈
+        :param fields: 结构化字段，写入 SPIDER_LOG_DB
+        :return:
+        """
+        allowed, suppressed = self._allow(key, host)
+        if not allowed:
+            return
+        if len(self._queue) == self._queue.maxlen:
+            metrics.incr("log.dropped")
+        self._queue.append((time.time(), level, key, host, msg, args, exc, suppressed, fields))
+        if not self.running:
+            self.start()
+        elif len(self._queue) >= self.batch_size:
+            self._wakeup.set()
+
+    def warning(self, key, host, msg, *args, **fields):
+        self.log(logging.WARNING, key, host, msg, *args, **fields)
+
+    def error(self, key, host, msg, *args, **fields):
+        self.log(logging.ERROR, key, host, msg, *args, **fields)
+
+    def exception(self, key, host, exc, msg, *args, **fields):
+        self.log(logging.ERROR, key, host, msg, *args, exc=exc, **fields)
+
+    def _write(self, record):
+        created, level, key, host, msg, args, exc, suppressed, fields = record
+        try:
+            text = msg.format(*args) if args else msg
+        except (IndexError, KeyError, ValueError) as e:
+            text = "{} {} ({})".format(msg, args, e)
+        if suppressed:
+            text = "{} (已省略 {} 条同类日志)".format(text, suppressed)
+        exc_info = (type(exc), exc, exc.__traceback__) if exc is not None else None
+        log.logger.log(level, text, exc_info=exc_info)
+        if self.log_db and redis is not None:
+            item = {"time": created, "level": logging.getLevelName(level), "key": key, "host": host,
+                    "msg": text, "spider_id": setting.SPIDER_ID, "spider_ip": setting.SPIDER_IP}
+            if suppressed:
+                item["suppressed"] = suppressed
+            item.update(fields)
+            self._batch.append(item)
+
+    def _send_batch(self):
+        if not self._batch:
+            return
+        batch, self._batch = self._batch, []
+        try:
+            if self._redis is None:
+                self._redis = redis.from_url(self.log_db)
+            pipe = self._redis.pipeline(transaction=False)
+            for i in range(0, len(batch), self.batch_size):
+                pipe.rpush(self.log_key, *[json.dumps(item, ensure_ascii=False, default=str)
+                                           for item in batch[i:i + self.batch_size]])
+            pipe.execute()
+        except Exception as e:
+            self._redis = None
+            metrics.incr("log.db_failed", len(batch))
+            log.logger.warning("结构化日志写入失败 {} 条 {}".format(len(batch), e))
+
+    def flush(self):
+        """
+        写出队列中所有日志
+        :return:
+        """
+        if self._flush_lock is None:
+            return self._flush()
+        with self._flush_lock:
+            self._flush()
+
+    def _flush(self):
+        while self._queue:
+            try:
+                self._write(self._queue.popleft())
+            except Exception as e:
+                log.logger.warning("日志输出失败 {}".format(e))
+        self._send_batch()
+
+    def _run(self):
+        while self.running:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def start(self):
+        with self._lock:
+            if not self.running:
+                self._start()
+
+    def _start(self):
+        # gevent 模式下 threading 未 patch 时，原生线程的 Event 会阻塞 hub，改用协程
+        use_greenlet = setting.CRAWLER_MODE == "gevent" and not monkey.is_module_patched("threading")
+        self._wakeup = gevent.event.Event() if use_greenlet else threading.Event()
+        # 写出时有 redis io，协程模式下使用 gevent 的锁，避免原生锁阻塞 hub
+        self._flush_lock = gevent.lock.BoundedSemaphore() if use_greenlet else threading.Lock()
+        self.running = True
+        if use_greenlet:
+            self._writer = gevent.spawn(self._run)
+        else:
+            self._writer = threading.Thread(target=self._run, name="hotlog", daemon=True)
+            self._writer.start()
+
+    def stop(self):
+        self.running = False
+        if self._wakeup is not None:
+            self._wakeup.set()
+        self.flush()
+
+
+hot_logger = HotLogger()
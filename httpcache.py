@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+# @Project Name : spider
+"""
+文件名：httpcache.py
+功能：http 条件请求缓存；
+　　　按 url 保存 ETag / Last-Modified 和响应内容，
+      下次请求时发送 If-None-Match / If-Modified-Since，
+      返回 304 时直接使用本地保存的内容；
+      缓存保存在本地磁盘，超过容量上限时按 LRU 淘汰
+"""
+
+import os
+import json
+import hashlib
+from collections import OrderedDict
+
+import gevent.lock
+
+import log
+
+# 缓存文件中需要保留的响应头
+KEEP_HEADERS = ("Content-Type", "ETag", "Last-Modified")
+
+
+class CacheEntry:
+    """
+    缓存条目
+    """
+
+    __slots__ = ("url", "etag", "last_modified", "headers", "encoding", "body")
+
+    def __init__(self, url, etag=None, last_modified=None, headers=None, encoding=None, body=b""):
+        self.url = url
+        self.etag = etag
+        self.last_modified = last_modified
+        self.headers = headers or {}
+        self.encoding = encoding
+        self.body = body
+
+    def conditional_headers(self):
+        """
+        返回条件请求头
+        :return:
+        """
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+class HttpCache:
+    """
+    磁盘 LRU 缓存
+    每个 url 对应一个文件：第一行为 json 格式的元数据，之后为响应内容
+    """
+
+    def __init__(self, cache_dir, max_size=256 * 1024 * 1024):
+        """
+
+        :param cache_dir: 缓存目录
+        :param max_size: 缓存最大字节数
+        """
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.size = 0
+        # key -> 文件大小，按访问顺序排列
+        self._index = OrderedDict()
+        self._lock = gevent.lock.RLock()
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self._load_index()
+
+    def _load_index(self):
+        """
+        启动时按文件修改时间重建 LRU 索引
+        :return:
+        """
+        files = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".cache"):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.cache_dir, name))
+            except OSError:
+                continue
+            files.append((stat.st_mtime, name[:-6], stat.st_size))
+        files.sort()
+        for _, key, size in files:
+            self._index[key] = size
+            self.size += size
+        self._evict()
+
+    @staticmethod
+    def _key(url):
+        return hashlib.sha1(url.encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + ".cache")
+
+    def _remove(self, key):
+        size = self._index.pop(key, 0)
+        self.size -= size
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def _evict(self):
+        while self.size > self.max_size and self._index:
+            key = next(iter(self._index))
+            self._remove(key)
+
+    def get(self, url):
+        """
+        读取缓存条目，不存在时返回 None
+        :param url:
+        :return:
+        """
+        key = self._key(url)
+        with self._lock:
+            if key not in self._index:
+                return None
+            self._index.move_to_end(key)
+        try:
+            with open(self._path(key), "rb") as f:
+                meta = json.loads(f.readline().decode("utf-8"))
+                body = f.read()
+        except (OSError, ValueError) as e:
+            log.logger.warning("读取 http 缓存失败 {} {}".format(url, e))
+            with self._lock:
+                self._remove(key)
+            return None
+        if meta.get("url") != url:
+            return None
+        return CacheEntry(url, meta.get("etag"), meta.get("last_modified"),
+                          meta.get("headers"), meta.get("encoding"), body)
+
+    def set(self, url, response):
+        """
+        保存带有校验信息的响应
+        :param url:
+        :param response:
+        :return: 是否已保存
+        """
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        if not (etag or last_modified):
+            return False
+        body = response.content or b""
+        meta = {
+            "url": url,
+            "etag": etag,
+            "last_modified": last_modified,
+            "headers": {k: response.headers[k] for k in KEEP_HEADERS if k in response.headers},
+            "encoding": response.encoding,
+        }
+        data = json.dumps(meta).encode("utf-8") + b"\n" + body
+        if len(data) > self.max_size:
+            return False
+
+        key = self._key(url)
+        path = self._path(key)
+        tmp_path = path + ".tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            log.logger.warning("写入 http 缓存失败 {} {}".format(url, e))
+            return False
+        with self._lock:
+            self.size -= self._index.pop(key, 0)
+            self._index[key] = len(data)
+            self.size += len(data)
+            self._evict()
+        return True
+
+    def conditional_headers(self, url):
+        """
+        返回该 url 的条件请求头和缓存条目
+        :param url:
+        :return:
+        """
+        entry = self.get(url)
+        if entry is None:
+            self.misses += 1
+            return {}, None
+        return entry.conditional_headers(), entry
+
+    def apply(self, response, entry):
+        """
+        304 响应时用缓存内容填充 response，并标记 from_cache
+        :param response:
+        :param entry:
+        :return:
+        """
+        self.hits += 1
+        response.status_code = 200
+        response._content = entry.body
+        response._content_consumed = True
+        for k, v in entry.headers.items():
+            response.headers.setdefault(k, v)
+        if entry.encoding:
+            response.encoding = entry.encoding
+        response.from_cache = True
+        return response
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+# @Project Name : spider
+"""
+文件名：hubwatch.py
+功能：gevent hub 阻塞检测；
+　　　crawler_mode = gevent 时，任何不让出 hub 的调用（未 patch 的 time.sleep、socket、
+      dns 解析、大量 cpu 计算）都会让所有协程停顿，
+　　　目前实现的功能有：
+　　　　　心跳协程定时更新时间戳，独立的原生线程检查时间戳，
+          超过阈值未更新时抓取 hub 所在线程的调用栈
+      hub 恢复后由心跳协程输出日志（原生线程中不使用 gevent patch 过的日志锁），
+          并计入 metrics：hub.blocked 次数、hub.blocked_seconds 累计阻塞时间、hub.max_blocked 最长阻塞
+      启动检查：monkey patch 是否覆盖了必需的模块
+"""
+
+import sys
+import time
+import traceback
+
+import gevent
+from gevent import monkey
+
+import log
+import setting
+import metrics
+
+_start_new_thread = monkey.get_original("_thread", "start_new_thread")
+_real_sleep = monkey.get_original("time", "sleep")
+_get_ident = monkey.get_original("_thread", "get_ident")
+
+# gevent 模式下必须 patch 的模块
+REQUIRED_MODULES = ["socket", "ssl", "time", "select", "_thread", "threading"]
+
+
+def check_patched(modules=REQUIRED_MODULES):
+    """
+    检查 monkey patch，未 patch 的模块会阻塞 hub
+    :param modules:
+    :return: 未 patch 的模块列表
+    """
+    unpatched = [name for name in modules if not monkey.is_module_patched(name)]
+    if unpatched:
+        log.logger.warning("crawler_mode = gevent 但以下模块未 monkey patch, 会阻塞 hub: {}".format(
+            ", ".join(unpatched)))
+    return unpatched
+
+
+class HubWatchdog:
+    """
+    hub 阻塞检测
+    """
+
+    def __init__(self, threshold=setting.HUB_BLOCK_THRESHOLD, interval=None):
+        """
+
+        :param threshold: hub 超过该时间(秒)未切换时认为被阻塞
+        :param interval: 心跳间隔(秒)，默认为阈值的四分之一
+        """
+        self.threshold = threshold if threshold > 0 else 0.5
+        self.interval = interval or self.threshold / 4
+        self._last = time.time()
+        self._hub_thread = None
+        self._incident = None
+        self._greenlet = None
+        self.running = False
+
+    def _heartbeat(self):
+        while self.running:
+            now = time.time()
+            incident = self._incident
+            if incident is not None:
+                self._incident = None
+                self._report(now - incident[0], incident[1])
+            self._last = now
+            gevent.sleep(self.interval)
+
+    def _report(self, blocked, stack):
+        metrics.incr("hub.blocked")
+        metrics.incr("hub.blocked_seconds", blocked)
+        if blocked > metrics.get("hub.max_blocked"):
+            metrics.gauge("hub.max_blocked", blocked)
+        log.logger.warning("gevent hub 被阻塞 {:.3f} 秒, 阻塞时的调用栈:\n{}".format(blocked, stack))
+
+    def _watch(self):
+        """
+        原生线程：只读写属性，不调用 gevent 和日志
+        :return:
+        """
+        while self.running:
+            _real_sleep(self.interval)
+            last = self._last
+            if self._incident is None and time.time() - last > self.threshold:
+                frame = sys._current_frames().get(self._hub_thread)
+                stack = "".join(traceback.format_stack(frame)) if frame is not None else ""
+                self._incident = (last, stack)
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self._hub_thread = _get_ident()
+        self._last = time.time()
+        self._greenlet = gevent.spawn(self._heartbeat)
+        _start_new_thread(self._watch, ())
+
+    def stop(self):
+        self.running = False
+        if self._greenlet is not None:
+            self._greenlet.kill(block=False)
+            self._greenlet = None
+
+
+def install(threshold=setting.HUB_BLOCK_THRESHOLD):
+    """
+    crawler_mode = gevent 时检查 monkey patch 并启动 hub 阻塞检测，阈值为 0 时不检测
+    :param threshold:
+    :return:
+    """
+    if setting.CRAWLER_MODE != "gevent":
+        return None
+    check_patched()
+    if threshold <= 0:
+        return None
+    watchdog = HubWatchdog(threshold)
+    watchdog.start()
+    return watchdog
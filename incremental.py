@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+# @Project Name : spider
+"""
+文件名：incremental.py
+功能：列表页增量抓取；
+　　　目前实现的功能有：
+　　　　　计算列表页链接集合指纹，判断列表页是否变化
+      只返回上次访问后新出现的详情页链接
+      根据列表页变化频率自适应调整重访间隔：
+          每次访问是否有新链接的移动平均作为变化概率 p 的估计，按泊松过程 p = 1 - exp(-λ·间隔)
+          估计变化速率 λ，下次间隔取使变化概率为 target_change 的间隔：
+              间隔 × ln(1 - target_change) / ln(1 - p)
+          每次调整不超过减半和乘以 backoff
+"""
+
+import math
+import time
+import heapq
+import hashlib
+from collections import OrderedDict
+
+import gevent.lock
+
+import setting
+
+
+def _link_hash(link):
+    return int.from_bytes(hashlib.md5(link.encode("utf-8")).digest()[:8], "big")
+
+
+class ListPageState:
+    """
+    单个列表页的增量状态
+    """
+
+    __slots__ = ("url", "fingerprint", "seen", "interval", "next_visit",
+                 "visits", "changes", "change_rate")
+
+    def __init__(self, url, interval):
+        self.url = url
+        self.fingerprint = None
+        # 已见过的详情页链接哈希，按出现顺序排列，超过上限时淘汰最早的
+        self.seen = OrderedDict()
+        self.interval = interval
+        self.next_visit = 0
+        self.visits = 0
+        self.changes = 0
+        # 每次访问有新链接的概率的指数移动平均，0 ~ 1
+        self.change_rate = 0.5
+
+
+class IncrementalTracker:
+    """
+    列表页增量跟踪和重访调度
+    """
+
+    def __init__(self, min_interval=setting.LIST_MIN_INTERVAL, max_interval=setting.LIST_MAX_INTERVAL,
+                 backoff=1.5, max_seen=2000, alpha=0.3, target_change=0.5):
+        """
+
+        :param min_interval: 最小重访间隔(秒)
+        :param max_interval: 最大重访间隔(秒)
+        :param backoff: 每次调整时重访间隔的最大放大系数
+        :param max_seen: 每个列表页最多记录的详情页链接数目
+        :param alpha: 变化率移动平均系数
+        :param target_change: 期望每次访问时列表页有变化的概率，0 ~ 1
+        """
+        self.min_interval = min_interval if min_interval > 0 else 60
+        self.max_interval = max(max_interval, self.min_interval)
+        self.backoff = backoff if backoff > 1 else 1.5
+        self.max_seen = max_seen
+        self.alpha = alpha
+        self.target_change = min(max(target_change, 0.05), 0.95)
+        self.states = {}
+        # (下次访问时间, url)
+        self._schedule = []
+        self._lock = gevent.lock.RLock()
+
+    def add(self, url, now=None):
+        """
+        添加列表页，立即可以访问
+        :param url:
+        :param now:
+        :return:
+        """
+        with self._lock:
+            if url in self.states:
+                return self.states[url]
+            state = ListPageState(url, self.min_interval)
+            state.change_rate = self.target_change
+            state.next_visit = now if now is not None else time.time()
+            self.states[url] = state
+            heapq.heappush(self._schedule, (state.next_visit, url))
+            return state
+
+    def remove(self, url):
+        with self._lock:
+            self.states.pop(url, None)
+
+    @staticmethod
+    def fingerprint(links):
+        """
+        链接集合指纹，与链接顺序无关
+        :param links:
+        :return:
+        """
+        md5 = hashlib.md5()
+        for link in sorted(set(links)):
+            md5.update(link.encode("utf-8"))
+            md5.update(b"\n")
+        return md5.hexdigest()
+
+    def update(self, url, links, now=None):
+        """
+        记录一次列表页访问结果，返回新出现的详情页链接，并安排下次访问时间
+        :param url: 列表页 url
+        :param links: 本次解析出的详情页链接
+        :param now:
+        :return: 新链接列表，保持原顺序
+        """
+        now = now if now is not None else time.time()
+        with self._lock:
+            state = self.states.get(url) or self.add(url, now)
+            state.visits += 1
+            fingerprint = self.fingerprint(links)
+
+            new_links = []
+            if fingerprint != state.fingerprint:
+                for link in links:
+                    h = _link_hash(link)
+                    if h in state.seen:
+                        state.seen.move_to_end(h)
+                        continue
+                    state.seen[h] = None
+                    new_links.append(link)
+                while len(state.seen) > self.max_seen:
+                    state.seen.popitem(last=False)
+                state.fingerprint = fingerprint
+
+            changed = 1.0 if new_links else 0.0
+            state.change_rate = self.alpha * changed + (1 - self.alpha) * state.change_rate
+            if new_links:
+                state.changes += 1
+            state.interval = self._next_interval(state)
+            state.next_visit = now + state.interval
+            heapq.heappush(self._schedule, (state.next_visit, url))
+        return new_links
+
+    def _next_interval(self, state):
+        """
+        根据估计的变化概率计算下次重访间隔
+        :param state:
+        :return:
+        """
+        p = min(state.change_rate, 0.99)
+        if p <= 0:
+            factor = self.backoff
+        else:
+            factor = math.log(1 - self.target_change) / math.log(1 - p)
+        factor = min(max(factor, 0.5), self.backoff)
+        return min(self.max_interval, max(self.min_interval, state.interval * factor))
+
+    def reschedule(self, url, now=None):
+        """
+        列表页下载失败时按当前间隔重新安排访问，不改变间隔
+        :param url:
+        :param now:
+        :return:
+        """
+        now = now if now is not None else time.time()
+        with self._lock:
+            state = self.states.get(url)
+            if state is None:
+                return
+            state.next_visit = now + state.interval
+            heapq.heappush(self._schedule, (state.next_visit, url))
+
+    def due(self, now=None, limit=None):
+        """
+        返回已到访问时间的列表页；
+        返回的列表页在调用 update 或 reschedule 之前不会再次返回
+        :param now:
+        :param limit: 最多返回数目
+        :return:
+        """
+        now = now if now is not None else time.time()
+        urls = []
+        with self._lock:
+            while self._schedule and self._schedule[0][0] <= now:
+                next_visit, url = heapq.heappop(self._schedule)
+                state = self.states.get(url)
+                # 已删除或已重新调度的过期记录
+                if state is None or state.next_visit != next_visit:
+                    continue
+                urls.append(url)
+                if limit and len(urls) >= limit:
+                    break
+        return urls
+
+    def next_due_time(self):
+        """
+        最近一个列表页的访问时间，没有列表页时返回 None
+        :return:
+        """
+        with self._lock:
+            return self._schedule[0][0] if self._schedule else None
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+# @Project Name : spider
+"""
+文件名：metrics.py
+功能：进程内运行指标；
+　　　计数器只增不减，gauge 保存最新值；
+      gevent 模式下协程之间不会在自增过程中切换，不需要加锁
+"""
+
+from collections import defaultdict
+
+_counters = defaultdict(int)
+_gauges = {}
+
+
+def incr(name, value=1):
+    """
+    计数器加 value
+    :param name:
+    :param value:
+    :return:
+    """
+    _counters[name] += value
+
+
+def gauge(name, value):
+    """
+    设置 gauge 值
+    :param name:
+    :param value:
+    :return:
+    """
+    _gauges[name] = value
+
+
+def get(name, default=0):
+    if name in _gauges:
+        return _gauges[name]
+    return _counters.get(name, default)
+
+
+def snapshot(prefix=""):
+    """
+    返回所有指标的副本
+    :param prefix: 只返回以该前缀开头的指标
+    :return:
+    """
+    data = {k: v for k, v in _counters.items() if k.startswith(prefix)}
+    data.update((k, v) for k, v in _gauges.items() if k.startswith(prefix))
+    return data
+
+
+def reset():
+    _counters.clear()
+    _gauges.clear()
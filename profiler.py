@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+# @Project Name : spider
+"""
+文件名：profiler.py
+功能：运行时性能诊断；
+　　　目前实现的功能有：
+　　　　　采样分析：独立线程定时采集所有线程和所有协程的调用栈，
+          按栈聚合计数，输出 flamegraph 可用的 folded 格式；
+          挂起中的协程（time.sleep、dns、等待代理）也会被采到
+      触发方式：向进程发送 SIGUSR2，或访问本地 http 接口 /profile?seconds=N
+      慢请求跟踪：记录超过阈值的下载各阶段耗时，保存在环形缓冲区，
+          通过 /slow 接口或 dump_slow() 导出
+"""
+
+import gc
+import os
+import sys
+import json
+import time
+import signal
+import weakref
+from collections import Counter, deque
+from urllib.parse import parse_qs
+
+import gevent
+from gevent import monkey
+from greenlet import greenlet
+
+import log
+import setting
+
+# 采样线程使用未被 monkey patch 的线程和 sleep，hub 阻塞时也能采样
+_start_new_thread = monkey.get_original("_thread", "start_new_thread")
+_real_sleep = monkey.get_original("time", "sleep")
+_get_ident = monkey.get_original("_thread", "get_ident")
+
+
+def _format_stack(frame, limit=64):
+    stack = []
+    while frame is not None and len(stack) < limit:
+        code = frame.f_code
+        stack.append("{}:{}:{}".format(code.co_filename.rsplit("/", 1)[-1], code.co_name, frame.f_lineno))
+        frame = frame.f_back
+    stack.reverse()
+    return ";".join(stack)
+
+
+class SamplingProfiler:
+    """
+    采样分析器
+    """
+
+    def __init__(self, interval=0.01, greenlet_interval=0.1):
+        """
+
+        :param interval: 线程栈采样间隔(秒)
+        :param greenlet_interval: 挂起协程栈采样间隔(秒)，需要遍历 gc 对象，间隔较大
+        """
+        self.interval = interval
+        self.greenlet_interval = greenlet_interval
+        self.samples = Counter()
+        self.running = False
+        self._own_thread_id = None
+
+    def _sample_threads(self):
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == self._own_thread_id:
+                continue
+            self.samples["thread;" + _format_stack(frame)] += 1
+
+    def _sample_greenlets(self):
+        for obj in gc.get_objects():
+            if isinstance(obj, greenlet) and not obj.dead and obj.gr_frame is not None:
+                self.samples["greenlet;" + _format_stack(obj.gr_frame)] += 1
+
+    def _run(self, seconds):
+        self._own_thread_id = _get_ident()
+        end = time.time() + seconds
+        next_greenlet_sample = 0
+        while self.running and time.time() < end:
+            self._sample_threads()
+            now = time.time()
+            if now >= next_greenlet_sample:
+                self._sample_greenlets()
+                next_greenlet_sample = now + self.greenlet_interval
+            _real_sleep(self.interval)
+        self.running = False
+
+    def start(self, seconds=30):
+        """
+        在独立线程中采样 seconds 秒
+        :param seconds:
+        :return: 是否启动，已经在采样时返回 False
+        """
+        if self.running:
+            return False
+        self.samples = Counter()
+        self.running = True
+        _start_new_thread(self._run, (seconds,))
+        return True
+
+    def stop(self):
+        self.running = False
+
+    def folded(self):
+        """
+        folded 格式：每行一个调用栈和采样次数
+        :return:
+        """
+        return "\n".join("{} {}".format(stack, count) for stack, count in self.samples.most_common())
+
+    def profile(self, seconds):
+        """
+        采样 seconds 秒并返回结果，调用方会等待
+        :param seconds:
+        :return:
+        """
+        if not self.start(seconds):
+            return ""
+        while self.running:
+            gevent.sleep(0.1)
+        return self.folded()
+
+
+class Trace:
+    """
+    一次下载的分阶段耗时
+    """
+
+    __slots__ = ("url", "start", "phases", "elapsed", "status")
+
+    def __init__(self, url):
+        self.url = url
+        self.start = time.time()
+        self.phases = []
+        self.elapsed = 0
+        self.status = None
+
+    def to_dict(self):
+        return {"url": self.url, "start": self.start, "elapsed": round(self.elapsed, 4),
+                "status": self.status, "phases": [(name, round(d, 4)) for name, d in self.phases]}
+
+
+class _Phase:
+    __slots__ = ("trace", "name", "start")
+
+    def __init__(self, trace, name):
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        if self.trace is not None:
+            self.trace.phases.append((self.name, time.time() - self.start))
+        return False
+
+
+class SlowRequestTracer:
+    """
+    慢请求跟踪，当前协程（或其父协程）正在进行的下载记录在 _active 中
+    """
+
+    def __init__(self, threshold=setting.SLOW_REQUEST_THRESHOLD, size=200):
+        """
+
+        :param threshold: 耗时超过该值(秒)的下载被记录，0 表示不记录
+        :param size: 环形缓冲区大小
+        """
+        self.threshold = threshold
+        self.traces = deque(maxlen=size)
+        # 协程被 kill 时不会调用 finish，使用弱引用避免泄漏
+        self._active = weakref.WeakKeyDictionary()
+
+    @property
+    def enabled(self):
+        return self.threshold > 0
+
+    def begin(self, url):
+        if not self.enabled:
+            return None
+        trace = Trace(url)
+        self._active[gevent.getcurrent()] = trace
+        return trace
+
+    def current(self):
+        if not self._active:
+            return None
+        current = gevent.getcurrent()
+        trace = self._active.get(current)
+        if trace is None:
+            # 对冲下载等在子协程中执行的阶段记到父协程的跟踪上
+            parent = getattr(current, "spawning_greenlet", None)
+            parent = parent() if parent is not None else None
+            trace = self._active.get(parent) if parent is not None else None
+        return trace
+
+    def phase(self, name):
+        """
+        with tracer.phase("dns"): ...
+        :param name:
+        :return:
+        """
+        return _Phase(self.current(), name)
+
+    def finish(self, trace, status=None):
+        if trace is None:
+            return
+        self._active.pop(gevent.getcurrent(), None)
+        trace.elapsed = time.time() - trace.start
+        trace.status = status
+        if trace.elapsed >= self.threshold:
+            self.traces.append(trace)
+
+    def dump_slow(self):
+        return [trace.to_dict() for trace in self.traces]
+
+
+profiler = SamplingProfiler()
+tracer = SlowRequestTracer()
+
+
+def _wsgi_app(environ, start_response):
+    path = environ.get("PATH_INFO", "")
+    query = parse_qs(environ.get("QUERY_STRING", ""))
+    if path == "/profile":
+        try:
+            seconds = float(query.get("seconds", ["10"])[0])
+        except ValueError:
+            seconds = None
+        # 非数字、nan、0 和负数返回 400，超过 300 秒按 300 秒采样
+        if seconds is None or not seconds > 0:
+            start_response("400 Bad Request", [("Content-Type", "text/plain; charset=utf-8")])
+            return ["seconds 应为正数".encode("utf-8")]
+        seconds = min(seconds, 300)
+        body = profiler.profile(seconds).encode("utf-8")
+        start_response("200 OK", [("Content-Type", "text/plain; charset=utf-8")])
+        return [body]
+    if path == "/slow":
+        body = json.dumps(tracer.dump_slow(), ensure_ascii=False).encode("utf-8")
+        start_response("200 OK", [("Content-Type", "application/json; charset=utf-8")])
+        return [body]
+    start_response("404 Not Found", [("Content-Type", "text/plain")])
+    return [b"/profile?seconds=N | /slow"]
+
+
+def _on_signal(*args):
+    """
+    SIGUSR2: 采样 30 秒后写入 /tmp/spider_profile_<pid>_<时间>.txt，同时写入慢请求
+    """
+    def dump():
+        folded = profiler.profile(30)
+        path = "/tmp/spider_profile_{}_{}.txt".format(os.getpid(), int(time.time()))
+        with open(path, "w") as f:
+            f.write(folded + "\n\n# slow requests\n")
+            f.write(json.dumps(tracer.dump_slow(), ensure_ascii=False, indent=1))
+        log.logger.info("profile saved to {}".format(path))
+
+    gevent.spawn(dump)
+
+
+def install(port=setting.PROFILER_PORT):
+    """
+    注册 SIGUSR2 信号，并在 127.0.0.1:port 启动诊断接口（port 为 0 时不启动）
+    :param port:
+    :return:
+    """
+    gevent.signal_handler(signal.SIGUSR2, _on_signal)
+    if port:
+        from gevent.pywsgi import WSGIServer
+        server = WSGIServer(("127.0.0.1", port), _wsgi_app, log=None)
+        server.start()
+        log.logger.info("profiler listening on 127.0.0.1:{}".format(port))
+        return server
+    return None
@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+# @Project Name : spider
+"""
+文件名：proxypool.py
+功能：多进程共享代理池；
+　　　主进程启动 ProxyPoolServer，在本地 unix socket 上提供代理借还服务，
+      各爬虫进程通过 ProxyPoolClient 借还代理：
+　　　　　代理只从代理服务器获取一次，所有进程共用
+      黑名单全局共享
+      proxy_max_num 按全局使用次数限制
+      无法连接代理池时回退到进程内的 ProxyManager
+协议：每行一个 json 请求，每行一个 json 响应
+    {"op": "get"}                                   -> {"pid", "type", "host", "counter"} 或 {}
+    {"op": "put", "pid", "host", "counter", "elapsed"} -> {}
+    {"op": "fail", "pid", "host", "elapsed"}        -> {}
+    {"op": "release", "pid", "host"}                -> {} 归还被取消请求的代理，不记录结果
+    {"op": "ban", "host"}                           -> {"type", "host"} 新选出的代理
+    {"op": "choice"}                                -> {"type", "host"} 不借出
+    {"op": "size"}                                  -> {"size"}
+"""
+
+import os
+import json
+import time
+import socket
+
+import gevent
+import gevent.lock
+import gevent.server
+import gevent.socket
+
+import log
+import setting
+import downloader
+
+
+class ProxyPoolServer:
+    """
+    代理池服务，内部使用一个 ProxyManager 保存所有代理
+    """
+
+    def __init__(self, socket_path=setting.PROXY_POOL_SOCKET, proxy_max_num=setting.PROXY_MAX_NUM,
+                 available_proxy=setting.PROXY_AVAILABLE, proxy_url=setting.PROXY_URL):
+        """
+
+        :param socket_path: unix socket 路径
+        :param proxy_max_num: 代理全局最多连续使用次数
+        :param available_proxy: 最多可用代理数目
+        :param proxy_url: 代理服务器地址
+        """
+        self.socket_path = socket_path
+        self.manager = downloader.ProxyManager(proxy_max_num, available_proxy, proxy_url)
+        self.server = None
+
+    def _item(self, data):
+        """
+        根据客户端传回的 pid 和 host 还原代理对象；pid 已被其它代理复用时返回 None
+        :param data:
+        :return:
+        """
+        pid, host = data.get("pid"), data.get("host")
+        if pid is None or self.manager.registry.id_of(host) != pid:
+            return None
+        proxy_type, _ = self.manager.registry.get(pid)
+        proxy_item = downloader.ProxyItem(proxy_type, host, self.manager.proxy_max_num, pid)
+        proxy_item.proxy_counter = data.get("counter", 0)
+        return proxy_item
+
+    def handle_request(self, data):
+        op = data.get("op")
+        if op == "get":
+            proxy_item = self.manager.get_proxy()
+            if proxy_item is None:
+                return {}
+            return {"pid": proxy_item.pid, "type": proxy_item.proxy_type,
+                    "host": proxy_item.host, "counter": proxy_item.proxy_counter}
+        if op == "put":
+            self.manager.put_proxy(self._item(data), data.get("elapsed"))
+            return {}
+        if op == "fail":
+            self.manager.report_failure(self._item(data), data.get("elapsed"))
+            return {}
+        if op == "release":
+            self.manager.release_proxy(self._item(data))
+            return {}
+        if op == "ban":
+            proxy_type, proxy_host = self.manager.update_black_peoxies(data.get("host"))
+            return {"type": proxy_type, "host": proxy_host}
+        if op == "choice":
+            proxy_type, proxy_host = self.manager.random_choice_proxy()
+            return {"type": proxy_type, "host": proxy_host}
+        if op == "size":
+            return {"size": self.manager.size()}
+        return {"error": "unknown op {}".format(op)}
+
+    def _handle(self, sock, address):
+        f = sock.makefile("rwb")
+        try:
+            for line in f:
+                try:
+                    result = self.handle_request(json.loads(line.decode("utf-8")))
+                except Exception as e:
+                    log.logger.exception(e)
+                    result = {"error": str(e)}
+                f.write(json.dumps(result).encode("utf-8") + b"\n")
+                f.flush()
+        except (OSError, ValueError):
+            pass
+        finally:
+            f.close()
+            sock.close()
+
+    def start(self):
+        """
+        启动代理池服务，首次加载代理
+        :return:
+        """
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        listener = gevent.socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(self.socket_path)
+        listener.listen(128)
+        self.manager.init_proxy_queue()
+        self.server = gevent.server.StreamServer(listener, self._handle)
+        self.server.start()
+        log.logger.info("proxy pool listening on {}, {} proxies".format(self.socket_path, self.manager.size()))
+
+    def serve_forever(self):
+        if self.server is None:
+            self.start()
+        self.server.serve_forever()
+
+    def stop(self):
+        if self.server is not None:
+            self.server.stop()
+            self.server = None
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+
+class ProxyPoolClient:
+    """
+    代理池客户端，接口与 ProxyManager 一致
+    """
+
+    def __init__(self, socket_path=setting.PROXY_POOL_SOCKET, proxy_max_num=setting.PROXY_MAX_NUM,
+                 available_proxy=setting.PROXY_AVAILABLE, proxy_url=setting.PROXY_URL, timeout=5):
+        """
+
+        :param socket_path: unix socket 路径
+        :param proxy_max_num: 回退到进程内代理管理时使用的参数
+        :param available_proxy:
+        :param proxy_url:
+        :param timeout: 请求代理池超时时间(秒)
+        """
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self._fallback_args = (proxy_max_num, available_proxy, proxy_url)
+        self._local = None
+        self._sock = None
+        self._file = None
+        self._lock = gevent.lock.Semaphore()
+        # 代理池不可用时，在该时间之前不再尝试连接
+        self._down_until = 0
+
+    @property
+    def black_peoxies(self):
+        return self._local.black_peoxies if self._local is not None else set()
+
+    def _connect(self):
+        sock = gevent.socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self._sock = sock
+        self._file = sock.makefile("rwb")
+
+    def _close(self):
+        for obj in (self._file, self._sock):
+            if obj is not None:
+                try:
+                    obj.close()
+                except OSError:
+                    pass
+        self._sock = self._file = None
+
+    def _call(self, **data):
+        """
+        发送一次请求，代理池不可用时返回 None，并在 10 秒内直接使用进程内代理管理
+        :param data:
+        :return:
+        """
+        if self._down_until > time.time():
+            return None
+        with self._lock:
+            for _ in range(2):
+                try:
+                    if self._sock is None:
+                        self._connect()
+                    self._file.write(json.dumps(data).encode("utf-8") + b"\n")
+                    self._file.flush()
+                    line = self._file.readline()
+                    if not line:
+                        raise OSError("proxy pool closed connection")
+                    return json.loads(line.decode("utf-8"))
+                except (OSError, ValueError) as e:
+                    self._close()
+                    error = e
+            log.logger.warning("代理池不可用, 使用进程内代理管理 {} {}".format(self.socket_path, error))
+            self._down_until = time.time() + 10
+            return None
+
+    def _local_manager(self):
+        if self._local is None:
+            self._local = downloader.ProxyManager(*self._fallback_args)
+            self._local.init_proxy_queue()
+        return self._local
+
+    def init_proxy_queue(self):
+        self.size()
+
+    def size(self):
+        result = self._call(op="size")
+        if result is None:
+            return self._local_manager().size()
+        return result.get("size", 0)
+
+    def get_proxy(self):
+        result = self._call(op="get")
+        if result is None:
+            return self._local_manager().get_proxy()
+        if not result.get("host"):
+            return None
+        proxy_item = downloader.ProxyItem(result.get("type"), result.get("host"),
+                                          self._fallback_args[0], result.get("pid"), origin=self.socket_path)
+        proxy_item.proxy_counter = result.get("counter", 0)
+        return proxy_item
+
+    def put_proxy(self, proxy_item, elapsed=None):
+        if proxy_item is None or proxy_item.pid is None:
+            return
+        # 按借出时记录的来源归还，代理池和进程内可能有相同地址的代理
+        if proxy_item.origin != self.socket_path:
+            if self._local is not None:
+                self._local.put_proxy(proxy_item, elapsed)
+            return
+        pid, proxy_item.pid = proxy_item.pid, None
+        self._call(op="put", pid=pid, host=proxy_item.host, counter=proxy_item.proxy_counter, elapsed=elapsed)
+
+    def report_failure(self, proxy_item, elapsed=None):
+        if proxy_item is None or proxy_item.pid is None:
+            return
+        # 按借出时记录的来源归还，代理池和进程内可能有相同地址的代理
+        if proxy_item.origin != self.socket_path:
+            if self._local is not None:
+                self._local.report_failure(proxy_item, elapsed)
+            return
+        pid, proxy_item.pid = proxy_item.pid, None
+        self._call(op="fail", pid=pid, host=proxy_item.host, elapsed=elapsed)
+
+    def release_proxy(self, proxy_item):
+        if proxy_item is None or proxy_item.pid is None:
+            return
+        if proxy_item.origin != self.socket_path:
+            if self._local is not None:
+                self._local.release_proxy(proxy_item)
+            return
+        pid, proxy_item.pid = proxy_item.pid, None
+        self._call(op="release", pid=pid, host=proxy_item.host)
+
+    def update_black_peoxies(self, host):
+        result = self._call(op="ban", host=host)
+        if result is None:
+            return self._local_manager().update_black_peoxies(host)
+        return result.get("type"), result.get("host")
+
+    def random_choice_proxy(self):
+        result = self._call(op="choice")
+        if result is None:
+            return self._local_manager().random_choice_proxy()
+        return result.get("type"), result.get("host")
+
+
+if __name__ == "__main__":
+    ProxyPoolServer().serve_forever()
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+# @Project Name : spider
+"""
+文件名：proxyregistry.py
+功能：代理注册表；
+　　　代理地址、计数和健康指标按列保存在 array 中，用整数 id 索引，
+      不再为每个代理创建带 __dict__ 的对象；
+      按成功率和耗时计算得分，按得分加权随机选择代理，
+      安装 numpy 时得分计算和选择使用向量运算；
+      连续失败 max_failures 次或得分低于 min_score 的代理删除，不再被选中
+"""
+
+import random
+from array import array
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+PROXY_TYPES = ["http", "https", "socks5", "socks5h", "socks4"]
+
+
+class ProxyRegistry:
+    """
+    代理注册表
+    """
+
+    def __init__(self, alpha=0.3, max_failures=3, min_score=0.05):
+        """
+
+        :param alpha: 耗时移动平均系数
+        :param max_failures: 连续失败多少次后删除代理，0 表示不按连续失败删除
+        :param min_score: 得分低于该值时删除代理，0 表示不按得分删除
+        """
+        self.alpha = alpha
+        self.max_failures = max_failures
+        self.min_score = min_score
+        # id -> 代理地址 host:port，已删除的位置为 None
+        self.hosts = []
+        self.types = array("B")
+        self.uses = array("I")
+        self.successes = array("I")
+        self.failures = array("I")
+        # 连续失败次数
+        self.streaks = array("I")
+        # 耗时移动平均(秒)
+        self.latency = array("d")
+        self.alive = array("B")
+        # 是否正在被某个请求使用
+        self.in_use = array("B")
+        self.blacklist = set()
+        self._ids = {}
+        self._free = []
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, host):
+        return host in self._ids
+
+    def add(self, proxy_type, host):
+        """
+        添加代理，已存在或在黑名单中时不添加
+        :param proxy_type:
+        :param host: host:port
+        :return: 代理 id，未添加时返回 None
+        """
+        if not host or host in self._ids or host in self.blacklist:
+            return None
+        proxy_type = (proxy_type or "http").lower()
+        if proxy_type not in PROXY_TYPES:
+            PROXY_TYPES.append(proxy_type)
+        type_id = PROXY_TYPES.index(proxy_type)
+
+        if self._free:
+            pid = self._free.pop()
+            self.hosts[pid] = host
+            self.types[pid] = type_id
+            self.uses[pid] = self.successes[pid] = self.failures[pid] = self.streaks[pid] = 0
+            self.latency[pid] = 0.0
+            self.alive[pid] = 1
+            self.in_use[pid] = 0
+        else:
+            pid = len(self.hosts)
+            self.hosts.append(host)
+            self.types.append(type_id)
+            self.uses.append(0)
+            self.successes.append(0)
+            self.failures.append(0)
+            self.streaks.append(0)
+            self.latency.append(0.0)
+            self.alive.append(1)
+            self.in_use.append(0)
+        self._ids[host] = pid
+        return pid
+
+    def remove(self, pid):
+        """
+        删除代理，id 之后可被复用
+        :param pid:
+        :return:
+        """
+        host = self.hosts[pid]
+        if host is None:
+            return
+        self._ids.pop(host, None)
+        self.hosts[pid] = None
+        self.alive[pid] = 0
+        self.in_use[pid] = 0
+        self._free.append(pid)
+
+    def ban(self, host):
+        """
+        加入黑名单并删除
+        :param host:
+        :return:
+        """
+        if not host:
+            return
+        self.blacklist.add(host)
+        pid = self._ids.get(host)
+        if pid is not None:
+            self.remove(pid)
+
+    def id_of(self, host):
+        return self._ids.get(host)
+
+    def get(self, pid):
+        """
+        返回 (代理类型, host:port)
+        :param pid:
+        :return:
+        """
+        return PROXY_TYPES[self.types[pid]], self.hosts[pid]
+
+    def acquire(self, pid):
+        self.in_use[pid] = 1
+        self.uses[pid] += 1
+
+    def release(self, pid, success=True, elapsed=None):
+        """
+        归还代理并记录本次使用结果；失败的代理连续失败次数过多或得分过低时删除
+        :param pid:
+        :param success: None 表示请求被取消，不记录结果
+        :param elapsed: 本次请求耗时，失败时为到失败为止的耗时
+        :return: 代理是否被删除
+        """
+        if self.hosts[pid] is None:
+            return False
+        self.in_use[pid] = 0
+        if success is None:
+            return False
+        if elapsed is not None:
+            if self.latency[pid] == 0:
+                self.latency[pid] = elapsed
+            else:
+                self.latency[pid] = self.alpha * elapsed + (1 - self.alpha) * self.latency[pid]
+        if success:
+            self.successes[pid] += 1
+            self.streaks[pid] = 0
+            return False
+        self.failures[pid] += 1
+        self.streaks[pid] += 1
+        if (self.max_failures and self.streaks[pid] >= self.max_failures) or \
+                (self.min_score and self.score(pid) < self.min_score):
+            self.remove(pid)
+            return True
+        return False
+
+    def score(self, pid):
+        """
+        单个代理的得分，与 scores 的计算方法相同，不考虑是否可用
+        :param pid:
+        :return:
+        """
+        s, f = self.successes[pid], self.failures[pid]
+        return (s + 1.0) / (s + f + 2) / (1 + self.latency[pid])
+
+    def available_count(self):
+        if np is not None and self.hosts:
+            return int(np.count_nonzero(self._mask()))
+        return sum(1 for a, u in zip(self.alive, self.in_use) if a and not u)
+
+    def _mask(self):
+        # np.frombuffer 直接引用 array 的内存，不复制
+        alive = np.frombuffer(self.alive, dtype=np.uint8)
+        in_use = np.frombuffer(self.in_use, dtype=np.uint8)
+        return (alive == 1) & (in_use == 0)
+
+    def scores(self):
+        """
+        返回所有代理的得分，不可用的代理得分为 0
+        得分 = 成功率(拉普拉斯平滑) / (1 + 平均耗时)
+        :return:
+        """
+        if np is not None:
+            successes = np.frombuffer(self.successes, dtype=np.uint32).astype(np.float64)
+            failures = np.frombuffer(self.failures, dtype=np.uint32)
+            latency = np.frombuffer(self.latency, dtype=np.float64)
+            scores = (successes + 1) / (successes + failures + 2) / (1 + latency)
+            scores[~self._mask()] = 0
+            return scores
+        return [(s + 1.0) / (s + f + 2) / (1 + l) if a and not u else 0.0
+                for s, f, l, a, u in zip(self.successes, self.failures, self.latency, self.alive, self.in_use)]
+
+    def select(self):
+        """
+        按得分加权随机选择一个可用代理
+        :return: 代理 id，没有可用代理时返回 None
+        """
+        if not self.hosts:
+            return None
+        scores = self.scores()
+        if np is not None:
+            cumulative = np.cumsum(scores)
+            total = cumulative[-1]
+            if total <= 0:
+                return None
+            return int(np.searchsorted(cumulative, random.random() * total, side="right"))
+        total = sum(scores)
+        if total <= 0:
+            return None
+        return random.choices(range(len(scores)), weights=scores)[0]
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+# @Project Name : spider
+"""
+文件名：replay.py
+功能：录制和回放下载；
+　　　record 模式下把请求和响应（返回码、响应头、内容、耗时）写入本地 WARC 归档，
+      replay 模式下 Downloader.download 不访问网络，直接从归档返回响应，
+      可按录制时的耗时乘以速度系数等待，用于在无网络的机器上重复测量抽取和流水线性能
+　　　请求 key：method + 完整 url(包含 params) + body md5
+"""
+
+import json
+import time
+import hashlib
+import datetime
+
+import gevent
+
+import setting
+import metrics
+import archive
+
+_sleep = gevent.sleep if setting.CRAWLER_MODE == "gevent" else time.sleep
+
+
+def request_key(key):
+    """
+    请求 key 转为归档索引 key
+    :param key: Downloader._replay_key 返回的元组
+    :return:
+    """
+    return hashlib.sha1("\t".join(str(part or "") for part in key).encode("utf-8")).hexdigest()
+
+
+class Recorder:
+    """
+    录制
+    """
+
+    def __init__(self, replay_dir=setting.REPLAY_DIR):
+        self.writer = archive.ArchiveWriter(replay_dir, prefix="record")
+
+    def record(self, key, response, elapsed):
+        """
+        录制一次下载，每条记录立即写入磁盘
+        :param key: Downloader._replay_key 返回的元组
+        :param response:
+        :param elapsed: 下载耗时(秒)
+        :return:
+        """
+        request = getattr(response, "request", None)
+        request_headers = dict(request.headers) if request is not None else {}
+        self.writer.write_response(response, key=request_key(key), warc_headers={
+            "X-Spider-Method": key[0],
+            "X-Spider-Request-Body-MD5": key[2],
+            "X-Spider-Request-Headers": json.dumps(request_headers, ensure_ascii=False),
+            "X-Spider-Elapsed": "{:.6f}".format(elapsed),
+        })
+        self.writer.flush()
+        metrics.incr("replay.recorded")
+
+
+class Replayer:
+    """
+    回放
+    """
+
+    def __init__(self, replay_dir=setting.REPLAY_DIR, speed=setting.REPLAY_SPEED):
+        """
+
+        :param replay_dir: 录制目录
+        :param speed: 速度系数，按 录制耗时 / speed 等待；0 表示不等待
+        """
+        self.reader = archive.ArchiveReader(replay_dir)
+        self.speed = speed
+
+    def replay(self, key):
+        """
+        返回录制的响应，没有录制时返回 None（与下载失败相同）
+        :param key: Downloader._replay_key 返回的元组
+        :return:
+        """
+        record = self.reader.get(request_key(key)) if key is not None else None
+        if record is None:
+            metrics.incr("replay.miss")
+            return None
+        metrics.incr("replay.hit")
+        elapsed = float(record.warc.get("X-Spider-Elapsed", 0) or 0)
+        if self.speed > 0 and elapsed > 0:
+            _sleep(elapsed / self.speed)
+        response = record.to_response()
+        response.elapsed = datetime.timedelta(seconds=elapsed)
+        return response
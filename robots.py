@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+# @Project Name : spider
+"""
+文件名：robots.py
+功能：robots.txt 缓存；
+　　　目前实现的功能有：
+　　　　　按 host 下载 robots.txt，按 TTL 缓存，缓存数目有上限(LRU)
+      规则预编译：不含通配符的规则用前缀比较，含 * 和 $ 的规则编译为正则
+      匹配规则：最长匹配优先，长度相同时 Allow 优先
+      robots.txt 返回 4xx 时全部允许，5xx、下载失败或熔断中时暂时全部禁止
+      作为 frontier 过滤函数，请求入队前检查；请求 meta 中 ignore_robots 为真时不检查；
+          robots.txt 暂时无法获取时请求按 host 暂存，重新获取成功后放回 frontier
+      记录 robots.txt 中的 Sitemap 和 Crawl-delay
+"""
+
+import re
+import time
+from collections import OrderedDict
+from urllib.parse import urlsplit
+
+import gevent
+
+import log
+import setting
+import metrics
+import frontier
+
+# robots.txt User-agent 的产品标识
+PRODUCT_TOKEN = re.compile(r"[a-z0-9_-]+")
+
+
+class RobotsRules:
+    """
+    一个 host 的 robots.txt 规则
+    """
+
+    __slots__ = ("rules", "crawl_delay", "sitemaps", "allow_all", "disallow_all", "transient")
+
+    def __init__(self, rules=None, crawl_delay=None, sitemaps=None, allow_all=False, disallow_all=False,
+                 transient=False):
+        """
+
+        :param rules: [(规则长度, 是否允许, 前缀或正则)]，已按长度从长到短排序
+        :param crawl_delay:
+        :param sitemaps:
+        :param allow_all:
+        :param disallow_all:
+        :param transient: robots.txt 暂时无法获取，规则只是临时的
+        """
+        self.rules = rules or []
+        self.crawl_delay = crawl_delay
+        self.sitemaps = sitemaps or []
+        self.allow_all = allow_all or not self.rules
+        self.disallow_all = disallow_all
+        self.transient = transient
+
+    @staticmethod
+    def _compile(path):
+        if "*" not in path and not path.endswith("$"):
+            return path
+        anchored = path.endswith("$")
+        pattern = re.escape(path[:-1] if anchored else path).replace(r"\*", ".*")
+        return re.compile(pattern + ("$" if anchored else ""))
+
+    @staticmethod
+    def _product_token(name):
+        """
+        返回名称中的产品标识（开头的字母、数字、_ 和 -，小写），如 MySpider/1.0 返回 myspider
+        :param name:
+        :return:
+        """
+        match = PRODUCT_TOKEN.match(name.strip().lower())
+        return match.group() if match else ""
+
+    @classmethod
+    def parse(cls, text, user_agent):
+        """
+        解析 robots.txt，使用产品标识与 user_agent 相同的分组，没有时使用 * 分组
+        :param text:
+        :param user_agent: 爬虫名称，按产品标识比较，不区分大小写
+        :return:
+        """
+        token = cls._product_token(user_agent)
+        groups = {}
+        agents, in_rules = [], False
+        crawl_delays, sitemaps = {}, []
+        for line in text.splitlines():
+            line = line.split("#", 1)[0].strip()
+            if ":" not in line:
+                continue
+            field, value = line.split(":", 1)
+            field, value = field.strip().lower(), value.strip()
+            if field == "user-agent":
+                if in_rules:
+                    agents, in_rules = [], False
+                agents.append(value.lower())
+            elif field in ("allow", "disallow"):
+                in_rules = True
+                for agent in agents:
+                    groups.setdefault(agent, []).append((field == "allow", value))
+            elif field == "crawl-delay":
+                in_rules = True
+                for agent in agents:
+                    try:
+                        crawl_delays[agent] = float(value)
+                    except ValueError:
+                        pass
+            elif field == "sitemap" and value:
+                sitemaps.append(value)
+
+        # 按产品标识整体比较，spider 分组不匹配 myspider
+        agent = next((a for a in groups if token and a != "*" and cls._product_token(a) == token), "*")
+        rules = []
+        for allow, path in groups.get(agent, []):
+            # 空的 Disallow 表示允许全部
+            if not path:
+                continue
+            rules.append((len(path), allow, cls._compile(path)))
+        rules.sort(key=lambda rule: (-rule[0], not rule[1]))
+        return cls(rules, crawl_delays.get(agent), sitemaps)
+
+    def allowed(self, path):
+        """
+        :param path: url 的 path 和 query
+        :return:
+        """
+        if self.disallow_all:
+            return False
+        if self.allow_all:
+            return True
+        for _, allow, matcher in self.rules:
+            if matcher.__class__ is str:
+                if path.startswith(matcher):
+                    return allow
+            elif matcher.match(path):
+                return allow
+        return True
+
+
+class RobotsCache:
+    """
+    robots.txt 缓存
+    """
+
+    def __init__(self, downloader, ttl=setting.ROBOTS_TTL, user_agent=setting.ROBOTS_USER_AGENT,
+                 error_ttl=300, max_hosts=10000, max_deferred=10000):
+        """
+
+        :param downloader: 用于下载 robots.txt 的下载器
+        :param ttl: 缓存时间(秒)
+        :param user_agent: robots.txt 中匹配的爬虫名称
+        :param error_ttl: 下载失败时的缓存时间(秒)，也是重新获取暂存请求所在 host 的 robots.txt 的间隔
+        :param max_hosts: 最多缓存的 host 数目
+        :param max_deferred: 每个 host 最多暂存的请求数目
+        """
+        self.downloader = downloader
+        self.ttl = ttl
+        self.user_agent = user_agent
+        self.error_ttl = error_ttl
+        self.max_hosts = max_hosts
+        self.max_deferred = max_deferred
+        # (scheme, netloc) -> (过期时间, RobotsRules)
+        self._cache = OrderedDict()
+        # (scheme, netloc) -> robots.txt 暂时无法获取时暂存的请求
+        self._deferred = {}
+        self.frontier = None
+        self._greenlet = None
+
+    def _fetch(self, scheme, netloc):
+        url = "{}://{}/robots.txt".format(scheme, netloc)
+        response = self.downloader.download({"url": url, "meta": {"keep_status_code": True}})
+        if response is None:
+            metrics.incr("robots.error")
+            # host 熔断中时按熔断剩余时间重新获取
+            retry_after = self.downloader.retry_after(url)
+            ttl = min(self.error_ttl, max(retry_after, 1)) if retry_after else self.error_ttl
+            return RobotsRules(disallow_all=True, transient=True), ttl
+        if response.status_code >= 500:
+            metrics.incr("robots.error")
+            return RobotsRules(disallow_all=True, transient=True), self.error_ttl
+        if response.status_code >= 400:
+            return RobotsRules(allow_all=True), self.ttl
+        try:
+            return RobotsRules.parse(response.text, self.user_agent), self.ttl
+        except Exception as e:
+            log.logger.warning("解析 robots.txt 失败 {} {}".format(url, e))
+            return RobotsRules(allow_all=True), self.error_ttl
+
+    @staticmethod
+    def _key(url):
+        parts = urlsplit(url)
+        return parts.scheme.lower(), parts.netloc.lower()
+
+    def rules_for(self, url):
+        """
+        返回 url 所在 host 的规则，缓存过期时重新下载
+        :param url:
+        :return:
+        """
+        key = self._key(url)
+        entry = self._cache.get(key)
+        if entry is not None and entry[0] > time.time():
+            self._cache.move_to_end(key)
+            metrics.incr("robots.hit")
+            return entry[1]
+        metrics.incr("robots.miss")
+        rules, ttl = self._fetch(*key)
+        self._cache[key] = (time.time() + ttl, rules)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_hosts:
+            self._cache.popitem(last=False)
+        return rules
+
+    def allowed(self, url):
+        parts = urlsplit(url)
+        path = parts.path or "/"
+        if parts.query:
+            path = "{}?{}".format(path, parts.query)
+        return self.rules_for(url).allowed(path)
+
+    def frontier_filter(self, request):
+        """
+        frontier 过滤函数，用法：robots_cache.install(frontier)；
+        只调用 frontier.add_filter(robots_cache.frontier_filter) 时暂存的请求需要调用方自己放回
+        :param request:
+        :return:
+        """
+        if isinstance(request, dict) and (request.get("meta") or {}).get("ignore_robots"):
+            return True
+        url = frontier.request_url(request)
+        if self.allowed(url):
+            return True
+        if self.rules_for(url).transient:
+            # robots.txt 暂时无法获取，暂存请求，不丢弃
+            self._defer(url, request)
+            return False
+        metrics.incr("robots.disallowed")
+        return False
+
+    def _defer(self, url, request):
+        deferred = self._deferred.setdefault(self._key(url), [])
+        if len(deferred) >= self.max_deferred:
+            metrics.incr("robots.deferred_dropped")
+            return
+        deferred.append(request)
+        metrics.incr("robots.deferred")
+
+    def retry_deferred(self):
+        """
+        重新获取暂存请求所在 host 的 robots.txt（缓存未过期时不下载），获取成功后把请求放回 frontier
+        :return: 放回 frontier 的请求数目
+        """
+        released = 0
+        for key in list(self._deferred):
+            if self.rules_for("{}://{}/".format(*key)).transient:
+                continue
+            requests_list = self._deferred.pop(key)
+            if self.frontier is not None:
+                # 放回时重新经过过滤函数，不允许抓取的请求被过滤
+                released += len(self.frontier.push_many(requests_list))
+        if released:
+            metrics.incr("robots.released", released)
+        return released
+
+    def _run(self):
+        while True:
+            gevent.sleep(max(min(self.error_ttl, 60), 1))
+            try:
+                self.retry_deferred()
+            except Exception as e:
+                log.logger.warning("重新获取 robots.txt 失败 {}".format(e))
+
+    def install(self, frontier_obj):
+        """
+        作为 frontier 的过滤函数，暂存的请求定时放回该 frontier
+        :param frontier_obj:
+        :return:
+        """
+        self.frontier = frontier_obj
+        frontier_obj.add_filter(self.frontier_filter)
+        if self._greenlet is None:
+            self._greenlet = gevent.spawn(self._run)
+
+    def stop(self):
+        if self._greenlet is not None:
+            self._greenlet.kill()
+            self._greenlet = None
+
+    def sitemaps(self, url):
+        """
+        返回 robots.txt 中声明的 sitemap
+        :param url: 该 host 的任意 url
+        :return:
+        """
+        return self.rules_for(url).sitemaps
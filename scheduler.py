@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+# @Project Name : spider
+"""
+文件名：scheduler.py
+功能：多任务公平调度；
+　　　多个任务配置同时运行，共用 list / detail worker 池，一个大任务不再阻塞其它小任务，
+　　　目前实现的功能有：
+　　　　　加权公平队列：每个任务按 priority 作为权重，每次调度选择虚拟完成时间最小的任务，
+          权重为 2 的任务得到的 worker 时间约为权重 1 的两倍
+      截止时间：离 deadline 不足 urgent_window 秒的任务优先调度(按截止时间先后)
+      每个任务的限制：同时进行的请求数、对同一 host 的并发连接数；
+          每个请求下载时最多占用一个代理，同时使用的代理数由同时进行的请求数限制；
+          队首请求受限时向后查找（最多 scan_limit 个）可以调度的请求，一个受限的 host 不阻塞整个任务
+      任务的请求全部完成后按 repeat_times 重新开始下一轮，全部轮次完成后回调 on_finished
+使用 gevent 事件等待，只在 crawler_mode = gevent 时使用
+"""
+
+import time
+from collections import deque, defaultdict
+
+import gevent
+import gevent.event
+
+import log
+import setting
+import metrics
+import frontier
+
+
+class TaskState:
+    """
+    一个任务配置的调度状态
+    """
+
+    __slots__ = ("task", "config_id", "weight", "deadline", "repeat_times", "round", "queue",
+                 "in_flight", "hosts", "finish_tag", "max_in_flight", "max_host_connections", "scan_limit")
+
+    def __init__(self, task, max_in_flight, max_host_connections, scan_limit=64):
+        self.task = task
+        self.config_id = str(task.get("config_id") or task.get("id") or id(task))
+        self.weight = max(float(task.get("priority") or 1), 0.01)
+        self.deadline = float(task.get("deadline") or 0)
+        try:
+            self.repeat_times = max(int(task.get("repeat_times") or 1), 1)
+        except (TypeError, ValueError):
+            self.repeat_times = 1
+        self.round = 0
+        self.queue = deque()
+        self.in_flight = 0
+        # host -> 正在进行的请求数
+        self.hosts = defaultdict(int)
+        # 加权公平队列的虚拟完成时间
+        self.finish_tag = 0.0
+        self.max_in_flight = int(task.get("max_in_flight") or max_in_flight)
+        self.max_host_connections = int(task.get("max_host_connections") or max_host_connections)
+        # 查找可调度请求时最多查看的请求数目
+        self.scan_limit = scan_limit
+
+    @staticmethod
+    def _host(request):
+        url = frontier.request_url(request) or ""
+        return url.split("/", 3)[2] if "://" in url else ""
+
+    def _allowed(self, request):
+        if self.max_host_connections and self.hosts.get(self._host(request), 0) >= self.max_host_connections:
+            return False
+        return True
+
+    def eligible(self):
+        """
+        返回可以调度的请求在队列中的位置，没有时返回 None
+        :return:
+        """
+        if not self.queue:
+            return None
+        if self.max_in_flight and self.in_flight >= self.max_in_flight:
+            return None
+        for i, request in enumerate(self.queue):
+            if i >= self.scan_limit:
+                break
+            if self._allowed(request):
+                return i
+        return None
+
+    def acquire(self, index=0):
+        if index:
+            request = self.queue[index]
+            del self.queue[index]
+        else:
+            request = self.queue.popleft()
+        self.in_flight += 1
+        self.hosts[self._host(request)] += 1
+        return request
+
+    def release(self, request):
+        self.in_flight -= 1
+        host = self._host(request)
+        self.hosts[host] -= 1
+        if self.hosts[host] <= 0:
+            del self.hosts[host]
+
+    @property
+    def idle(self):
+        return not self.queue and self.in_flight == 0
+
+
+class FairScheduler:
+    """
+    加权公平调度器
+    """
+
+    def __init__(self, on_start=None, on_finished=None, max_in_flight=setting.TASK_MAX_IN_FLIGHT,
+                 max_host_connections=setting.TASK_MAX_HOST_CONNECTIONS,
+                 urgent_window=60):
+        """
+
+        :param on_start: func(任务, 轮次) 每一轮开始时调用，返回该轮的初始请求（如列表页）
+        :param on_finished: func(任务) 全部轮次完成后调用，如发送抓取结果
+        :param max_in_flight: 每个任务同时进行的请求数上限，0 表示不限制；也是同时使用的代理数上限
+        :param max_host_connections: 每个任务对同一 host 的并发连接数上限，0 表示不限制
+        :param urgent_window: 离截止时间不足该值(秒)时优先调度
+        """
+        self.on_start = on_start
+        self.on_finished = on_finished
+        self.max_in_flight = max_in_flight
+        self.max_host_connections = max_host_connections
+        self.urgent_window = urgent_window
+        # config_id -> TaskState
+        self.tasks = {}
+        self.virtual_time = 0.0
+        self._ready = gevent.event.Event()
+
+    def add_task(self, task):
+        """
+        加入任务配置，开始第一轮；任务数据错误或 on_start 异常时抛出异常，任务不加入
+        :param task:
+        :return: TaskState
+        """
+        state = TaskState(task, self.max_in_flight, self.max_host_connections)
+        if state.config_id in self.tasks:
+            return self.tasks[state.config_id]
+        # 新任务从当前虚拟时间开始，不会因为之前没有运行而积累额度
+        state.finish_tag = self.virtual_time
+        self.tasks[state.config_id] = state
+        try:
+            self._start_round(state)
+        except Exception:
+            self.tasks.pop(state.config_id, None)
+            raise
+        return state
+
+    def _start_round(self, state):
+        state.round += 1
+        requests = self.on_start(state.task, state.round) if self.on_start is not None else None
+        if requests:
+            self.submit(state.config_id, *requests)
+        elif state.idle:
+            self._round_done(state)
+
+    def _round_done(self, state):
+        if state.round < state.repeat_times:
+            self._start_round(state)
+            return
+        self.tasks.pop(state.config_id, None)
+        metrics.incr("scheduler.finished")
+        if self.on_finished is not None:
+            try:
+                self.on_finished(state.task)
+            except Exception as e:
+                log.logger.exception(e)
+
+    def submit(self, config_id, *requests):
+        """
+        加入任务的请求（列表页解析出的详情页等）；
+        请求的 meta 中加入 config_id，下载统计按任务区分，url 字符串转为请求字典
+        :param config_id:
+        :param requests:
+        :return:
+        """
+        state = self.tasks.get(str(config_id))
+        if state is None:
+            return False
+        if not requests:
+            return True
+        if not state.queue:
+            # 队列为空期间不积累额度，重新有请求时从当前虚拟时间开始
+            state.finish_tag = max(state.finish_tag, self.virtual_time)
+        for request in requests:
+            if not isinstance(request, dict):
+                request = {"url": request}
+            meta = request.get("meta") or {}
+            if meta.get("config_id") != state.config_id:
+                request = dict(request, meta=dict(meta, config_id=state.config_id))
+            state.queue.append(request)
+        self._ready.set()
+        return True
+
+    def _pick(self):
+        """
+        选择下一个调度的任务
+        :return: (请求在队列中的位置, TaskState)，没有可调度的任务时返回 (None, None)
+        """
+        now = time.time()
+        best, urgent = None, None
+        for state in self.tasks.values():
+            index = state.eligible()
+            if index is None:
+                continue
+            if state.deadline and state.deadline - now < self.urgent_window:
+                if urgent is None or state.deadline < urgent[1].deadline:
+                    urgent = (index, state)
+            tag = state.finish_tag + 1.0 / state.weight
+            if best is None or tag < best[0]:
+                best = (tag, index, state)
+        if urgent is not None:
+            return urgent
+        return best[1:] if best is not None else (None, None)
+
+    def next(self, timeout=None):
+        """
+        取出下一个请求
+        :param timeout:
+        :return: (TaskState, 请求)，超时返回 (None, None)
+        """
+        deadline = time.time() + timeout if timeout is not None else None
+        while True:
+            index, state = self._pick()
+            if state is not None:
+                start_tag = state.finish_tag
+                state.finish_tag = start_tag + 1.0 / state.weight
+                self.virtual_time = max(self.virtual_time, start_tag)
+                return state, state.acquire(index)
+            self._ready.clear()
+            remaining = deadline - time.time() if deadline is not None else None
+            if remaining is not None and remaining <= 0:
+                return None, None
+            self._ready.wait(remaining)
+
+    def done(self, state, request):
+        """
+        请求处理完成
+        :param state:
+        :param request:
+        :return:
+        """
+        state.release(request)
+        self._ready.set()
+        if state.idle and state.config_id in self.tasks:
+            self._round_done(state)
+
+    def run_one(self, handler, timeout=1):
+        """
+        worker 池的 target：取出一个请求并调用 handler(任务, 请求)
+        用法：concurrency.create_pool("detail", lambda: scheduler.run_one(handle_request))
+        :param handler: 返回是否成功
+        :param timeout:
+        :return: handler 的返回值，没有请求时返回 None
+        """
+        state, request = self.next(timeout)
+        if state is None:
+            return None
+        try:
+            return bool(handler(state.task, request))
+        finally:
+            self.done(state, request)
+
+    def pump(self, client, max_tasks=setting.TASK_PREFETCH_NUM):
+        """
+        从调度服务持续获取任务，同时运行的任务数不超过 max_tasks
+        :param client: dispatcher.DispatcherClient
+        :param max_tasks:
+        :return: 协程
+        """
+        def loop():
+            while True:
+                if len(self.tasks) >= max(max_tasks, 1):
+                    gevent.sleep(1)
+                    continue
+                task = client.get_task(timeout=5)
+                if not task:
+                    continue
+                try:
+                    self.add_task(task)
+                except Exception as e:
+                    # 任务数据错误（如 priority 不是数字）或 on_start 异常只影响该任务
+                    log.logger.exception("加入任务失败 {} {}".format(task, e))
+
+        return gevent.spawn(loop)
+
+    def snapshot(self):
+        """
+        各任务的调度状态
+        :return:
+        """
+        data = {config_id: {"queued": len(s.queue), "in_flight": s.in_flight, "round": s.round,
+                            "weight": s.weight, "deadline": s.deadline}
+                for config_id, s in self.tasks.items()}
+        metrics.gauge("scheduler.tasks", len(data))
+        return data
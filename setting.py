@@ -24,6 +24,42 @@ CRAWLER_MODE = config.get("threading", "crawler_mode")
 LIST_PAGE_THREAD_NUM = config.getint("threading", "list_page_thread_num")
 DETAIL_PAGE_THREAD_NUM = config.getint("threading", "detail_page_threading_num")
 DATA_QUEUE_THREAD_NUM = config.getint("threading", "data_queue_thread_num")
+try:
+    ADAPTIVE_CONCURRENCY = config.get_boolean("threading", "adaptive_concurrency")
+except:
+    ADAPTIVE_CONCURRENCY = False
+try:
+    LIST_PAGE_THREAD_MIN = config.getint("threading", "list_page_thread_min")
+except:
+    LIST_PAGE_THREAD_MIN = 1
+try:
+    LIST_PAGE_THREAD_MAX = config.getint("threading", "list_page_thread_max")
+except:
+    LIST_PAGE_THREAD_MAX = LIST_PAGE_THREAD_NUM * 4
+try:
+    DETAIL_PAGE_THREAD_MIN = config.getint("threading", "detail_page_thread_min")
+except:
+    DETAIL_PAGE_THREAD_MIN = 1
+try:
+    DETAIL_PAGE_THREAD_MAX = config.getint("threading", "detail_page_thread_max")
+except:
+    DETAIL_PAGE_THREAD_MAX = DETAIL_PAGE_THREAD_NUM * 4
+try:
+    DATA_QUEUE_THREAD_MIN = config.getint("threading", "data_queue_thread_min")
+except:
+    DATA_QUEUE_THREAD_MIN = 1
+try:
+    DATA_QUEUE_THREAD_MAX = config.getint("threading", "data_queue_thread_max")
+except:
+    DATA_QUEUE_THREAD_MAX = DATA_QUEUE_THREAD_NUM * 4
+try:
+    CONCURRENCY_MAX_CPU = config.getfloat("threading", "concurrency_max_cpu")
+except:
+    CONCURRENCY_MAX_CPU = 0.9
+try:
+    CONCURRENCY_MAX_ERROR_RATE = config.getfloat("threading", "concurrency_max_error_rate")
+except:
+    CONCURRENCY_MAX_ERROR_RATE = 0.2
 
 try:
     RESTART_TIME = config.get("threading", "restart_time")
@@ -34,6 +70,10 @@ except:
     config.set("threading", "restart_time", RESTART_TIME)
     with open(config_file, "w") as f:
         config.write(f)
+try:
+    HUB_BLOCK_THRESHOLD = config.getfloat("threading", "hub_block_threshold")
+except:
+    HUB_BLOCK_THRESHOLD = 0.5
 
 # http
 try:
@@ -47,10 +87,138 @@ UESR_AGENT = config.get("http", "user_agent")
 COMPRESSION = config.get_boolean("http", "compression")
 HTTP_TIMEOUT = config.getint("http", "timeout")
 COOKIE_ENABLE = config.get_boolean("http", "cookie_enable")
+try:
+    COOKIE_JAR_MAX = config.getint("http", "cookie_jar_max")
+except:
+    COOKIE_JAR_MAX = 1000
+try:
+    COOKIE_JAR_DIR = config.get("http", "cookie_jar_dir")
+except:
+    COOKIE_JAR_DIR = ""
+try:
+    COOKIE_STICKY_PROXY = config.get_boolean("http", "cookie_sticky_proxy")
+except:
+    COOKIE_STICKY_PROXY = False
+try:
+    PROXY_POOL_SOCKET = config.get("http", "proxy_pool_socket")
+except:
+    PROXY_POOL_SOCKET = ""
+try:
+    PROXY_RELOAD_INTERVAL = config.getfloat("http", "proxy_reload_interval")
+except:
+    PROXY_RELOAD_INTERVAL = 10
+try:
+    PROXY_MAX_FAILURES = config.getint("http", "proxy_max_failures")
+except:
+    PROXY_MAX_FAILURES = 3
+try:
+    HTTP_CACHE_ENABLE = config.get_boolean("http", "http_cache_enable")
+except:
+    HTTP_CACHE_ENABLE = False
+try:
+    HTTP_CACHE_DIR = config.get("http", "http_cache_dir")
+except:
+    HTTP_CACHE_DIR = ""
+HTTP_CACHE_DIR = HTTP_CACHE_DIR or os.path.join(os.path.dirname(__file__), "http_cache")
+try:
+    HTTP_CACHE_MAX_SIZE = config.getint("http", "http_cache_max_size") * 1024 * 1024
+except:
+    HTTP_CACHE_MAX_SIZE = 256 * 1024 * 1024
+try:
+    ARCHIVE_ENABLE = config.get_boolean("http", "archive_enable")
+except:
+    ARCHIVE_ENABLE = False
+try:
+    ARCHIVE_DIR = config.get("http", "archive_dir")
+except:
+    ARCHIVE_DIR = ""
+ARCHIVE_DIR = ARCHIVE_DIR or os.path.join(os.path.dirname(__file__), "archive")
+try:
+    ARCHIVE_SEGMENT_SIZE = config.getint("http", "archive_segment_size") * 1024 * 1024
+except:
+    ARCHIVE_SEGMENT_SIZE = 1024 * 1024 * 1024
+try:
+    REPLAY_MODE = config.get("http", "replay_mode").strip()
+except:
+    REPLAY_MODE = ""
+try:
+    REPLAY_DIR = config.get("http", "replay_dir")
+except:
+    REPLAY_DIR = ""
+REPLAY_DIR = REPLAY_DIR or os.path.join(os.path.dirname(__file__), "replay")
+try:
+    REPLAY_SPEED = config.getfloat("http", "replay_speed")
+except:
+    REPLAY_SPEED = 1.0
+try:
+    DNS_CACHE_ENABLE = config.get_boolean("http", "dns_cache_enable")
+except:
+    DNS_CACHE_ENABLE = False
+try:
+    DNS_CACHE_TTL = config.getint("http", "dns_cache_ttl")
+except:
+    DNS_CACHE_TTL = 300
+try:
+    DNS_NEGATIVE_TTL = config.getint("http", "dns_negative_ttl")
+except:
+    DNS_NEGATIVE_TTL = 30
+try:
+    HTTP2_ENABLE = config.get_boolean("http", "http2_enable")
+except:
+    HTTP2_ENABLE = False
+try:
+    HTTP2_MAX_CONNECTIONS = config.getint("http", "http2_max_connections")
+except:
+    HTTP2_MAX_CONNECTIONS = 2
+try:
+    HEDGE_ENABLE = config.get_boolean("http", "hedge_enable")
+except:
+    HEDGE_ENABLE = False
+try:
+    HEDGE_RATIO = config.getfloat("http", "hedge_ratio")
+except:
+    HEDGE_RATIO = 0.05
+try:
+    BREAKER_ENABLE = config.get_boolean("http", "breaker_enable")
+except:
+    BREAKER_ENABLE = True
+try:
+    HOST_BREAKER_THRESHOLD = config.getint("http", "host_breaker_threshold")
+except:
+    HOST_BREAKER_THRESHOLD = 10
+try:
+    PROXY_BREAKER_THRESHOLD = config.getint("http", "proxy_breaker_threshold")
+except:
+    PROXY_BREAKER_THRESHOLD = 3
+try:
+    BREAKER_COOL_DOWN = config.getint("http", "breaker_cool_down")
+except:
+    BREAKER_COOL_DOWN = 60
+try:
+    SINGLE_FLIGHT_ENABLE = config.get_boolean("http", "single_flight_enable")
+except:
+    SINGLE_FLIGHT_ENABLE = True
+try:
+    ROBOTS_ENABLE = config.get_boolean("http", "robots_enable")
+except:
+    ROBOTS_ENABLE = False
+try:
+    ROBOTS_TTL = config.getint("http", "robots_ttl")
+except:
+    ROBOTS_TTL = 86400
+try:
+    ROBOTS_USER_AGENT = config.get("http", "robots_user_agent").strip() or "spider"
+except:
+    ROBOTS_USER_AGENT = "spider"
 
 # spider
 SPIDER_ID = config.get("spider", "spider_id")
 EXIT_TIMEOUT = config.getint("spider", "exit_timeout")
+try:
+    CHECKPOINT_DIR = config.get("spider", "checkpoint_dir")
+except:
+    CHECKPOINT_DIR = ""
+CHECKPOINT_DIR = CHECKPOINT_DIR or os.path.join(os.path.dirname(__file__), "checkpoint")
 LIST_DETAIL_INTERVAL = config.getint("spider", "list_detail_interval")
 DATA_ENCODING = config.get("spider", "data_encoding")
 REPEAT_TIMES = config.get("spider", "show_data")
@@ -63,6 +231,18 @@ try:
     CONFIG_MONITOR = config.get_boolean("spider", "config_monitor")
 except:
     CONFIG_MONITOR = False
+try:
+    INCREMENTAL_ENABLE = config.get_boolean("spider", "incremental_enable")
+except:
+    INCREMENTAL_ENABLE = False
+try:
+    LIST_MIN_INTERVAL = config.getint("spider", "list_min_interval")
+except:
+    LIST_MIN_INTERVAL = 60
+try:
+    LIST_MAX_INTERVAL = config.getint("spider", "list_max_interval")
+except:
+    LIST_MAX_INTERVAL = 3600
 
 # dispatch
 DEFAULT_DISPATCH_HOST = os.getenv("dispatch_host", "").strip()
@@ -91,6 +271,58 @@ else:
     SEND_CRAWL_RESULT_TO = config.get('spider', 'send_crawl_result_to')
     GET_SPIDER_PARAM_FROM = config.get('spider', 'get_spider_param_from')
     GET_CONFIG_CONTENT_FROM = ""
+try:
+    TASK_BATCH_SIZE = config.getint("spider", "task_batch_size")
+except:
+    TASK_BATCH_SIZE = 1
+try:
+    TASK_PREFETCH_NUM = config.getint("spider", "task_prefetch_num")
+except:
+    TASK_PREFETCH_NUM = TASK_BATCH_SIZE
+try:
+    TASK_LONG_POLL = config.getint("spider", "task_long_poll")
+except:
+    TASK_LONG_POLL = 0
+try:
+    HEARTBEAT_INTERVAL = config.getint("spider", "heartbeat_interval")
+except:
+    HEARTBEAT_INTERVAL = 30
+try:
+    SHARDING_ENABLE = config.get_boolean("spider", "sharding_enable")
+except:
+    SHARDING_ENABLE = False
+try:
+    SHARD_BATCH_SIZE = config.getint("spider", "shard_batch_size")
+except:
+    SHARD_BATCH_SIZE = 100
+try:
+    SHARD_FLUSH_INTERVAL = config.getfloat("spider", "shard_flush_interval")
+except:
+    SHARD_FLUSH_INTERVAL = 1
+try:
+    TASK_MAX_IN_FLIGHT = config.getint("spider", "task_max_in_flight")
+except:
+    TASK_MAX_IN_FLIGHT = 20
+try:
+    TASK_MAX_HOST_CONNECTIONS = config.getint("spider", "task_max_host_connections")
+except:
+    TASK_MAX_HOST_CONNECTIONS = 8
+try:
+    PROFILER_PORT = config.getint("spider", "profiler_port")
+except:
+    PROFILER_PORT = 0
+try:
+    SLOW_REQUEST_THRESHOLD = config.getfloat("spider", "slow_request_threshold")
+except:
+    SLOW_REQUEST_THRESHOLD = 10
+try:
+    HOT_LOG_BURST = config.getint("spider", "hot_log_burst")
+except:
+    HOT_LOG_BURST = 5
+try:
+    HOT_LOG_INTERVAL = config.getint("spider", "hot_log_interval")
+except:
+    HOT_LOG_INTERVAL = 60
 
 # dedup
 DEDUP_URI = config.get('dedup', 'dedup_uri')
@@ -0,0 +1,343 @@
+# -*- coding: utf-8 -*-
+# @Project Name : spider
+"""
+文件名：sharding.py
+功能：多节点分布式 frontier；
+　　　按 host 一致性哈希把详情页请求分配到爬虫节点，同一个 host 只在一个节点上抓取，
+　　　目前实现的功能有：
+　　　　　一致性哈希环，每个节点若干虚拟节点，节点增减时只有少量 host 迁移
+      哈希环只包含 redis(crawler_list_data) 中在线记录未过期的节点，调度服务心跳返回的 nodes 只用于过滤
+      其它节点的请求按节点分批转发到 redis 列表 spider_shard:<节点>，各节点定时批量取回
+      节点变化时重新分配本地队列中不再属于本节点的请求，离开节点的转发列表由其新的所属节点取回并重新分配
+      未安装 redis 或未配置 crawler_list_data 时所有请求留在本地
+"""
+
+import json
+import time
+import bisect
+import hashlib
+from collections import defaultdict
+from urllib.parse import urlsplit
+
+import gevent
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+import log
+import setting
+import metrics
+import frontier as frontier_module
+
+NODES_KEY = "spider_nodes"
+SHARD_KEY = "spider_shard:{}"
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+
+class HashRing:
+    """
+    一致性哈希环
+    """
+
+    def __init__(self, nodes=(), replicas=64):
+        """
+
+        :param nodes: 节点列表
+        :param replicas: 每个节点的虚拟节点数目
+        """
+        self.replicas = replicas
+        self.nodes = set()
+        self._hashes = []
+        self._owners = []
+        self.update(nodes)
+
+    def update(self, nodes):
+        """
+        重建哈希环
+        :param nodes:
+        :return: 节点是否有变化
+        """
+        nodes = set(node for node in nodes if node)
+        if nodes == self.nodes:
+            return False
+        points = sorted((_hash("{}#{}".format(node, i)), node) for node in nodes for i in range(self.replicas))
+        self._hashes = [h for h, _ in points]
+        self._owners = [node for _, node in points]
+        self.nodes = nodes
+        return True
+
+    def owner(self, key):
+        """
+        返回 key 所属节点，没有节点时返回 None
+        :param key:
+        :return:
+        """
+        if not self._hashes:
+            return None
+        i = bisect.bisect(self._hashes, _hash(key))
+        return self._owners[i % len(self._owners)]
+
+
+class ShardedFrontier:
+    """
+    分布式 frontier，接口与 frontier.Frontier 相同，本节点的请求放入本地 frontier
+    """
+
+    def __init__(self, local, node_id=setting.SPIDER_ID, redis_url=setting.CRAWLER_LIST_DATA,
+                 batch_size=setting.SHARD_BATCH_SIZE, flush_interval=setting.SHARD_FLUSH_INTERVAL,
+                 node_ttl=setting.HEARTBEAT_INTERVAL * 3):
+        """
+
+        :param local: 本地 frontier.Frontier
+        :param node_id: 本节点 id，应与调度服务返回的节点 id 一致
+        :param redis_url: 转发请求使用的 redis
+        :param batch_size: 每个节点累计多少请求后转发
+        :param flush_interval: 转发和取回的间隔(秒)
+        :param node_ttl: 节点在线记录超过该时间(秒)未更新时认为节点已离开
+        """
+        self.local = local
+        self.node_id = node_id
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.node_ttl = node_ttl
+        self.ring = HashRing([node_id])
+        # 调度服务返回的节点，为空时不过滤
+        self._dispatcher_nodes = set()
+        # redis 中在线的节点
+        self._redis_nodes = set()
+        # 节点 -> 待转发请求
+        self._outbox = defaultdict(list)
+        self._redis = None
+        if redis_url and redis is not None:
+            self._redis = redis.from_url(redis_url)
+        elif redis_url:
+            log.logger.warning("未安装 redis, 不转发其它节点的请求")
+        self._greenlet = None
+
+    # 与 Frontier 相同的接口
+    def add_filter(self, func):
+        self.local.add_filter(func)
+
+    def add_listener(self, func):
+        self.local.add_listener(func)
+
+    def pop(self, block=True, timeout=None):
+        return self.local.pop(block, timeout)
+
+    def qsize(self):
+        return self.local.qsize()
+
+    def snapshot(self):
+        return self.local.snapshot() + [r for batch in self._outbox.values() for r in batch]
+
+    def owner(self, request):
+        host = urlsplit(frontier_module.request_url(request)).hostname or ""
+        return self.ring.owner(host)
+
+    def push_many(self, requests):
+        """
+        本节点的请求放入本地 frontier，其它节点的请求放入转发队列
+        :param requests:
+        :return: 放入本地 frontier 的请求
+        """
+        if self._redis is None or len(self.ring.nodes) <= 1:
+            return self.local.push_many(requests)
+        local = []
+        for request in requests:
+            node = self.owner(request)
+            if node == self.node_id or node is None:
+                local.append(request)
+            else:
+                outbox = self._outbox[node]
+                outbox.append(request)
+                if len(outbox) >= self.batch_size:
+                    self._forward(node)
+        return self.local.push_many(local) if local else []
+
+    def push(self, request):
+        return bool(self.push_many([request]))
+
+    def _forward(self, node):
+        batch = self._outbox.pop(node, None)
+        if not batch:
+            return
+        try:
+            self._redis.rpush(SHARD_KEY.format(node), json.dumps(batch, ensure_ascii=False))
+            metrics.incr("shard.forwarded", len(batch))
+        except Exception as e:
+            log.logger.warning("转发请求失败 {} {} 条 {}".format(node, len(batch), e))
+            # 转发失败时本节点抓取
+            self.local.push_many(batch)
+
+    def _receive(self, max_batches=100):
+        """
+        取回其它节点转发给本节点的请求
+        :return:
+        """
+        self._drain(SHARD_KEY.format(self.node_id), max_batches)
+
+    def _drain(self, key, max_batches=100):
+        """
+        取回转发列表中的请求并按当前哈希环重新分配
+        :param key:
+        :param max_batches:
+        :return: 取回的请求数目
+        """
+        pipe = self._redis.pipeline(transaction=True)
+        pipe.lrange(key, 0, max_batches - 1)
+        pipe.ltrim(key, max_batches, -1)
+        batches, _ = pipe.execute()
+        received = 0
+        for data in batches:
+            try:
+                requests = json.loads(data)
+            except ValueError:
+                continue
+            received += len(requests)
+            # 转发来的请求可能属于后来加入的节点，重新分配
+            self.push_many(requests)
+        if received:
+            metrics.incr("shard.received", received)
+        return received
+
+    def _drain_departed(self, max_batches=100):
+        """
+        不在哈希环中的节点（已离开）的转发列表由离开节点在新哈希环上的所属节点取回，
+        其它节点更新哈希环之前转发给离开节点的请求也会在之后的周期中取回
+        :param max_batches:
+        :return:
+        """
+        prefix = SHARD_KEY.format("")
+        for key in self._redis.scan_iter(match=SHARD_KEY.format("*")):
+            key = key.decode("utf-8") if isinstance(key, bytes) else key
+            node = key[len(prefix):]
+            if node in self.ring.nodes or self.ring.owner(node) != self.node_id:
+                continue
+            drained = self._drain(key, max_batches)
+            if drained:
+                log.logger.info("取回离开节点 {} 的 {} 条请求".format(node, drained))
+                metrics.incr("shard.drained", drained)
+
+    def _announce(self):
+        """
+        写入本节点在线记录，读取在线节点
+        :return:
+        """
+        now = time.time()
+        pipe = self._redis.pipeline(transaction=False)
+        pipe.zadd(NODES_KEY, {self.node_id: now})
+        pipe.zremrangebyscore(NODES_KEY, 0, now - self.node_ttl)
+        pipe.zrangebyscore(NODES_KEY, now - self.node_ttl, "+inf")
+        nodes = pipe.execute()[-1]
+        self._redis_nodes = set(n.decode("utf-8") if isinstance(n, bytes) else n for n in nodes)
+        self._rebuild()
+
+    def update_nodes(self, nodes):
+        """
+        调度服务返回的节点列表
+        :param nodes:
+        :return:
+        """
+        self._dispatcher_nodes = set(str(node) for node in nodes or [])
+        self._rebuild()
+
+    def heartbeat_listener(self, data):
+        """
+        DispatcherClient 心跳监听函数，心跳返回中带 nodes 时更新节点列表
+        用法：client.add_heartbeat_listener(sharded.heartbeat_listener)
+        :param data:
+        :return:
+        """
+        if isinstance(data, dict) and data.get("nodes") is not None:
+            self.update_nodes(data.get("nodes"))
+
+    def _rebuild(self):
+        # 没有在 redis 中写入在线记录的节点不会取回转发的请求，不加入哈希环
+        nodes = self._redis_nodes
+        if self._dispatcher_nodes:
+            nodes = nodes & self._dispatcher_nodes
+        nodes = nodes | {self.node_id}
+        if self.ring.update(nodes):
+            log.logger.info("爬虫节点变化, 当前 {} 个节点".format(len(nodes)))
+            self.rebalance()
+
+    def rebalance(self):
+        """
+        重新分配本地队列和转发队列中的请求
+        :return:
+        """
+        pending = []
+        while True:
+            request = self.local.pop(block=False)
+            if request is None:
+                break
+            pending.append(request)
+        for batch in list(self._outbox.values()):
+            pending.extend(batch)
+        self._outbox.clear()
+
+        moved = 0
+        for request in pending:
+            node = self.owner(request)
+            if node == self.node_id or node is None or self._redis is None:
+                # 已经过滤的请求直接放回队列
+                self.local.queue.put(request)
+            else:
+                self._outbox[node].append(request)
+                moved += 1
+        for node in list(self._outbox):
+            self._forward(node)
+        metrics.incr("shard.rebalanced", moved)
+
+    def flush(self):
+        for node in list(self._outbox):
+            self._forward(node)
+
+    def _run(self):
+        while True:
+            try:
+                self._announce()
+                self.flush()
+                self._receive()
+                self._drain_departed()
+            except Exception as e:
+                log.logger.warning("frontier 分片同步失败 {}".format(e))
+            gevent.sleep(self.flush_interval)
+
+    def start(self):
+        if self._redis is not None and self._greenlet is None:
+            self._greenlet = gevent.spawn(self._run)
+
+    def stop(self):
+        if self._greenlet is not None:
+            self._greenlet.kill()
+            self._greenlet = None
+        if self._redis is not None:
+            self.flush()
+            # 删除在线记录，其它节点下一个周期即重新分配，不必等待记录过期
+            try:
+                self._redis.zrem(NODES_KEY, self.node_id)
+            except Exception as e:
+                log.logger.warning("删除节点在线记录失败 {}".format(e))
+
+
+def create_frontier(local, node_id=setting.SPIDER_ID):
+    """
+    开启分片时返回 ShardedFrontier，否则返回本地 frontier
+    :param local:
+    :param node_id: 本节点 id，一般为调度服务分配的爬虫 id
+    :return:
+    """
+    if not setting.SHARDING_ENABLE:
+        return local
+    if not node_id:
+        log.logger.warning("爬虫 id 为空, 不开启 frontier 分片")
+        return local
+    sharded = ShardedFrontier(local, node_id)
+    sharded.start()
+    return sharded
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+# @Project Name : spider
+"""
+文件名：shutdown.py
+功能：退出时排空和断点保存；
+　　　收到 SIGTERM / SIGINT 后在 exit_timeout 秒内完成：
+　　　　　停止接收新任务（调用注册的停止函数）
+      等待下载器中正在进行的请求完成
+      把待抓取队列、未处理的任务、未发送的结果保存到本地断点文件
+      保存 cookie，写出归档和热路径日志
+再次启动时从断点文件恢复；再次收到退出信号时立即退出
+"""
+
+import os
+import json
+import time
+import signal
+
+import gevent
+import gevent.event
+
+import log
+import hotlog
+import setting
+
+
+class ShutdownCoordinator:
+    """
+    退出协调器
+    """
+
+    def __init__(self, exit_timeout=setting.EXIT_TIMEOUT, checkpoint_dir=setting.CHECKPOINT_DIR, name="spider"):
+        """
+
+        :param exit_timeout: 收到退出信号后最长执行时间(秒)
+        :param checkpoint_dir: 断点文件目录
+        :param name: 断点文件名，多进程时每个进程使用不同的名字
+        """
+        self.exit_timeout = exit_timeout if exit_timeout > 0 else 90
+        self.checkpoint_path = os.path.join(checkpoint_dir, "{}.checkpoint.json".format(name))
+        self.stopping = False
+        self.done = gevent.event.Event()
+        self._stop_funcs = []
+        self._downloaders = []
+        # name -> (dump, restore)
+        self._checkpoints = {}
+        if not os.path.isdir(checkpoint_dir):
+            os.makedirs(checkpoint_dir)
+
+    def on_stop(self, func):
+        """
+        注册停止接收新任务的函数
+        :param func:
+        :return:
+        """
+        self._stop_funcs.append(func)
+
+    def track(self, downloader):
+        """
+        等待该下载器正在进行的请求完成后再保存断点
+        :param downloader:
+        :return:
+        """
+        self._downloaders.append(downloader)
+
+    def add_checkpoint(self, name, dump, restore):
+        """
+        注册断点数据
+        :param name:
+        :param dump: 退出时调用，返回可 json 序列化的数据
+        :param restore: 启动时调用，参数为保存的数据
+        :return:
+        """
+        self._checkpoints[name] = (dump, restore)
+
+    def in_flight(self):
+        return sum(d.in_flight for d in self._downloaders)
+
+    def install(self):
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            gevent.signal_handler(signum, self.request_shutdown, signum)
+
+    def request_shutdown(self, signum=None):
+        if self.stopping:
+            log.logger.warning("再次收到退出信号 {}, 立即退出".format(signum))
+            os._exit(1)
+        log.logger.info("收到退出信号 {}, {} 秒内保存断点后退出".format(signum, self.exit_timeout))
+        self.stopping = True
+        gevent.spawn(self.drain)
+
+    def drain(self):
+        """
+        停止接收任务，等待请求完成，保存断点；保存断点预留 exit_timeout 的五分之一
+        :return:
+        """
+        deadline = time.time() + self.exit_timeout * 0.8
+        try:
+            for func in self._stop_funcs:
+                try:
+                    func()
+                except Exception as e:
+                    log.logger.exception(e)
+            while self.in_flight() > 0 and time.time() < deadline:
+                gevent.sleep(0.1)
+            if self.in_flight() > 0:
+                log.logger.warning("退出超时, 放弃 {} 个正在进行的请求".format(self.in_flight()))
+            for d in self._downloaders:
+                if getattr(d, "archive", None) is not None:
+                    d.archive.flush()
+                if getattr(d, "cookie_pool", None) is not None:
+                    d.cookie_pool.save_all()
+            self.save()
+        finally:
+            # 停止后台写出并写出剩余的日志
+            hotlog.hot_logger.stop()
+            self.done.set()
+
+    def wait(self, timeout=None):
+        """
+        主流程等待排空完成后退出
+        :param timeout:
+        :return:
+        """
+        return self.done.wait(timeout)
+
+    def save(self):
+        data = {}
+        for name, (dump, _) in self._checkpoints.items():
+            try:
+                data[name] = dump()
+            except Exception as e:
+                log.logger.warning("保存断点失败 {} {}".format(name, e))
+        if not any(data.values()):
+            return
+        tmp = self.checkpoint_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"time": time.time(), "data": data}, f, ensure_ascii=False)
+        os.replace(tmp, self.checkpoint_path)
+        log.logger.info("断点已保存 {} {}".format(self.checkpoint_path, {k: len(v) for k, v in data.items() if v}))
+
+    def restore(self):
+        """
+        启动时从断点恢复，恢复后删除断点文件，避免重复恢复
+        :return: 是否恢复了断点
+        """
+        if not os.path.exists(self.checkpoint_path):
+            return False
+        try:
+            with open(self.checkpoint_path) as f:
+                data = json.load(f).get("data", {})
+        except Exception as e:
+            log.logger.warning("读取断点失败 {} {}".format(self.checkpoint_path, e))
+            return False
+        os.remove(self.checkpoint_path)
+        for name, value in data.items():
+            if name not in self._checkpoints or not value:
+                continue
+            try:
+                self._checkpoints[name][1](value)
+            except Exception as e:
+                log.logger.warning("恢复断点失败 {} {}".format(name, e))
+        log.logger.info("已从断点恢复 {}".format({k: len(v) for k, v in data.items() if v}))
+        return True
+
+    def add_frontier(self, frontier, name="frontier"):
+        """
+        保存待抓取队列；恢复时直接放回队列，不再经过过滤函数（请求已去重）
+        :param frontier:
+        :param name:
+        :return:
+        """
+        def restore(requests):
+            for request in requests:
+                frontier.queue.put(request)
+
+        self.add_checkpoint(name, frontier.snapshot, restore)
+
+    def add_dispatcher(self, client):
+        """
+        停止预取任务；保存已预取未处理的任务和发送失败的结果
+        :param client: dispatcher.DispatcherClient
+        :return:
+        """
+        def dump_results():
+            client.flush_results()
+            return list(client._results)
+
+        def restore_tasks(tasks):
+            for task in tasks:
+                client.task_queue.put(task)
+
+        self.on_stop(client.stop)
+        self.add_checkpoint("tasks", lambda: list(client.task_queue.queue), restore_tasks)
+        # flush_results 会替换 client._results，恢复时不能绑定旧列表的 extend
+        self.add_checkpoint("results", dump_results, lambda results: client._results.extend(results))
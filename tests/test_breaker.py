@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+熔断器状态转换测试
+"""
+
+from breaker import CircuitBreaker, BreakerRegistry, CLOSED, OPEN, HALF_OPEN
+
+
+def test_opens_after_threshold():
+    b = CircuitBreaker("a.com", threshold=3, cool_down=10)
+    assert not b.failure(now=0)
+    assert not b.failure(now=0)
+    assert b.failure(now=0)
+    assert b.state == OPEN
+    assert not b.allow(now=5)
+    assert b.retry_after(now=5) == 5
+
+
+def test_success_resets_failures():
+    b = CircuitBreaker("a.com", threshold=2)
+    b.failure(now=0)
+    b.success()
+    assert not b.failure(now=0)
+    assert b.state == CLOSED
+
+
+def test_half_open_probe_success_closes():
+    b = CircuitBreaker("a.com", threshold=1, cool_down=10, max_probes=1)
+    b.failure(now=0)
+    assert b.allow(now=10)
+    assert b.state == HALF_OPEN
+    # 只放行 max_probes 个探测请求
+    assert not b.allow(now=10)
+    b.success()
+    assert b.state == CLOSED
+    assert b.allow(now=11)
+
+
+def test_half_open_probe_failure_reopens():
+    b = CircuitBreaker("a.com", threshold=5, cool_down=10)
+    for _ in range(5):
+        b.failure(now=0)
+    assert b.allow(now=10)
+    # half_open 状态下一次失败即重新打开
+    assert b.failure(now=10)
+    assert b.state == OPEN
+    assert not b.allow(now=15)
+    assert b.allow(now=20)
+
+
+def test_lost_probe_is_replaced_after_cool_down():
+    b = CircuitBreaker("a.com", threshold=1, cool_down=10)
+    b.failure(now=0)
+    assert b.allow(now=10)
+    assert not b.allow(now=15)
+    # 探测请求超过冷却时间没有结果，重新放行
+    assert b.allow(now=20)
+
+
+def test_registry_tracks_keys():
+    registry = BreakerRegistry("host", threshold=2, cool_down=60)
+    assert registry.allow("a.com")
+    registry.failure("a.com")
+    registry.failure("a.com")
+    assert not registry.allow("a.com")
+    assert registry.allow("b.com")
+    assert registry.retry_after("a.com") > 0
+    assert registry.snapshot()["a.com"][0] == OPEN
+    registry.success("a.com")
+    assert registry.allow("a.com")
+    assert registry.snapshot() == {}
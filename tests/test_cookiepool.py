@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+"""
+cookie jar 分片测试
+"""
+
+from cookiepool import CookieJarPool
+
+
+def test_key_for_prefers_cookie_key():
+    assert CookieJarPool.key_for("a.com") == "a.com"
+    assert CookieJarPool.key_for("a.com", {"meta": {"cookie_key": "user1"}}) == "user1"
+    assert CookieJarPool.key_for("a.com", {"meta": {}}) == "a.com"
+
+
+def test_evicted_jar_is_saved_and_reloaded(tmp_path):
+    pool = CookieJarPool(max_jars=1, persist_dir=str(tmp_path))
+    pool.get("a.com").set("session", "1", domain="a.com")
+    pool.bind_proxy("a.com", "http", "1.1.1.1:80")
+    # 超过上限时淘汰并保存 a.com
+    pool.get("b.com")
+    assert "a.com" not in pool._jars
+    assert pool.sticky_proxy("a.com") == (None, None)
+    jar = pool.get("a.com")
+    assert jar.get("session") == "1"
+    assert pool.sticky_proxy("a.com") == ("http", "1.1.1.1:80")
+
+
+def test_save_all_persists_jars_in_memory(tmp_path):
+    pool = CookieJarPool(max_jars=10, persist_dir=str(tmp_path))
+    pool.get("a.com").set("token", "x", domain="a.com")
+    pool.save_all()
+    assert CookieJarPool(max_jars=10, persist_dir=str(tmp_path)).get("a.com").get("token") == "x"
+
+
+def test_clear_removes_saved_jar(tmp_path):
+    pool = CookieJarPool(max_jars=10, persist_dir=str(tmp_path))
+    pool.get("a.com").set("token", "x", domain="a.com")
+    pool.save("a.com")
+    pool.clear("a.com")
+    assert pool.get("a.com").get("token") is None
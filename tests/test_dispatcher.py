@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+调度服务客户端测试，使用桩 session 代替真实调度服务
+"""
+
+import gevent
+
+from dispatcher import DispatcherClient
+
+URLS = {
+    "get_spider_config_from": "http://dispatcher/get/%s/%s",
+    "add_spider_from": "",
+    "spider_heartbeat_from": "",
+    "send_crawl_result_to": "",
+}
+
+
+class StubResponse:
+    def __init__(self, data):
+        self.data = data
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self.data
+
+
+class StubSession:
+    """
+    桩调度服务：依次返回 batches 中的任务列表，用完后返回空列表
+    """
+
+    def __init__(self, batches=(), delay=0):
+        self.batches = list(batches)
+        self.delay = delay
+        self.calls = []
+
+    def request(self, method, url, timeout=None, **kwargs):
+        self.calls.append((method, url, kwargs.get("params")))
+        if self.delay:
+            gevent.sleep(self.delay)
+        return StubResponse(self.batches.pop(0) if self.batches else [])
+
+
+def make_client(session, **kwargs):
+    kwargs.setdefault("batch_size", 3)
+    kwargs.setdefault("prefetch_num", 5)
+    kwargs.setdefault("long_poll", 0)
+    return DispatcherClient(spider_id="1", urls=URLS, session=session, crawl_stats=False, **kwargs)
+
+
+def test_fetch_tasks_batches():
+    session = StubSession([{"tasks": [{"id": 1}, {"id": 2}]}])
+    client = make_client(session)
+    assert client.fetch_tasks("w") == [{"id": 1}, {"id": 2}]
+    assert session.calls[0] == ("GET", "http://dispatcher/get/1/w", {"num": 3})
+
+
+def test_prefetch_fills_queue_up_to_watermark():
+    session = StubSession([[{"id": i} for i in range(3)], [{"id": i} for i in range(3, 6)]])
+    client = make_client(session)
+    client.start("w")
+    try:
+        gevent.sleep(0.1)
+        # 两批之后队列达到水位，不再请求
+        assert client.task_queue.qsize() == 6
+        assert len(session.calls) == 2
+        assert client.get_task(timeout=0.1) == {"id": 0}
+    finally:
+        client.stop()
+
+
+def test_empty_fetch_backs_off():
+    session = StubSession()
+    client = make_client(session)
+    client.start("w")
+    try:
+        gevent.sleep(0.3)
+        assert len(session.calls) == 1
+    finally:
+        client.stop()
+
+
+def test_long_poll_backs_off_when_dispatcher_returns_immediately():
+    # 调度服务不支持 wait，立即返回空：不能连续请求
+    session = StubSession()
+    client = make_client(session, long_poll=10)
+    client.start("w")
+    try:
+        gevent.sleep(0.3)
+        assert len(session.calls) == 1
+        assert session.calls[0][2] == {"num": 3, "wait": 10}
+    finally:
+        client.stop()
+
+
+def test_long_poll_retries_immediately_after_held_request():
+    # 调度服务挂满了等待时间才返回空，立即发起下一次长轮询
+    session = StubSession(delay=0.1)
+    client = make_client(session, long_poll=0.1)
+    client.start("w")
+    try:
+        gevent.sleep(0.35)
+        assert len(session.calls) >= 3
+    finally:
+        client.stop()
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+dns 缓存测试，使用桩解析函数代替真实 dns
+"""
+
+import socket
+
+import gevent
+import pytest
+
+from downloader import DNSCache
+
+
+class StubResolver:
+    def __init__(self, result=None, error=None, delay=0):
+        self.result = result
+        self.error = error
+        self.delay = delay
+        self.calls = []
+
+    def __call__(self, host):
+        self.calls.append(host)
+        if self.delay:
+            gevent.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+def test_hit_after_first_resolve():
+    resolver = StubResolver(["10.0.0.1"])
+    cache = DNSCache(ttl=60, resolver=resolver)
+    assert cache.resolve("a.com") == ["10.0.0.1"]
+    assert cache.resolve("a.com") == ["10.0.0.1"]
+    assert resolver.calls == ["a.com"]
+
+
+def test_record_ttl_expires():
+    resolver = StubResolver((["10.0.0.1"], 0.05))
+    cache = DNSCache(ttl=60, resolver=resolver)
+    cache.resolve("a.com")
+    gevent.sleep(0.1)
+    cache.resolve("a.com")
+    assert len(resolver.calls) == 2
+
+
+def test_concurrent_resolves_share_one_lookup():
+    resolver = StubResolver(["10.0.0.1"], delay=0.05)
+    cache = DNSCache(resolver=resolver)
+    jobs = [gevent.spawn(cache.resolve, "a.com") for _ in range(5)]
+    gevent.joinall(jobs)
+    assert [job.value for job in jobs] == [["10.0.0.1"]] * 5
+    assert resolver.calls == ["a.com"]
+
+
+def test_nxdomain_is_negative_cached():
+    resolver = StubResolver(error=socket.gaierror(socket.EAI_NONAME, "not found"))
+    cache = DNSCache(negative_ttl=60, resolver=resolver)
+    for _ in range(2):
+        with pytest.raises(socket.gaierror):
+            cache.resolve("missing.com")
+    assert resolver.calls == ["missing.com"]
+
+
+def test_temporary_failure_is_not_cached():
+    resolver = StubResolver(error=socket.gaierror(socket.EAI_AGAIN, "try again"))
+    cache = DNSCache(negative_ttl=60, resolver=resolver)
+    for _ in range(2):
+        with pytest.raises(socket.gaierror):
+            cache.resolve("flaky.com")
+    assert len(resolver.calls) == 2
+
+
+def test_create_connection_uses_cached_ips():
+    resolver = StubResolver(["10.0.0.1", "10.0.0.2"])
+    cache = DNSCache(resolver=resolver)
+    attempts = []
+
+    def fake_create_connection(address, *args, **kwargs):
+        attempts.append(address)
+        if address[0] == "10.0.0.1":
+            raise OSError("refused")
+        return "conn"
+
+    cache._original_create_connection = fake_create_connection
+    assert cache._create_connection(("a.com", 80)) == "conn"
+    assert attempts == [("10.0.0.1", 80), ("10.0.0.2", 80)]
+    # ip 直连不经过解析
+    assert cache._create_connection(("127.0.0.1", 80)) == "conn"
+    assert resolver.calls == ["a.com"]
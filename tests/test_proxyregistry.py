@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+代理注册表测试：得分、选择和删除
+"""
+
+from proxyregistry import ProxyRegistry
+
+
+def test_add_ignores_duplicates_and_blacklist():
+    registry = ProxyRegistry()
+    assert registry.add("http", "1.1.1.1:80") == 0
+    assert registry.add("http", "1.1.1.1:80") is None
+    registry.ban("2.2.2.2:80")
+    assert registry.add("http", "2.2.2.2:80") is None
+    assert len(registry) == 1
+    assert registry.get(0) == ("http", "1.1.1.1:80")
+
+
+def test_score_prefers_success_and_low_latency():
+    registry = ProxyRegistry(max_failures=0, min_score=0)
+    good, slow, bad = (registry.add("http", "10.0.0.{}:80".format(i)) for i in range(3))
+    for _ in range(5):
+        registry.release(good, True, 0.1)
+        registry.release(slow, True, 2.0)
+        registry.release(bad, False, 0.1)
+    assert registry.score(good) > registry.score(slow)
+    assert registry.score(good) > registry.score(bad)
+    # 新代理没有记录，得分为 0.5
+    fresh = registry.add("http", "10.0.0.9:80")
+    assert registry.score(fresh) == 0.5
+
+
+def test_in_use_proxy_is_not_selected():
+    registry = ProxyRegistry()
+    pid = registry.add("http", "1.1.1.1:80")
+    registry.acquire(pid)
+    assert registry.available_count() == 0
+    assert registry.select() is None
+    assert not registry.release(pid, None)
+    assert registry.select() == pid
+    # 取消的请求不记录结果
+    assert registry.successes[pid] == registry.failures[pid] == 0
+
+
+def test_consecutive_failures_evict():
+    registry = ProxyRegistry(max_failures=3, min_score=0)
+    pid = registry.add("http", "1.1.1.1:80")
+    assert not registry.release(pid, False)
+    assert not registry.release(pid, False)
+    # 成功后连续失败次数清零
+    assert not registry.release(pid, True)
+    assert not registry.release(pid, False)
+    assert not registry.release(pid, False)
+    assert registry.release(pid, False)
+    assert "1.1.1.1:80" not in registry
+    assert registry.available_count() == 0
+    assert registry.select() is None
+
+
+def test_low_score_evicts():
+    registry = ProxyRegistry(max_failures=0, min_score=0.2)
+    pid = registry.add("http", "1.1.1.1:80")
+    # 失败时也记录耗时，耗时长的失败代理得分下降更快
+    assert registry.release(pid, False, 5.0)
+    assert len(registry) == 0
+
+
+def test_removed_id_is_reused_with_fresh_stats():
+    registry = ProxyRegistry(max_failures=1)
+    pid = registry.add("http", "1.1.1.1:80")
+    registry.release(pid, False, 1.0)
+    new = registry.add("socks5", "2.2.2.2:1080")
+    assert new == pid
+    assert registry.get(new) == ("socks5", "2.2.2.2:1080")
+    assert registry.failures[new] == 0 and registry.latency[new] == 0
+    assert registry.score(new) == 0.5
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+"""
+robots.txt 解析测试
+"""
+
+from robots import RobotsRules
+
+TEXT = """
+User-agent: spider
+Disallow: /spider-only
+
+User-agent: MySpider/2.0
+Disallow: /myspider-only
+Crawl-delay: 5
+
+User-agent: *
+Disallow: /private
+"""
+
+
+def test_group_matched_by_product_token():
+    rules = RobotsRules.parse(TEXT, "myspider")
+    assert not rules.allowed("/myspider-only")
+    # spider 分组不匹配 myspider
+    assert rules.allowed("/spider-only")
+    assert rules.allowed("/private")
+    assert rules.crawl_delay == 5
+
+
+def test_group_match_ignores_case_and_version():
+    rules = RobotsRules.parse(TEXT, "Spider/1.0")
+    assert not rules.allowed("/spider-only")
+    assert rules.allowed("/myspider-only")
+
+
+def test_unknown_agent_uses_wildcard_group():
+    rules = RobotsRules.parse(TEXT, "otherbot")
+    assert not rules.allowed("/private")
+    assert rules.allowed("/spider-only")
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+多任务公平调度测试
+"""
+
+from scheduler import FairScheduler
+
+
+def make_scheduler(pages, **kwargs):
+    """
+    :param pages: config_id -> 该任务每一轮的请求
+    """
+    finished = []
+    scheduler = FairScheduler(on_start=lambda task, round_: pages[task["config_id"]],
+                              on_finished=finished.append, **kwargs)
+    return scheduler, finished
+
+
+def test_max_in_flight_caps_task():
+    scheduler, _ = make_scheduler({"a": ["http://a{}.com/".format(i) for i in range(5)]},
+                                  max_in_flight=2, max_host_connections=0)
+    scheduler.add_task({"config_id": "a"})
+    taken = [scheduler.next(timeout=0) for _ in range(3)]
+    assert taken[0][0] is not None and taken[1][0] is not None
+    assert taken[2] == (None, None)
+    scheduler.done(*taken[0])
+    assert scheduler.next(timeout=0)[0] is not None
+
+
+def test_host_cap_skips_to_other_hosts():
+    urls = ["http://slow.com/1", "http://slow.com/2", "http://fast.com/1"]
+    scheduler, _ = make_scheduler({"a": urls}, max_in_flight=0, max_host_connections=1)
+    scheduler.add_task({"config_id": "a"})
+    _, first = scheduler.next(timeout=0)
+    _, second = scheduler.next(timeout=0)
+    assert first["url"] == "http://slow.com/1"
+    # slow.com 受限时不阻塞 fast.com
+    assert second["url"] == "http://fast.com/1"
+    assert scheduler.next(timeout=0) == (None, None)
+
+
+def test_weighted_fair_share():
+    pages = {"a": ["http://a.com/{}".format(i) for i in range(30)],
+             "b": ["http://b.com/{}".format(i) for i in range(30)]}
+    scheduler, _ = make_scheduler(pages, max_in_flight=0, max_host_connections=0)
+    scheduler.add_task({"config_id": "a", "priority": 2})
+    scheduler.add_task({"config_id": "b", "priority": 1})
+    counts = {"a": 0, "b": 0}
+    for _ in range(30):
+        state, request = scheduler.next(timeout=0)
+        counts[state.config_id] += 1
+        scheduler.done(state, request)
+    assert counts["a"] == 20 and counts["b"] == 10
+
+
+def test_task_finishes_after_all_rounds():
+    scheduler, finished = make_scheduler({"a": ["http://a.com/"]}, max_in_flight=0, max_host_connections=0)
+    scheduler.add_task({"config_id": "a", "repeat_times": 2})
+    for _ in range(2):
+        state, request = scheduler.next(timeout=0)
+        scheduler.done(state, request)
+    assert finished == [{"config_id": "a", "repeat_times": 2}]
+    assert not scheduler.tasks
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""
+一致性哈希环和分布式 frontier 测试，使用内存中的桩 redis
+"""
+
+import fnmatch
+
+import frontier
+from sharding import HashRing, ShardedFrontier, NODES_KEY, SHARD_KEY
+
+
+class StubRedis:
+    """
+    只实现 ShardedFrontier 用到的命令
+    """
+
+    def __init__(self):
+        self.zsets = {}
+        self.lists = {}
+
+    def pipeline(self, transaction=True):
+        return StubPipeline(self)
+
+    def zadd(self, key, mapping):
+        self.zsets.setdefault(key, {}).update(mapping)
+
+    def zrem(self, key, member):
+        self.zsets.get(key, {}).pop(member, None)
+
+    def zremrangebyscore(self, key, low, high):
+        zset = self.zsets.get(key, {})
+        for member in [m for m, score in zset.items() if low <= score <= high]:
+            zset.pop(member)
+
+    def zrangebyscore(self, key, low, high):
+        high = float("inf") if high == "+inf" else high
+        return [m.encode("utf-8") for m, score in self.zsets.get(key, {}).items() if low <= score <= high]
+
+    def rpush(self, key, value):
+        self.lists.setdefault(key, []).append(value)
+
+    def lrange(self, key, start, end):
+        return list(self.lists.get(key, [])[start:end + 1])
+
+    def ltrim(self, key, start, end):
+        self.lists[key] = self.lists.get(key, [])[start:]
+
+    def scan_iter(self, match="*"):
+        return [key.encode("utf-8") for key in list(self.lists) if fnmatch.fnmatch(key, match)]
+
+
+class StubPipeline:
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def __getattr__(self, name):
+        def command(*args):
+            self.commands.append((name, args))
+        return command
+
+    def execute(self):
+        return [getattr(self.redis, name)(*args) for name, args in self.commands]
+
+
+def make_node(redis, node_id):
+    node = ShardedFrontier(frontier.Frontier(), node_id=node_id, redis_url=None, batch_size=1, node_ttl=60)
+    node._redis = redis
+    return node
+
+
+def urls(n):
+    return ["http://host{}.com/page".format(i) for i in range(n)]
+
+
+def drain_local(node):
+    result = []
+    while True:
+        request = node.pop(block=False)
+        if request is None:
+            return result
+        result.append(request)
+
+
+def test_ring_moves_few_keys_when_node_added():
+    keys = ["host{}.com".format(i) for i in range(1000)]
+    ring = HashRing(["a", "b", "c"])
+    before = {key: ring.owner(key) for key in keys}
+    assert ring.update(["a", "b", "c", "d"])
+    moved = [key for key in keys if ring.owner(key) != before[key]]
+    # 只有归属新节点的 key 迁移
+    assert all(ring.owner(key) == "d" for key in moved)
+    assert len(moved) < len(keys) / 2
+    assert not ring.update(["d", "c", "b", "a"])
+
+
+def test_dispatcher_only_nodes_do_not_join_ring():
+    redis = StubRedis()
+    a = make_node(redis, "a")
+    a.update_nodes(["a", "b"])
+    a._announce()
+    # b 没有在 redis 中写入在线记录
+    assert a.ring.nodes == {"a"}
+    b = make_node(redis, "b")
+    b._announce()
+    a._announce()
+    assert a.ring.nodes == {"a", "b"}
+
+
+def test_dispatcher_nodes_filter_redis_nodes():
+    redis = StubRedis()
+    a, b = make_node(redis, "a"), make_node(redis, "b")
+    b._announce()
+    a.update_nodes(["a"])
+    a._announce()
+    assert a.ring.nodes == {"a"}
+
+
+def test_requests_forwarded_and_received():
+    redis = StubRedis()
+    a, b = make_node(redis, "a"), make_node(redis, "b")
+    a._announce()
+    b._announce()
+    a._announce()
+    a.push_many(urls(50))
+    a.flush()
+    b._receive()
+    local_a, local_b = drain_local(a), drain_local(b)
+    assert sorted(local_a + local_b) == sorted(urls(50))
+    assert all(a.owner(url) == "a" for url in local_a)
+    assert all(a.owner(url) == "b" for url in local_b)
+
+
+def test_departed_node_list_is_drained_by_new_owner():
+    redis = StubRedis()
+    a, b, c = make_node(redis, "a"), make_node(redis, "b"), make_node(redis, "c")
+    for node in (a, b, c, a, b):
+        node._announce()
+    a.push_many(urls(100))
+    a.flush()
+    to_c = [url for url in urls(100) if a.owner(url) == "c"]
+    assert to_c and redis.lists.get(SHARD_KEY.format("c"))
+
+    # c 离开，未取回转发给它的请求
+    c.stop()
+    assert "c" not in redis.zsets[NODES_KEY]
+    for node in (a, b):
+        node._announce()
+        node._drain_departed()
+    for node in (a, b):
+        node.flush()
+        node._receive()
+    assert not redis.lists.get(SHARD_KEY.format("c"))
+    received = drain_local(a) + drain_local(b)
+    assert set(to_c) <= set(received)